@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+import os
+import threading
+import time
+
+from sqlalchemy import func
+
+from main_db import Coupons, OrderLine, SpecialOffer, Users
+import query_budget
+
+
+# Панель статистики перераховується не частіше ніж раз на ADMIN_STATS_TTL секунд
+ADMIN_STATS_TTL = float(os.getenv("ADMIN_STATS_TTL", "300"))
+STATS_DAYS = 14
+TOP_ITEMS = 5
+
+
+class AdminStats:
+    '''Numbers for the admin dashboard, all computed by SQL aggregates.'''
+    __slots__ = ("users", "orders_per_day", "revenue_total", "revenue_period",
+                 "top_items", "active_offers", "computed_at")
+
+    def __init__(self, db_session, days=STATS_DAYS):
+        since = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+        revenue = func.sum(OrderLine.unit_price * OrderLine.quantity)
+
+        self.users = db_session.query(func.count(Users.id)).scalar()
+        self.active_offers = db_session.query(func.count(SpecialOffer.id)) \
+            .filter(SpecialOffer.active == True, SpecialOffer.expiration_date > datetime.now()).scalar()
+
+        # date() є і в Postgres, і в SQLite; SQLite повертає рядок, тож приводимо до str
+        day = func.date(Coupons.order_time)
+        orders = dict(db_session.query(day, func.count(Coupons.id))
+                      .filter(Coupons.order_time >= since).group_by(day).all())
+        line_day = func.date(OrderLine.order_time)
+        revenue_by_day = dict(db_session.query(line_day, revenue)
+                              .filter(OrderLine.order_time >= since).group_by(line_day).all())
+        orders = {str(key): value for key, value in orders.items()}
+        revenue_by_day = {str(key): value for key, value in revenue_by_day.items()}
+
+        self.orders_per_day = []
+        for offset in range(days):
+            key = (since + timedelta(days=offset)).date().isoformat()
+            self.orders_per_day.append((key, orders.get(key, 0), round(revenue_by_day.get(key) or 0, 2)))
+
+        self.revenue_total = round(db_session.query(revenue).scalar() or 0, 2)
+        self.revenue_period = round(sum(revenue for _, _, revenue in self.orders_per_day), 2)
+        self.top_items = db_session.query(
+            OrderLine.menu_name, func.sum(OrderLine.quantity).label("quantity"), revenue.label("revenue")
+        ).filter(OrderLine.order_time >= since).group_by(OrderLine.menu_name) \
+            .order_by(func.sum(OrderLine.quantity).desc()).limit(TOP_ITEMS).all()
+        self.computed_at = datetime.now()
+
+
+_lock = threading.Lock()
+_stats = None
+_stats_at = 0
+
+
+def get_stats(db_session):
+    '''Returns cached AdminStats, recomputing them after ADMIN_STATS_TTL.'''
+    global _stats, _stats_at
+    if _stats is not None and time.monotonic() - _stats_at < ADMIN_STATS_TTL:
+        return _stats
+    with _lock:
+        if _stats is None or time.monotonic() - _stats_at >= ADMIN_STATS_TTL:
+            with query_budget.exempt():
+                _stats = AdminStats(db_session)
+            _stats_at = time.monotonic()
+    return _stats
+
+
+def invalidate():
+    '''Drops this process's cached stats after an admin change (others wait for the TTL).'''
+    global _stats
+    _stats = None
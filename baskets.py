@@ -0,0 +1,200 @@
+from sqlalchemy import insert
+
+from main_db import Basket
+import catalog_cache
+
+
+MAX_UNITS = 10
+MAX_LINES = 10
+SESSION_KEY = "basket"
+
+
+class BasketLimitError(ValueError):
+    pass
+
+
+class BasketLine:
+    '''One basket position with the cached menu item attached.'''
+    __slots__ = ("menu_id", "quantity", "menu")
+
+    def __init__(self, menu_id, quantity, menu):
+        self.menu_id = menu_id
+        self.quantity = quantity
+        self.menu = menu
+
+
+def _load_rows(db_session, user_id):
+    items = {}
+    for row in db_session.query(Basket.menu_id, Basket.quantity) \
+            .filter_by(user_id=user_id).order_by(Basket.id):
+        key = str(row.menu_id)
+        items[key] = items.get(key, 0) + row.quantity
+    return items
+
+
+def _trim(items):
+    '''Cuts a merged basket down to the line and unit limits, keeping the order.'''
+    trimmed = {}
+    units = 0
+    for key, quantity in items.items():
+        if len(trimmed) >= MAX_LINES or units >= MAX_UNITS:
+            break
+        quantity = min(quantity, MAX_UNITS - units)
+        if quantity > 0:
+            trimmed[key] = quantity
+            units += quantity
+    return trimmed
+
+
+def _check_add(items, key, quantity):
+    if quantity < 1:
+        raise BasketLimitError("Кількість повинна бути не менше 1!")
+    total = sum(items.values()) + quantity
+    if total > MAX_UNITS:
+        raise BasketLimitError(
+            f"В кошику не може бути більше {MAX_UNITS} одиниць товару! Лишня кількість: {total - MAX_UNITS}")
+    if key not in items and len(items) >= MAX_LINES:
+        raise BasketLimitError(f"В кошику не може бути більше {MAX_LINES} позицій!")
+
+
+class SessionBasket:
+    '''The user's basket mirrored in the session as {"<menu_id>": quantity}.
+
+    Pages read the basket from the session only. Every change is a single
+    capped statement against the Basket table, which stays the source of
+    truth; the session copy is updated from what the statement returned
+    and re-read from the DB if another tab or device changed the basket.
+    '''
+
+    def __init__(self, session, state):
+        self._session = session
+        self._state = state
+
+    @property
+    def items(self):
+        return {int(key): quantity for key, quantity in self._state["items"].items()}
+
+    @property
+    def total_quantity(self):
+        return sum(self._state["items"].values())
+
+    def __len__(self):
+        return len(self._state["items"])
+
+    def lines(self):
+        '''BasketLine objects for items that still exist in the catalog.'''
+        catalog = catalog_cache.get_catalog()
+        lines = []
+        for menu_id, quantity in self.items.items():
+            menu = catalog.by_id.get(menu_id)
+            if menu is not None:
+                lines.append(BasketLine(menu_id, quantity, menu))
+        return lines
+
+    def add(self, db_session, menu_id, quantity):
+        items = self._state["items"]
+        key = str(menu_id)
+        # Очевидне перевищення відсікаємо без запиту; остаточно ліміт перевіряє БД
+        _check_add(items, key, quantity)
+
+        new_quantity = Basket.add_capped(db_session, self._state["user_id"], menu_id,
+                                         quantity, MAX_UNITS, MAX_LINES)
+        if new_quantity is None:
+            # Кошик змінили в іншій вкладці: перечитуємо й пояснюємо, що саме не так
+            self.reload(db_session)
+            _check_add(self._state["items"], key, quantity)
+            raise BasketLimitError(f"В кошику не може бути більше {MAX_UNITS} одиниць товару!")
+
+        if new_quantity != items.get(key, 0) + quantity:
+            self.reload(db_session)
+        else:
+            items[key] = new_quantity
+            self._session.modified = True
+
+    def set_quantity(self, db_session, menu_id, quantity):
+        '''Returns False if the item is not in the basket or the cap was hit.'''
+        new_quantity = Basket.set_quantity_capped(db_session, self._state["user_id"], menu_id,
+                                                  quantity, MAX_UNITS)
+        if new_quantity is None:
+            self.reload(db_session)
+            return False
+
+        self._state["items"][str(menu_id)] = new_quantity
+        self._session.modified = True
+        return True
+
+    def remove(self, db_session, menu_id):
+        '''Returns False if the item was not in the basket.'''
+        deleted = db_session.query(Basket).filter_by(
+            user_id=self._state["user_id"], menu_id=menu_id).delete()
+        db_session.commit()
+
+        self._state["items"].pop(str(menu_id), None)
+        self._session.modified = True
+        return deleted > 0
+
+    def take(self, db_session):
+        '''Deletes the stored lines for checkout, without committing.
+
+        Returns BasketLine objects built from the deleted rows rather than
+        from the session copy, which another tab or device may have made stale. Rows of items
+        that left the catalog are deleted too but not returned.
+        '''
+        catalog = catalog_cache.get_catalog()
+        lines = []
+        for row in Basket.take_all(db_session, self._state["user_id"]):
+            menu = catalog.by_id.get(row.menu_id)
+            if menu is not None:
+                lines.append(BasketLine(row.menu_id, row.quantity, menu))
+        return lines
+
+    def mark_ordered(self):
+        '''Empties the basket after checkout deleted its rows in the same transaction.'''
+        self._state["items"] = {}
+        self._session.modified = True
+
+    def reload(self, db_session):
+        '''Re-reads the session copy from the Basket table.'''
+        self._state["items"] = _load_rows(db_session, self._state["user_id"])
+        # Вкладений dict змінюється на місці, тому Flask сам цього не помітить
+        self._session.modified = True
+
+
+def get(session, user_id, db_session):
+    '''Returns the session basket, loading it from the DB once per session.'''
+    state = session.get(SESSION_KEY)
+    if not state or state.get("user_id") != user_id:
+        state = {"user_id": user_id, "items": _load_rows(db_session, user_id)}
+        session[SESSION_KEY] = state
+    return SessionBasket(session, state)
+
+
+def reconcile(session, user_id, db_session):
+    '''Called at login: merges a basket left in the session with the stored one.
+
+    The stored basket may have been written by another device. For items in
+    both the larger quantity wins; the result is trimmed to the limits and
+    written back if it differs from the stored rows.
+    '''
+    stored = _load_rows(db_session, user_id)
+    state = session.get(SESSION_KEY)
+    merged = dict(stored)
+    if state and state.get("user_id") == user_id:
+        for key, quantity in state["items"].items():
+            merged[key] = max(merged.get(key, 0), quantity)
+    merged = _trim(merged)
+
+    if merged != stored:
+        db_session.query(Basket).filter_by(user_id=user_id).delete()
+        # Один executemany: add_all на SQLite робить INSERT ... RETURNING id на кожен рядок
+        if merged:
+            db_session.execute(insert(Basket), [{"user_id": user_id, "menu_id": int(key), "quantity": quantity}
+                                                for key, quantity in merged.items()])
+        db_session.commit()
+
+    session[SESSION_KEY] = {"user_id": user_id, "items": merged}
+    return SessionBasket(session, session[SESSION_KEY])
+
+
+def forget(session):
+    session.pop(SESSION_KEY, None)
@@ -0,0 +1,357 @@
+from datetime import datetime, timedelta
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+# Бенчмарк піднімає застосунок у цьому ж процесі (Flask test client) проти
+# окремої БД: за замовчуванням тимчасовий SQLite-файл, або --database-url
+# на порожню локальну Postgres. Ліміти входу і вартість bcrypt знижені,
+# бо міряємо саму програму, а не захист від перебору. Перевищення бюджету
+# SQL-запитів маршруту (query_budget) дає 500, тобто помилку прогону
+BENCH_ENV = {
+    "SECRET_KEY": secrets.token_hex(32),
+    "BCRYPT_ROUNDS": "4",
+    "PASSWORD_POOL": "thread",
+    "LOGIN_RATE_PER_IP": "1000000",
+    "LOGIN_RATE_PER_USERNAME": "1000000",
+    "REGISTER_RATE_PER_IP": "1000000",
+    "LOG_FORMAT": "text",
+    "QUERY_BUDGET": "raise",
+}
+PASSWORD = "bench-password"
+PERCENTILES = (50, 95, 99)
+
+
+def configure(database_url):
+    os.environ["DATABASE_URL"] = database_url
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+
+
+# ===== НАПОВНЕННЯ БД =====
+def seed(users, menu_items, offers, coupons_per_user, rng):
+    '''Creates the schema and inserts realistic volumes; returns menu item names.'''
+    from sqlalchemy import insert
+
+    import migrations
+    import passwords
+    from main_db import Base, Coupons, Menu, OrderLine, Session, SpecialOffer, Users, engine
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    migrations.upgrade()
+
+    # Один хеш на всіх - bcrypt тут не предмет вимірювання
+    password_hash = passwords.hash_password(PASSWORD)
+    now = datetime.now()
+    with Session() as db_session:
+        # id повертає сама БД, щоб послідовності Postgres лишались узгодженими
+        user_ids = db_session.scalars(insert(Users).returning(Users.id, sort_by_parameter_order=True), [{
+            "username": "admin" if index == 0 else f"user{index:05d}",
+            "email": f"user{index:05d}@bench.local",
+            "password": password_hash,
+            "is_admin": index == 0,
+        } for index in range(users)]).all()
+
+        menu = [{
+            "name": f"Item {index + 1:03d}", "weight": f"{rng.randint(150, 450)} мл",
+            "ingredients": "кава, молоко", "description": "Опис позиції " * rng.randint(1, 12),
+            "price": rng.randint(40, 180), "active": index % 10 != 9, "file_name": f"item{index + 1}.png",
+        } for index in range(menu_items)]
+        menu_ids = db_session.scalars(insert(Menu).returning(Menu.id, sort_by_parameter_order=True), menu).all()
+        for item, menu_id in zip(menu, menu_ids):
+            item["id"] = menu_id
+        db_session.execute(insert(SpecialOffer), [{
+            "menu_id": rng.choice(menu_ids), "discount": rng.choice((5, 10, 15, 20, 30)),
+            "expiration_date": now + timedelta(days=rng.randint(1, 30)), "active": True,
+        } for _ in range(offers)])
+
+        for user_id in user_ids:
+            coupons, picks = [], []
+            for _ in range(rng.randint(0, coupons_per_user * 2)):
+                order_time = now - timedelta(minutes=rng.randint(1, 90 * 24 * 60))
+                items = rng.sample(menu, rng.randint(1, 4))
+                order_items = {str(item["id"]): rng.randint(1, 3) for item in items}
+                coupons.append({"user_id": user_id, "order_time": order_time,
+                                "order_items": order_items, "active": True})
+                picks.append(items)
+            if not coupons:
+                continue
+            coupon_ids = db_session.scalars(
+                insert(Coupons).returning(Coupons.id, sort_by_parameter_order=True), coupons).all()
+            db_session.execute(insert(OrderLine), [{
+                "coupon_id": coupon_id, "user_id": user_id, "order_time": coupon["order_time"],
+                "menu_id": item["id"], "menu_name": item["name"],
+                "quantity": coupon["order_items"][str(item["id"])], "unit_price": item["price"], "discount": 0,
+            } for coupon_id, coupon, items in zip(coupon_ids, coupons, picks) for item in items])
+        db_session.commit()
+
+    return [item["name"] for item in menu if item["active"]]
+
+
+# ===== СЦЕНАРІЇ КОРИСТУВАЧІВ =====
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.enabled = True
+
+    def add(self, label, seconds, ok):
+        if self.enabled:
+            with self._lock:
+                self.samples.append((label, seconds, ok))
+
+
+class VirtualUser:
+    '''One browser: its own test client, session cookie and IP address.'''
+
+    def __init__(self, app, recorder, username, index, rng, menu_names):
+        self.client = app.test_client()
+        self.client.environ_base["REMOTE_ADDR"] = f"10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}"
+        self.recorder = recorder
+        self.username = username
+        self.rng = rng
+        self.menu_names = menu_names
+
+    def request(self, label, method, url, expect=(200,), **kwargs):
+        start = time.perf_counter()
+        response = self.client.open(url, method=method, **kwargs)
+        self.recorder.add(label, time.perf_counter() - start, response.status_code in expect)
+        return response
+
+    def csrf_token(self):
+        with self.client.session_transaction() as session:
+            return session["csrf_token"]
+
+    def login(self):
+        self.request("GET /login", "GET", "/login")
+        self.request("POST /login", "POST", "/login", expect=(302,), data={
+            "csrf_token": self.csrf_token(), "username": self.username, "password": PASSWORD})
+
+    def browse(self):
+        self.request("GET /", "GET", "/")
+        self.request("GET /menu", "GET", "/menu")
+        for name in self.rng.sample(self.menu_names, 2):
+            self.request("GET /position/<name>", "GET", f"/position/{name}")
+
+    def shop(self):
+        for name in self.rng.sample(self.menu_names, self.rng.randint(1, 3)):
+            self.request("POST /position/<name>", "POST", f"/position/{name}", expect=(302,), data={
+                "csrf_token": self.csrf_token(), "name": name, "quantity": self.rng.randint(1, 3)})
+        self.request("GET /basket", "GET", "/basket")
+        page = self.request("GET /checkout", "GET", "/checkout")
+        match = re.search(r'name="idempotency_key" value="([^"]+)"', page.get_data(as_text=True))
+        if match:
+            self.request("POST /checkout", "POST", "/checkout", expect=(302,), data={
+                "csrf_token": self.csrf_token(), "idempotency_key": match.group(1)})
+
+    def history(self):
+        self.request("GET /my_coupons", "GET", "/my_coupons")
+        coupons = self.request("GET /my_coupons.json", "GET", "/my_coupons.json").get_json() or {}
+        if coupons.get("coupons"):
+            coupon = self.rng.choice(coupons["coupons"])
+            self.request("GET /coupon/<id>", "GET", coupon["url"])
+        if coupons.get("next_cursor"):
+            self.request("GET /my_coupons?cursor", "GET", f"/my_coupons?cursor={coupons['next_cursor']}")
+
+    def admin(self):
+        self.request("GET /admin", "GET", "/admin")
+        self.request("GET /admin?q", "GET", "/admin?q=user00")
+
+    def journey(self):
+        self.browse()
+        if self.rng.random() < 0.6:
+            self.shop()
+        if self.rng.random() < 0.5:
+            self.history()
+        if self.username == "admin":
+            self.admin()
+
+
+def run_load(app, recorder, usernames, menu_names, concurrency, iterations, warmup, seed_value):
+    '''Runs concurrency threads, each a virtual user doing warmup + iterations journeys.'''
+    errors = []
+    barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        user = VirtualUser(app, recorder, usernames[index % len(usernames)], index, rng, menu_names)
+        try:
+            user.login()
+            for _ in range(warmup):
+                user.journey()
+            barrier.wait()
+            for _ in range(iterations):
+                user.journey()
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as error:
+            errors.append(repr(error))
+            barrier.abort()
+
+    recorder.enabled = False
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    # Після прогріву всі потоки стартують одночасно, рахуємо лише цю частину
+    recorder.enabled = True
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, errors
+
+
+# ===== ЗВІТ =====
+def percentile(sorted_values, percent):
+    '''Nearest-rank percentile of an already sorted list.'''
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(samples, wall_seconds):
+    by_label = {}
+    for label, seconds, ok in samples:
+        by_label.setdefault(label, []).append((seconds, ok))
+
+    endpoints = {}
+    for label, values in sorted(by_label.items()):
+        durations = sorted(seconds for seconds, _ in values)
+        endpoints[label] = {
+            "requests": len(values),
+            "errors": sum(1 for _, ok in values if not ok),
+            "throughput_rps": round(len(values) / wall_seconds, 2) if wall_seconds else 0,
+            "mean_ms": round(sum(durations) / len(durations) * 1000, 3),
+            **{f"p{percent}_ms": round(percentile(durations, percent) * 1000, 3) for percent in PERCENTILES},
+        }
+
+    durations = sorted(seconds for _, seconds, _ in samples)
+    return {
+        "total": {
+            "requests": len(samples),
+            "errors": sum(1 for _, _, ok in samples if not ok),
+            "wall_seconds": round(wall_seconds, 3),
+            "throughput_rps": round(len(samples) / wall_seconds, 2) if wall_seconds else 0,
+            **{f"p{percent}_ms": round(percentile(durations, percent) * 1000, 3) for percent in PERCENTILES},
+        },
+        "endpoints": endpoints,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline, max_regression, min_requests=20):
+    '''Returns endpoints whose p95 grew by more than max_regression (0.2 = +20%).
+
+    Endpoints with fewer than min_requests samples in either run are skipped:
+    their p95 is a single request and too noisy to fail a build on.
+    '''
+    regressions = []
+    for label, stats in result["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(label)
+        if not before or not before["p95_ms"]:
+            continue
+        if min(stats["requests"], before["requests"]) < min_requests:
+            continue
+        change = stats["p95_ms"] / before["p95_ms"] - 1
+        if change > max_regression:
+            regressions.append((label, before["p95_ms"], stats["p95_ms"], change))
+    return regressions
+
+
+def print_report(result):
+    print(f"{'endpoint':<26}{'req':>7}{'err':>5}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for label, stats in result["endpoints"].items():
+        print(f"{label:<26}{stats['requests']:>7}{stats['errors']:>5}{stats['throughput_rps']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    total = result["total"]
+    print(f"{'total':<26}{total['requests']:>7}{total['errors']:>5}{total['throughput_rps']:>9}"
+          f"{total['p50_ms']:>10}{total['p95_ms']:>10}{total['p99_ms']:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Seed a local database and load-test the app")
+    parser.add_argument("--database-url", help="empty database to use (default: temporary SQLite file)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--menu-items", type=int, default=40)
+    parser.add_argument("--offers", type=int, default=8)
+    parser.add_argument("--coupons-per-user", type=int, default=10, help="average order history size")
+    parser.add_argument("--concurrency", type=int, default=4, help="simultaneous virtual users")
+    parser.add_argument("--iterations", type=int, default=20, help="journeys per virtual user")
+    parser.add_argument("--warmup", type=int, default=2, help="unrecorded journeys per virtual user")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="benchmark.json", help="where to save results as JSON")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2,
+                        help="allowed p95 growth per endpoint vs the baseline")
+    parser.add_argument("--min-requests", type=int, default=20,
+                        help="endpoints with fewer samples are not compared")
+    args = parser.parse_args()
+
+    temp_dir = None
+    database_url = args.database_url
+    if not database_url:
+        temp_dir = tempfile.mkdtemp(prefix="coffee-bench-")
+        database_url = f"sqlite:///{os.path.join(temp_dir, 'bench.sqlite')}"
+    configure(database_url)
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    menu_names = seed(args.users, args.menu_items, args.offers, args.coupons_per_user, rng)
+    print(f"Seeded {args.users} users, {args.menu_items} menu items in {time.perf_counter() - started:.1f}s")
+
+    from main import app
+
+    usernames = ["admin"] + [f"user{index:05d}" for index in range(1, args.users)]
+    recorder = Recorder()
+    wall, errors = run_load(app, recorder, usernames, menu_names,
+                            args.concurrency, args.iterations, args.warmup, args.seed)
+
+    result = summarize(recorder.samples, wall)
+    result["config"] = {key: value for key, value in vars(args).items()
+                        if key not in ("out", "baseline", "database_url")}
+    result["config"]["database"] = database_url.split(":", 1)[0]
+    result["environment"] = {
+        "commit": _git_commit(), "python": platform.python_version(),
+        "platform": platform.platform(), "time": datetime.now().isoformat(timespec="seconds"),
+    }
+    result["worker_errors"] = errors
+
+    print_report(result)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {args.out}")
+
+    failed = bool(errors) or result["total"]["errors"] > 0
+    for error in errors:
+        print(f"Worker failed: {error}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        for label, before, after, change in compare(result, baseline, args.max_regression, args.min_requests):
+            print(f"REGRESSION {label}: p95 {before} ms -> {after} ms (+{change:.0%})")
+            failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,332 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from flask import url_for
+from sqlalchemy import func, select
+
+
+CHUNK_SIZE = 64 * 1024
+# Блоби, молодші за це значення, sweep не чіпає: їх може саме зараз
+# завантажувати адмін, і запис у Menu ще не закомічений
+SWEEP_GRACE = timedelta(minutes=int(os.getenv("BLOB_SWEEP_GRACE_MINUTES", "60")))
+
+
+class BlobBackend(ABC):
+    '''Interface of a flat key -> bytes store for menu images.
+
+    Keys look like "<sha256>.png" for originals and "derived/<name>" for
+    resized copies; they never change once written.
+    '''
+
+    @abstractmethod
+    def put_file(self, key, path):
+        ...
+
+    @abstractmethod
+    def put_bytes(self, key, data):
+        ...
+
+    @abstractmethod
+    def get_bytes(self, key):
+        '''Returns the stored bytes or None if the key does not exist.'''
+
+    @abstractmethod
+    def exists(self, key):
+        ...
+
+    @abstractmethod
+    def delete(self, key):
+        ...
+
+    @abstractmethod
+    def list_keys(self, prefix=""):
+        '''Yields (key, last_modified) pairs; last_modified is an aware datetime.'''
+
+    @abstractmethod
+    def url(self, key):
+        ...
+
+    def temp_dir(self):
+        '''Directory for spooling uploads before they get their content key.'''
+        return None
+
+
+class LocalBlobBackend(BlobBackend):
+    '''Stores blobs as files under a directory inside Flask's static folder.'''
+
+    def __init__(self, root, static_folder="static"):
+        self.root = root
+        self.url_prefix = os.path.relpath(root, static_folder).replace(os.sep, "/")
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, key, path):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # os.replace атомарний, тож читачі ніколи не побачать недописаний файл
+        shutil.copyfile(path, target + ".part")
+        os.replace(target + ".part", target)
+
+    def put_bytes(self, key, data):
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + ".part", "wb") as f:
+            f.write(data)
+        os.replace(target + ".part", target)
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def delete(self, key):
+        path = self._path(key)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        # Каталоги маркерів посилань (derived/refs/<похідна>/) не лишаємо порожніми
+        if key.count("/") > 1:
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+    def list_keys(self, prefix=""):
+        # Обходимо лише каталог префікса, а не все сховище
+        start = os.path.join(self.root, *prefix.split("/")[:-1])
+        for directory, _, files in os.walk(start):
+            for file_name in files:
+                path = os.path.join(directory, file_name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and not key.endswith(".part"):
+                    modified = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+                    yield key, modified
+
+    def url(self, key):
+        return url_for("static", filename=f"{self.url_prefix}/{key}")
+
+    def temp_dir(self):
+        # Той самий диск, що й сховище, щоб не копіювати між розділами
+        return self.root
+
+
+# Коди помилки head_object, коли ключа немає (S3 віддає 404 без тіла, MinIO - NoSuchKey)
+MISSING_KEY_CODES = {"404", "NoSuchKey", "NotFound"}
+
+
+class ObjectStoreBackend(BlobBackend):
+    '''S3-compatible backend; works with any boto3-style client.
+
+    For local development point BLOB_ENDPOINT_URL at MinIO (or any other
+    S3 stand-in) and BLOB_PUBLIC_URL at the address browsers can reach.
+    '''
+
+    def __init__(self, client, bucket, public_url):
+        self.client = client
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/")
+
+    def put_file(self, key, path):
+        with open(path, "rb") as f:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=f,
+                                   CacheControl="public, max-age=31536000, immutable")
+
+    def put_bytes(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data,
+                               CacheControl="public, max-age=31536000, immutable")
+
+    def get_bytes(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError as error:
+            # Лише "немає такого ключа" - відсутність; помилки доступу чи
+            # throttling не мають призводити до повторного завантаження
+            if error.response.get("Error", {}).get("Code") in MISSING_KEY_CODES:
+                return False
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list_keys(self, prefix=""):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                yield item["Key"], item["LastModified"]
+
+    def url(self, key):
+        return f"{self.public_url}/{key}"
+
+
+def backend_from_env():
+    if os.getenv("BLOB_BACKEND", "local") == "s3":
+        # boto3 - необов'язкова залежність: pip install -r requirements-s3.txt
+        import boto3
+
+        client = boto3.client("s3", endpoint_url=os.getenv("BLOB_ENDPOINT_URL"))
+        return ObjectStoreBackend(client, os.getenv("BLOB_BUCKET"), os.getenv("BLOB_PUBLIC_URL"))
+    return LocalBlobBackend(os.getenv("BLOB_ROOT", "static/menu"))
+
+
+backend = backend_from_env()
+
+
+def key_for(digest, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return f"{digest}{extension}"
+
+
+def spool_upload(file):
+    '''Streams an upload to a temp file in chunks while hashing it.
+
+    Returns (key, temp_path); the caller stores it with commit_upload()
+    and removes temp_path afterwards.
+    '''
+    digest = hashlib.sha256()
+    temp_dir = backend.temp_dir()
+    with tempfile.NamedTemporaryFile(dir=temp_dir, suffix=".part", delete=False) as temp:
+        while chunk := file.stream.read(CHUNK_SIZE):
+            digest.update(chunk)
+            temp.write(chunk)
+    return key_for(digest.hexdigest(), file.filename), temp.name
+
+
+def commit_upload(key, temp_path):
+    '''Stores a spooled upload unless identical content is already stored.'''
+    if backend.exists(key):
+        return False
+    backend.put_file(key, temp_path)
+    return True
+
+
+# Збереження і видалення одного ключа не мають перетинатися: інакше завантаження
+# бачить exists() == True і пропускає put, паралельний release видаляє блоб,
+# а новий рядок Menu посилається на відсутній файл
+_key_locks = [threading.Lock() for _ in range(64)]
+
+
+@contextmanager
+def locked(key, db_session):
+    '''Serialises storing and releasing one key; commit db_session inside the block.
+
+    Within a process this is a striped thread lock; across workers on
+    Postgres also a transaction-level advisory lock, which the commit releases.
+    '''
+    with _key_locks[hash(key) % len(_key_locks)]:
+        if db_session.get_bind().dialect.name == "postgresql":
+            db_session.execute(select(func.pg_advisory_xact_lock(func.hashtext("blob"), func.hashtext(key))))
+        yield
+
+
+def unreferenced(file_names, db_session):
+    '''Returns those of file_names that no Menu row points at any more.'''
+    from main_db import Menu
+
+    file_names = set(file_names)
+    if not file_names:
+        return set()
+    still_used = {row.file_name for row in db_session.query(Menu.file_name)
+                  .filter(Menu.file_name.in_(file_names)).distinct()}
+    return file_names - still_used
+
+
+def release(file_names, db_session):
+    '''Deletes blobs (and their derivatives) whose reference count dropped to 0.'''
+    import menu_images
+
+    for file_name in unreferenced(file_names, db_session):
+        with locked(file_name, db_session):
+            # Поки чекали на блокування, ту саму картинку могли завантажити знову
+            if unreferenced([file_name], db_session):
+                menu_images.delete_derivatives(file_name)
+                backend.delete(file_name)
+            db_session.commit()
+
+
+# ===== ОБСЛУГОВУВАННЯ СХОВИЩА =====
+def migrate(db_session):
+    '''Renames legacy uuid-prefixed uploads to content keys and updates Menu.'''
+    from main_db import Menu
+    import menu_images
+
+    renamed = 0
+    for menu in db_session.query(Menu).all():
+        data = backend.get_bytes(menu.file_name)
+        if data is None:
+            continue
+        key = key_for(hashlib.sha256(data).hexdigest(), menu.file_name)
+        if key == menu.file_name:
+            # Похідні зі старіших версій ще не мають маркерів посилань
+            menu_images.write_refs(key)
+            continue
+        if not backend.exists(key):
+            backend.put_bytes(key, data)
+        menu_images.build_derivatives(BytesIO(data), key)
+        menu.file_name = key
+        renamed += 1
+    db_session.commit()
+    return renamed
+
+
+def sweep(db_session, dry_run=False):
+    '''Deletes blobs that neither Menu rows nor their manifests reference.'''
+    from main_db import Menu
+    import menu_images
+
+    keep = set()
+    for (file_name,) in db_session.query(Menu.file_name).distinct():
+        keep.add(file_name)
+        keep.add(menu_images.manifest_key(file_name))
+        keep.update(menu_images.derived_keys(file_name))
+        keep.update(menu_images.ref_keys(file_name))
+
+    cutoff = datetime.now(timezone.utc) - SWEEP_GRACE
+    orphans = [key for key, modified in backend.list_keys()
+               if key not in keep and modified < cutoff]
+    if not dry_run:
+        for key in orphans:
+            backend.delete(key)
+    return orphans
+
+
+if __name__ == "__main__":
+    from main_db import Session
+
+    parser = argparse.ArgumentParser(description="Menu image blob store maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate", help="move legacy uploads to content-addressed keys, add derivative references")
+    sweep_parser = subparsers.add_parser("sweep", help="delete blobs nothing references")
+    sweep_parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    with Session() as db_session:
+        if args.command == "migrate":
+            print(f"Migrated {migrate(db_session)} menu image(s)")
+        else:
+            orphans = sweep(db_session, dry_run=args.dry_run)
+            for key in orphans:
+                print(key)
+            print(f"{'Would delete' if args.dry_run else 'Deleted'} {len(orphans)} orphan blob(s)")
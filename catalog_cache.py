@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+
+from main_db import Menu, SpecialOffer, Session
+import query_budget
+
+
+# Скільки секунд знімок каталогу вважається свіжим. Адмінські зміни в цьому
+# процесі скидають кеш одразу, а інші воркери підхоплять їх не пізніше ніж за TTL.
+CATALOG_TTL = float(os.getenv("CATALOG_TTL", "60"))
+
+
+class CachedMenuItem:
+    '''Read-only copy of a Menu row that outlives the DB session.'''
+    __slots__ = ("id", "name", "weight", "ingredients", "description",
+                 "price", "active", "file_name", "special_offers")
+
+    def __init__(self, menu):
+        self.id = menu.id
+        self.name = menu.name
+        self.weight = menu.weight
+        self.ingredients = menu.ingredients
+        self.description = menu.description
+        self.price = menu.price
+        self.active = menu.active
+        self.file_name = menu.file_name
+        self.special_offers = []
+
+
+class CachedOffer:
+    '''Read-only copy of an active SpecialOffer with its menu item attached.'''
+    __slots__ = ("id", "menu_id", "discount", "expiration_date", "active", "menu")
+
+    def __init__(self, offer, menu):
+        self.id = offer.id
+        self.menu_id = offer.menu_id
+        self.discount = offer.discount
+        self.expiration_date = offer.expiration_date
+        self.active = offer.active
+        self.menu = menu
+
+
+class Catalog:
+    '''Immutable snapshot of the menu and active offers.
+
+    A patched snapshot remembers which version it was derived from and
+    which menu ids changed, so dependants (pricing) can update incrementally.
+    '''
+
+    def __init__(self, version, items, offers, parent_version=None, changed_ids=None,
+                 built_at=None):
+        self.version = version
+        self.parent_version = parent_version
+        self.changed_ids = changed_ids
+        self.built_at = time.monotonic() if built_at is None else built_at
+        self.items = items
+        self.by_id = {item.id: item for item in items}
+        self.by_name = {item.name: item for item in items}
+        self.active_positions = [item for item in items if item.active]
+        self.offers = offers
+
+    def get_active(self, name):
+        item = self.by_name.get(name)
+        if item and item.active:
+            return item
+        return None
+
+
+_lock = threading.Lock()
+_catalog = None
+_version = 0
+
+
+def _load_items(db_session, menu_ids=None):
+    menu_query = db_session.query(Menu)
+    offer_query = db_session.query(SpecialOffer).filter_by(active=True)
+    if menu_ids is not None:
+        menu_query = menu_query.filter(Menu.id.in_(menu_ids))
+        offer_query = offer_query.filter(SpecialOffer.menu_id.in_(menu_ids))
+
+    items = [CachedMenuItem(menu) for menu in menu_query.order_by(Menu.id)]
+    by_id = {item.id: item for item in items}
+
+    offers = []
+    for offer in offer_query.order_by(SpecialOffer.id):
+        menu = by_id.get(offer.menu_id)
+        if not menu:
+            continue
+        cached_offer = CachedOffer(offer, menu)
+        menu.special_offers.append(cached_offer)
+        offers.append(cached_offer)
+
+    return items, offers
+
+
+def _load(version):
+    # Перебудова каталогу - раз на CATALOG_TTL, а не ціна конкретного запиту
+    with query_budget.exempt(), Session() as db_session:
+        items, offers = _load_items(db_session)
+    return Catalog(version, items, offers)
+
+
+def get_catalog():
+    '''Returns the current catalog snapshot, rebuilding it when stale.'''
+    global _catalog, _version
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - catalog.built_at < CATALOG_TTL:
+        return catalog
+
+    with _lock:
+        # Інший потік міг уже перебудувати каталог, поки ми чекали на lock
+        catalog = _catalog
+        if catalog is not None and time.monotonic() - catalog.built_at < CATALOG_TTL:
+            return catalog
+
+        _version += 1
+        _catalog = _load(_version)
+        return _catalog
+
+
+def refresh(menu_ids):
+    '''Reloads only the given menu items (and their offers) into the snapshot.'''
+    global _catalog, _version
+    menu_ids = {int(menu_id) for menu_id in menu_ids}
+    with _lock:
+        catalog = _catalog
+        if catalog is None or not menu_ids:
+            return
+
+        with query_budget.exempt(), Session() as db_session:
+            fresh_items, fresh_offers = _load_items(db_session, menu_ids)
+
+        # Позиції, яких більше немає в БД, просто випадають зі знімку
+        items = [item for item in catalog.items if item.id not in menu_ids]
+        items = sorted(items + fresh_items, key=lambda item: item.id)
+        offers = [offer for offer in catalog.offers if offer.menu_id not in menu_ids]
+        offers = sorted(offers + fresh_offers, key=lambda offer: offer.id)
+
+        _version += 1
+        _catalog = Catalog(_version, items, offers,
+                           parent_version=catalog.version,
+                           changed_ids=frozenset(menu_ids),
+                           built_at=catalog.built_at)
+
+
+def invalidate():
+    '''Drops the snapshot; the next reader rebuilds it from the DB.'''
+    global _catalog
+    with _lock:
+        _catalog = None
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hashlib
+import os
+import threading
+
+from flask import make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+
+
+# Локаль входить у ключ кешу, щоб після додавання перекладів сторінки різних мов не змішувались
+LOCALE = os.getenv("APP_LOCALE", "uk")
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", "512"))
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "32"))
+
+
+class LRUCache:
+    '''Thread-safe dict that evicts the least recently used entry.'''
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+fragments = LRUCache(FRAGMENT_CACHE_SIZE)
+pages = LRUCache(PAGE_CACHE_SIZE)
+
+
+# ===== ФРАГМЕНТИ =====
+def fragment(name, version, key, macro, *args):
+    '''Renders macro(*args) once per (name, key, catalog version, locale).
+
+    version must be the catalog version the arguments were taken from
+    (e.g. prices.version), so a rebuilt catalog never reuses old markup.
+    '''
+    cache_key = (name, key, version, LOCALE)
+    html = fragments.get(cache_key)
+    if html is None:
+        html = Markup(macro(*args))
+        fragments.put(cache_key, html)
+    return html
+
+
+# ===== ЦІЛІ СТОРІНКИ ДЛЯ АНОНІМІВ =====
+class CachedPage:
+    __slots__ = ("version", "body", "etag", "last_modified")
+
+    def __init__(self, version, body, previous=None):
+        self.version = version
+        self.body = body
+        # ETag з вмісту однаковий у всіх воркерах
+        self.etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+        # Каталог перебудовується і без змін (по TTL), тож Last-Modified
+        # зсуваємо лише тоді, коли сторінка справді змінилась
+        if previous is not None and previous.etag == self.etag:
+            self.last_modified = previous.last_modified
+        else:
+            self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def _cacheable():
+    # Залогінений юзер бачить свою навігацію, а flash-повідомлення одноразові
+    return (request.method == "GET" and not current_user.is_authenticated
+            and not session.get("_flashes"))
+
+
+def cached_page(version, render):
+    '''Serves render() to anonymous visitors from cache, answering 304 when unchanged.'''
+    if not _cacheable():
+        return render()
+
+    cache_key = (request.endpoint, request.path, LOCALE)
+    page = pages.get(cache_key)
+    if page is None or page.version != version:
+        page = CachedPage(version, render(), page)
+        pages.put(cache_key, page)
+
+    response = make_response(page.body)
+    response.set_etag(page.etag)
+    response.last_modified = page.last_modified
+    # Та сама адреса для залогіненого юзера інша, тож лише приватний кеш з перевіркою
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
+
+
+def clear():
+    fragments.clear()
+    pages.clear()
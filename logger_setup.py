@@ -1,24 +1,239 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+import atexit
+import json
 import logging
+import os
+import queue
+import threading
+import time
+
+from flask import g, has_request_context
+
+
+# У режимі черги запит лише кладе запис у чергу, а запис у файл і консоль
+# робить окремий потік. LOG_QUEUE=0 повертає синхронні хендлери
+LOG_QUEUE = os.getenv("LOG_QUEUE", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# drop - при переповненій черзі запис відкидається (і підраховується), block - запит чекає
+LOG_OVERFLOW = os.getenv("LOG_OVERFLOW", "drop")
+# size | time | none
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+# text | json
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+
+class RequestContextFilter(logging.Filter):
+    '''Adds request_id and latency_ms (time since the request started) to records.'''
+
+    def filter(self, record):
+        record.request_id = None
+        record.latency_ms = None
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            started = g.get("request_started")
+            if started is not None:
+                record.latency_ms = round((time.perf_counter() - started) * 1000, 2)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''One JSON object per line: time, level, logger, message, request id, latency.'''
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            data["request_id"] = record.request_id
+        if getattr(record, "latency_ms", None) is not None:
+            data["latency_ms"] = record.latency_ms
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
 
-def setup_logger(name, log_file, level_file=logging.INFO, level_console=logging.WARNING):
-    '''Function to set up a logger with both file and console handlers.'''
-    logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
 
-    formatter = logging.Formatter(
+def _formatter(json_format):
+    if json_format:
+        return JsonFormatter()
+    return logging.Formatter(
         "%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
         "%Y-%m-%d %H:%M:%S"
     )
 
-    file_handler = logging.FileHandler(log_file, encoding="utf-8")
-    file_handler.setLevel(level_file)
-    file_handler.setFormatter(formatter)
 
+# ===== ФАЙЛИ =====
+# Кілька логерів пишуть в один файл (app.log), тож хендлер на файл один -
+# інакше ротація двох хендлерів одного файлу перетирала б записи.
+# Формат файлу задає перший логер, що його відкрив
+_file_handlers = {}
+_file_handlers_lock = threading.Lock()
+
+
+def _file_handler(log_file, rotation, formatter):
+    path = os.path.abspath(log_file)
+    with _file_handlers_lock:
+        handler = _file_handlers.get(path)
+        if handler is None:
+            if rotation == "size":
+                handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES,
+                                              backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+            elif rotation == "time":
+                handler = TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN,
+                                                   backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+            else:
+                handler = logging.FileHandler(path, encoding="utf-8")
+            handler.setFormatter(formatter)
+            _file_handlers[path] = handler
+        return handler
+
+
+class _Route(logging.Handler):
+    '''Per-logger level in front of a handler shared by several loggers.'''
+
+    def __init__(self, target, level):
+        super().__init__(level)
+        self.target = target
+
+    def emit(self, record):
+        self.target.handle(record)
+
+
+# ===== ЧЕРГА =====
+class _BoundedQueueHandler(QueueHandler):
+    '''QueueHandler that never blocks the caller unless LOG_OVERFLOW=block.'''
+
+    def __init__(self, log_queue, route):
+        super().__init__(log_queue)
+        self.route = route
+
+    def prepare(self, record):
+        # Черга в тому ж процесі, тож запис не треба серіалізувати: повідомлення
+        # з аргументами форматує вже потік-слухач, а не потік запиту
+        record.route = self.route
+        return record
+
+    def enqueue(self, record):
+        if LOG_OVERFLOW == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _listener.dropped += 1
+
+
+class _Router(logging.Handler):
+    '''Listener-side handler that passes records to their logger's sinks.'''
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+        self.dropped = 0
+
+    def handle(self, record):
+        handlers = self.routes.get(getattr(record, "route", record.name), ())
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                        "Log queue was full, %s record(s) dropped", (dropped,), None)
+            for handler in handlers:
+                handler.handle(warning)
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+class _Listener:
+    '''The single background thread writing all queued records.'''
+
+    def __init__(self):
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        self.router = _Router()
+        self.handlers = []
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def dropped(self):
+        return self.router.dropped
+
+    @dropped.setter
+    def dropped(self, value):
+        self.router.dropped = value
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = QueueListener(self.queue, self.router)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def after_fork(self):
+        # Потік-слухач не переживає fork (gunicorn --preload), а черга і її
+        # локи могли бути скопійовані в зайнятому стані - починаємо з чистих
+        self.queue = queue.Queue(LOG_QUEUE_SIZE)
+        for handler in self.handlers:
+            handler.queue = self.queue
+        self._lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+        if self.handlers:
+            self.ensure_started()
+
+    def stop(self):
+        '''Writes out everything still queued; called at interpreter exit.'''
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+_listener = _Listener()
+atexit.register(_listener.stop)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_listener.after_fork)
+
+
+def setup_logger(name, log_file, level_file=logging.INFO, level_console=logging.WARNING,
+                 use_queue=None, rotation=None, json_format=None):
+    '''Function to set up a logger with both file and console handlers.
+
+    By default records go through a bounded queue to one background
+    thread; see the LOG_* settings at the top of this module.
+    '''
+    use_queue = LOG_QUEUE if use_queue is None else use_queue
+    rotation = LOG_ROTATION if rotation is None else rotation
+    json_format = LOG_FORMAT == "json" if json_format is None else json_format
+
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    if logger.handlers:
+        return logger
+
+    formatter = _formatter(json_format)
+    file_handler = _Route(_file_handler(log_file, rotation, formatter), level_file)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(level_console)
     console_handler.setFormatter(formatter)
+    logger.addFilter(RequestContextFilter())
 
-    if not logger.hasHandlers():
+    if use_queue:
+        _listener.router.routes[name] = [file_handler, console_handler]
+        handler = _BoundedQueueHandler(_listener.queue, name)
+        _listener.handlers.append(handler)
+        _listener.ensure_started()
+        logger.addHandler(handler)
+    else:
         logger.addHandler(file_handler)
         logger.addHandler(console_handler)
 
@@ -1,22 +1,43 @@
 from datetime import datetime, timedelta
+import math
 import os
 import secrets
-import uuid
+import time
 import logging
 
-import qrcode
 from dotenv import load_dotenv
-from flask import Flask, flash, redirect, render_template, request, session, url_for
+from flask import Flask, Response, flash, g, jsonify, redirect, render_template, request, session, url_for
 from flask_login import current_user, login_required, login_user, logout_user, LoginManager
+from PIL import UnidentifiedImageError
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from main_db import Menu, Basket, Coupons, SpecialOffer, Session, Users, func, joinedload
+from main_db import Menu, Coupons, OrderLine, SpecialOffer, Users
+from main_db import engine, get_db, close_db, pool_stats
 from logger_setup import setup_logger
+import admin_stats
+import baskets
+from baskets import BasketLimitError
+import blob_store
+import catalog_cache
+import fragment_cache
+import menu_images
+import metrics
+import offer_scheduler
+import passwords
+import pricing
+import qr_codes
+import query_budget
+import rate_limit
+import sales_analytics
+import static_assets
+import user_cache
 
 # ===== КОНФІГУРАЦІЯ ДОДАТКУ =====
 load_dotenv()
 
 app = Flask(__name__)
-FILES_PATH = "static/menu"
 
 
 app_logger = setup_logger(
@@ -30,6 +51,23 @@ app.config["MAX_FORM_MEMORY_SIZE"] = 1024 * 1024
 app.config["MAX_FORM_PARTS"] = 500
 app.config["SESSION_COOKIE_SAMESITE"] = "Strict"
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+# Скільки довірених проксі (nginx, балансувальник) стоїть перед застосунком. Без
+# цього всі клієнти мають IP проксі, і ліміти входу на IP стають одним спільним відром
+app.config["PROXY_HOPS"] = int(os.getenv("PROXY_HOPS", "0"))
+if app.config["PROXY_HOPS"]:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"],
+                            x_proto=app.config["PROXY_HOPS"])
+
+
+app.add_template_global(menu_images.menu_image)
+app.add_template_global(fragment_cache.fragment)
+metrics.init_app(app, engine)
+query_budget.init_app(app, engine)
+static_assets.init_app(app)
+
+
+# Одна сесія БД на запит, закривається після відповіді (або відкатується при помилці)
+app.teardown_appcontext(close_db)
 
 
 login_manager = LoginManager()
@@ -40,16 +78,17 @@ login_manager.login_view = "login"
 # Штуки які треба зробити перед тим, як юзер побачить сторінку
 @app.before_request
 def do_before_request():
+    # Id запиту і час старту потрапляють у кожен запис логу (див. logger_setup)
+    g.request_id = request.headers.get("X-Request-ID", "")[:64] or secrets.token_hex(8)
+    g.request_started = time.perf_counter()
+    offer_scheduler.ensure_started()
     if "csrf_token" not in session:
         session["csrf_token"] = secrets.token_hex(16)
 
-# Лоадить юзера..
+# Лоадить юзера з підписаної cookie сесії, в БД ходимо лише коли кеш застарів
 @login_manager.user_loader
 def load_user(user_id):
-    with Session() as db_session:
-        user = db_session.query(Users).filter_by(id=user_id).first()
-        if user:
-            return user
+    return user_cache.load(session, user_id, get_db())
 
 # Захист від XSS атак
 @app.after_request
@@ -65,37 +104,48 @@ def apply_csp(response):
         f"form-action 'self'"
     )
     response.headers["Content-Security-Policy"] = csp
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
     response.set_cookie("nonce", nonce)
     return response
 
 # Обробник загальних помилок (пізніше зроблю під кожну помилку окремо)
 @app.errorhandler(Exception)
 def handle_error(error):
-    app_logger.error(f"Unhandled error: {str(error)}", exc_info=True)
+    app_logger.error("Unhandled error: %s", error, exc_info=True)
     return "Internal server error", 500
 
 
+# Пул хешування паролів переповнений або не встиг за PASSWORD_TIMEOUT - краще
+# швидко відмовити, ніж тримати воркер
+@app.errorhandler(passwords.HashingBusy)
+def handle_hashing_busy(error):
+    app_logger.warning("Password hashing pool is busy, request rejected")
+    return "Сервер зараз перевантажений, спробуйте за хвилину.", 503, {"Retry-After": "5"}
+
+
 # ===== ГОЛОВНА СТОРІНКА =====
+# query_budget.limit(n) - скільки SQL-запитів може зробити маршрут (з урахуванням
+# підвантаження юзера після user_cache.USER_CACHE_TTL); у тестах перевищення - помилка
 @app.route("/")
 @app.route("/home")
+@query_budget.limit(3)
 def home():
-    db_session = Session()
-    popular_items = db_session.query(
-        Menu).filter_by(active=True).limit(3).all()
-    db_session.close()
+    catalog = catalog_cache.get_catalog()
+    prices = pricing.get_price_table()
+    popular_items = catalog.active_positions[:3]
 
     if current_user.is_authenticated:
-        with Session() as db_session:
-            user_coupons_count = db_session.query(
-                Coupons).filter_by(user_id=current_user.id).count()
-            offers = db_session.query(SpecialOffer).options(
-                joinedload(SpecialOffer.menu)).filter_by(active=True).all()
+        db_session = get_db()
+        user_coupons_count = db_session.query(
+            Coupons).filter_by(user_id=current_user.id).count()
+        offers = prices.best_offers
 
-            days_member = (datetime.now(
-            ) - current_user.created_at).days if hasattr(current_user, 'created_at') else 1
+        days_member = (datetime.now(
+        ) - current_user.created_at).days if current_user.created_at else 1
 
-            recent_orders = db_session.query(Coupons).filter_by(user_id=current_user.id)\
-                .order_by(Coupons.order_time.desc()).limit(3).all()
+        recent_orders = db_session.query(Coupons).filter_by(user_id=current_user.id)\
+            .order_by(Coupons.order_time.desc()).limit(3).all()
 
         return render_template("home/home.html",
                                user=current_user,
@@ -105,10 +155,12 @@ def home():
                                offers=offers,
                                current_year=datetime.now().year)
 
-    return render_template("home/welcome.html",
-                           user=current_user,
-                           popular_items=popular_items,
-                           current_year=datetime.now().year)
+    return fragment_cache.cached_page(prices.version, lambda: render_template(
+        "home/welcome.html",
+        user=current_user,
+        popular_items=popular_items,
+        prices=prices,
+        current_year=datetime.now().year))
 
 
 # ===== АВТЕНТИФІКАЦІЯ =====
@@ -127,6 +179,13 @@ def register_post():
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
+    wait = rate_limit.check_register(request.remote_addr)
+    if wait:
+        flash(f"Забагато спроб реєстрації. Спробуйте через {math.ceil(wait)} с.", "danger")
+        return render_template("join/register.html",
+                               csrf_token=session["csrf_token"],
+                               current_year=datetime.now().year), 429, {"Retry-After": str(math.ceil(wait))}
+
     username = request.form["username"]
     email = request.form["email"]
     password = request.form["password"]
@@ -141,25 +200,25 @@ def register_post():
     if email == os.getenv("ADMIN_EMAIL") and username in os.getenv("ADMINS"):
         is_admin = True
 
-    with Session() as db_session:
-        if (db_session.query(Users).filter_by(email=email).first() or
-                db_session.query(Users).filter_by(username=username).first()):
-            flash("Користувач з таким email або юзернеймом вже існує!", "danger")
-            return render_template("join/register.html",
-                                   csrf_token=session["csrf_token"],
-                                   current_year=datetime.now().year,
-                                   )
-
-        new_user = Users(username=username, email=email, is_admin=is_admin)
-        new_user.set_password(password)
-        db_session.add(new_user)
-        db_session.commit()
-        db_session.refresh(new_user)
+    db_session = get_db()
+    if (db_session.query(Users).filter_by(email=email).first() or
+            db_session.query(Users).filter_by(username=username).first()):
+        flash("Користувач з таким email або юзернеймом вже існує!", "danger")
+        return render_template("join/register.html",
+                               csrf_token=session["csrf_token"],
+                               current_year=datetime.now().year,
+                               )
 
-        login_user(new_user)
-        current_user['created_at'] = datetime.now()
+    new_user = Users(username=username, email=email, is_admin=is_admin)
+    new_user.set_password(password)
+    db_session.add(new_user)
+    db_session.commit()
+    db_session.refresh(new_user)
 
-        return redirect(url_for("home"))
+    login_user(user_cache.remember(session, new_user))
+    baskets.reconcile(session, new_user.id, db_session)
+
+    return redirect(url_for("home"))
 
 
 @app.get("/login")
@@ -173,24 +232,39 @@ def login():
 
 
 @app.post("/login")
+@query_budget.limit(4)
 def login_post():
     if request.form.get("csrf_token") != session["csrf_token"]:
-        app_logger.warning(f"CSRF token mismatch in login attempt")
+        app_logger.warning("CSRF token mismatch in login attempt")
         return "Request blocked!", 403
 
     username = request.form["username"]
     password = request.form["password"]
 
-    with Session() as db_session:
-        user = db_session.query(Users).filter_by(username=username).first()
-        if user and user.check_password(password):
-            login_user(user)
-            app_logger.info(f"User {username} logged in successfully")
-            return redirect(url_for("home"))
+    wait = rate_limit.check_login(request.remote_addr, username)
+    if wait:
+        app_logger.warning("Login rate limit hit for username: %s", username)
+        flash(f"Забагато спроб входу. Спробуйте через {math.ceil(wait)} с.", "danger")
+        return render_template("join/login.html",
+                               current_year=datetime.now().year,
+                               csrf_token=session["csrf_token"]), 429, {"Retry-After": str(math.ceil(wait))}
+
+    db_session = get_db()
+    user = db_session.query(Users).filter_by(username=username).first()
+    # Неіснуючий юзер перевіряється проти фіктивного хешу, щоб відповідь займала стільки ж часу
+    valid = user.check_password(password) if user else passwords.verify(password, None)
+    if valid:
+        if user.password_needs_rehash():
+            user.set_password(password)
+            db_session.commit()
+        login_user(user_cache.remember(session, user))
+        baskets.reconcile(session, user.id, db_session)
+        app_logger.info("User %s logged in successfully", username)
+        return redirect(url_for("home"))
 
-        app_logger.warning(f"Failed login attempt for username: {username}")
-        flash("Неправильний юзернейм або пароль!", "danger")
-        return redirect(url_for("login"))
+    app_logger.warning("Failed login attempt for username: %s", username)
+    flash("Неправильний юзернейм або пароль!", "danger")
+    return redirect(url_for("login"))
 
 
 @app.get("/profile")
@@ -207,34 +281,41 @@ def profile_logout():
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
+    baskets.forget(session)
     logout_user()
+    user_cache.forget(session)
     return redirect(url_for("home"))
 
 
 # ===== МЕНЮ ТА ПРОДУКТИ =====
 @app.route("/menu")
+@query_budget.limit(1)
 def menu():
-    with Session() as db_session:
-        offers = db_session.query(SpecialOffer).options(
-            joinedload(SpecialOffer.menu)).filter_by(active=True).all()
-        all_positions = db_session.query(Menu).options(
-            joinedload(Menu.special_offers)).filter_by(active=True).all()
-
-    return render_template("menu/menu.html", all_positions=all_positions,
-                           offers=offers, user=current_user)
+    catalog = catalog_cache.get_catalog()
+    prices = pricing.get_price_table()
+    return fragment_cache.cached_page(prices.version, lambda: render_template(
+        "menu/menu.html", all_positions=catalog.active_positions,
+        offers=prices.best_offers, prices=prices,
+        user=current_user))
 
 
 @app.get("/position/<name>")
+@query_budget.limit(1)
 def position(name):
-    with Session() as db_session:
-        position = db_session.query(Menu).options(joinedload(
-            Menu.special_offers)).filter_by(active=True, name=name).first()
-        return render_template("menu/position.html",
-                               csrf_token=session["csrf_token"],
-                               position=position)
+    position = catalog_cache.get_catalog().get_active(name)
+    if not position:
+        return "Позицію не знайдено!", 404
+
+    return render_template("menu/position.html",
+                           csrf_token=session["csrf_token"],
+                           position=position,
+                           price=pricing.get_price_table()[position.id])
 
 
+# Юзер після USER_CACHE_TTL, advisory lock кошика (лише Postgres, див. Basket._lock_user),
+# upsert і перечитування кошика, якщо його змінили в іншій вкладці
 @app.post("/position/<name>")
+@query_budget.limit(4)
 @login_required
 def position_post(name):
     if request.form.get("csrf_token") != session["csrf_token"]:
@@ -243,51 +324,38 @@ def position_post(name):
     position_name = request.form.get("name")
     position_quantity = request.form.get("quantity")
 
-    if not position_name or not position_quantity:
+    # Форма дозволяє лише min="1"; нуль чи від'ємне число зменшили б рядок кошика
+    if not position_name or not (position_quantity and position_quantity.isdigit()
+                                 and int(position_quantity) >= 1):
         return "Invalid data! (Potentially a server side problem)", 400
 
-    with Session() as db_session:
-        menu_item = db_session.query(Menu).filter_by(
-            name=position_name).first()
-        if not menu_item:
-            return "Position is not found! (Potentially a server side problem)", 404
-
-        total_quantity = db_session.query(func.sum(Basket.quantity)).filter_by(
-            user_id=current_user.id).scalar() or 0
-
-        if total_quantity + int(position_quantity) > 10:
-            flash(
-                f"В кошику не може бути більше 10 одиниць товару! Лишня кількість: {total_quantity + int(position_quantity) - 10}", "danger")
-            return redirect(url_for("position", name=name))
+    menu_item = catalog_cache.get_catalog().get_active(position_name)
+    if not menu_item:
+        return "Position is not found! (Potentially a server side problem)", 404
 
-        if db_session.query(Basket).filter_by(user_id=current_user.id).count() > 10:
-            flash("В кошику не може бути більше 10 позицій!", "danger")
-            return redirect(url_for("position", name=name))
-
-        new_basket_item = Basket(
-            user_id=current_user.id,
-            menu_id=menu_item.id,
-            quantity=int(position_quantity)
-        )
-
-        db_session.add(new_basket_item)
-        db_session.commit()
-        db_session.refresh(new_basket_item)
-        flash(
-            f"Додано {new_basket_item.quantity} шт. {new_basket_item.menu.name} до кошика", "success")
+    db_session = get_db()
+    basket = baskets.get(session, current_user.id, db_session)
+    try:
+        basket.add(db_session, menu_item.id, int(position_quantity))
+    except BasketLimitError as error:
+        flash(str(error), "danger")
         return redirect(url_for("position", name=name))
 
+    flash(
+        f"Додано {position_quantity} шт. {menu_item.name} до кошика", "success")
+    return redirect(url_for("position", name=name))
+
 
 # ===== КОШИК ТА ЗАМОВЛЕННЯ =====
 @app.route("/basket")
+@query_budget.limit(1)
 @login_required
 def basket():
-    with Session() as db_session:
-        basket_items = db_session.query(Basket).filter_by(
-            user_id=current_user.id).options(joinedload(Basket.menu)).all()
-        return render_template("orders/basket.html",
-                               csrf_token=session["csrf_token"],
-                               basket=basket_items, user=current_user)
+    return render_template("orders/basket.html",
+                           csrf_token=session["csrf_token"],
+                           basket=baskets.get(session, current_user.id, get_db()).lines(),
+                           prices=pricing.get_price_table(),
+                           user=current_user)
 
 
 @app.post("/update_quantity")
@@ -296,25 +364,19 @@ def update_quantity():
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
-    item_id = request.form.get("item_id")
+    menu_id = request.form.get("menu_id")
     quantity = request.form.get("quantity")
 
-    with Session() as db_session:
-        basket_item = db_session.query(Basket).filter_by(
-            id=item_id, user_id=current_user.id).options(joinedload(Basket.menu)).first()
-        if not basket_item:
-            return "Елемент кошика не знайдено!", 404
-
-        other_items_quantity = db_session.query(func.sum(Basket.quantity)).filter(
-            Basket.user_id == current_user.id, Basket.id != basket_item.id).scalar() or 0
-        new_total_quantity = other_items_quantity + int(quantity)
+    if not (menu_id and menu_id.isdigit() and quantity and quantity.isdigit() and int(quantity) > 0):
+        return redirect(url_for("basket"))
 
-        if new_total_quantity > 10:
-            return redirect(url_for("basket"))
+    db_session = get_db()
+    basket = baskets.get(session, current_user.id, db_session)
+    if int(menu_id) not in basket.items:
+        return "Елемент кошика не знайдено!", 404
 
-        if quantity and quantity.isdigit() and int(quantity) > 0:
-            basket_item.quantity = int(quantity)
-            db_session.commit()
+    if not basket.set_quantity(db_session, int(menu_id), int(quantity)):
+        flash(f"В кошику не може бути більше {baskets.MAX_UNITS} одиниць товару!", "danger")
 
     return redirect(url_for("basket"))
 
@@ -325,147 +387,177 @@ def remove_from_basket():
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
-    item_id = request.form.get("item_id")
-
-    with Session() as db_session:
-        basket_item = db_session.query(Basket).filter_by(
-            id=item_id, user_id=current_user.id).options(joinedload(Basket.menu)).first()
-
-        if not basket_item:
-            return "Елемент кошика не знайдено!", 404
+    menu_id = request.form.get("menu_id")
 
-        db_session.delete(basket_item)
-        db_session.commit()
+    db_session = get_db()
+    basket = baskets.get(session, current_user.id, db_session)
+    if not (menu_id and menu_id.isdigit() and basket.remove(db_session, int(menu_id))):
+        return "Елемент кошика не знайдено!", 404
 
-        return redirect(url_for("basket"))
+    return redirect(url_for("basket"))
 
 
 @app.get("/checkout")
+@query_budget.limit(1)
 @login_required
 def checkout_page():
-    with Session() as db_session:
-        basket = db_session.query(Basket).filter_by(
-            user_id=current_user.id).all()
+    basket = baskets.get(session, current_user.id, get_db())
+    lines = basket.lines()
+    prices = pricing.get_price_table()
 
-        return render_template("orders/checkout.html",
-                               csrf_token=session["csrf_token"],
-                               basket=basket,
-                               total_quantity=sum(
-                                   item.quantity for item in basket),
-                               total_price=sum(item.menu.price for item in basket))
+    return render_template("orders/checkout.html",
+                           csrf_token=session["csrf_token"],
+                           basket=lines,
+                           prices=prices,
+                           total_quantity=sum(
+                               line.quantity for line in lines),
+                           total_price=prices.total(lines),
+                           # Новий ключ на кожен показ сторінки: подвійне натискання
+                           # "Підтвердити" відправить той самий ключ і дасть одне замовлення
+                           idempotency_key=secrets.token_urlsafe(24))
 
 
 @app.post("/checkout") 
+@query_budget.limit(4)
 @login_required
 def checkout():
-    with Session() as db_session:
-        if request.form.get("csrf_token") != session["csrf_token"]:
-            app_logger.warning(f"CSRF token mismatch in checkout for user {current_user.id}")
-            return "Request blocked!", 403
-
-        basket_items = db_session.query(Basket).filter_by(
-            user_id=current_user.id).options(joinedload(Basket.menu)).all()
-
-        if not basket_items:
-            app_logger.info(f"Empty basket checkout attempt by user {current_user.id}")
-            flash("Ваш кошик порожній", "danger")
-            return redirect(url_for("basket"))
-
-        else:
-            order_items = {}
-            total_price = 0
-
-            for item in basket_items:
-                price = item.menu.price
-                if item.menu.special_offers:
-                    active_offer = next(
-                        (offer for offer in item.menu.special_offers
-                            if offer.active and offer.expiration_date > datetime.now()),
-                        None
-                    )
-                    if active_offer:
-                        price = round(
-                            price - (price * active_offer.discount / 100), 2)
-                order_items[item.menu.id] = item.quantity
-                total_price += price * item.quantity
-
-            new_coupon = Coupons(
-                order_items=order_items,
-                order_time=datetime.now(),
-                user_id=current_user.id
-            )
-
-            db_session.add(new_coupon)
-            db_session.commit()
-            db_session.refresh(new_coupon)
-
-            qr_data = f"ORDER:{new_coupon.id}"
-            qr_img = qrcode.make(qr_data)
-            qr_filename = f"coupon_{new_coupon.id}.png"
-            qr_path = os.path.join("static/qrcodes", qr_filename)
-            qr_img.save(qr_path)
+    db_session = get_db()
+    if request.form.get("csrf_token") != session["csrf_token"]:
+        app_logger.warning("CSRF token mismatch in checkout for user %s", current_user.id)
+        return "Request blocked!", 403
 
-            new_coupon.qr_code_path = qr_path
-            db_session.commit()
+    basket = baskets.get(session, current_user.id, db_session)
+    # Замовлення складається з рядків, які прибрав DELETE ... RETURNING, а не з
+    # копії в сесії: кошик могли змінити в іншій вкладці чи на іншому пристрої
+    lines = basket.take(db_session)
 
-            db_session.query(Basket).filter_by(
-                user_id=current_user.id).delete()
-            db_session.commit()
+    if not lines:
+        db_session.rollback()
+        basket.reload(db_session)
+        app_logger.info("Empty basket checkout attempt by user %s", current_user.id)
+        flash("Ваш кошик порожній", "danger")
+        return redirect(url_for("basket"))
 
-            flash(
-                f"Замовлення оформлено! Загальна сума: {total_price}₴", "success")
-            app_logger.info(f"Order {new_coupon.id} created for user {current_user.id}. Total price: {total_price}")
+    else:
+        prices = pricing.get_price_table()
+        order_items = {line.menu_id: line.quantity for line in lines}
+        total_price = prices.total(lines)
+
+        # Купон і очищення кошика - одна транзакція й один commit;
+        # id купона приходить з INSERT ... RETURNING, а QR-код рахується з id на льоту
+        order_time = datetime.now()
+        coupon_id = Coupons.insert_once(
+            db_session, current_user.id, order_items, order_time,
+            request.form.get("idempotency_key") or None)
+        if coupon_id is None:
+            # Відкат повертає рядки кошика: після першого замовлення в ньому
+            # могли з'явитися нові позиції, і сесія має їх показувати
+            db_session.rollback()
+            app_logger.info("Duplicate checkout submit by user %s ignored", current_user.id)
+            basket.reload(db_session)
             return redirect(url_for("my_coupons"))
 
+        # Рядки замовлення з ціною на момент покупки - одним executemany
+        db_session.execute(insert(OrderLine), [{
+            "coupon_id": coupon_id, "user_id": current_user.id, "order_time": order_time,
+            "menu_id": line.menu_id, "menu_name": line.menu.name, "quantity": line.quantity,
+            "unit_price": prices[line.menu_id].price, "discount": prices[line.menu_id].discount,
+        } for line in lines])
+
+        db_session.commit()
+        basket.mark_ordered()
+
+        # Прогріваємо кеш QR-коду у фоні, щоб перший перегляд купона був миттєвим
+        qr_codes.submit(coupon_id)
+
+        flash(
+            f"Замовлення оформлено! Загальна сума: {total_price}₴", "success")
+        app_logger.info("Order %s created for user %s. Total price: %s", coupon_id, current_user.id, total_price)
+        return redirect(url_for("my_coupons"))
+
+
+HISTORY_PER_PAGE = 10
+HISTORY_MAX_PER_PAGE = 50
+
+
+def history_page_args():
+    per_page = request.args.get("per_page", type=int) or HISTORY_PER_PAGE
+    return request.args.get("cursor"), max(1, min(per_page, HISTORY_MAX_PER_PAGE))
+
 
 @app.route("/my_coupons")
+@query_budget.limit(3)
 @login_required
 def my_coupons():
-    with Session() as db_session:
-        coupons = db_session.query(Coupons).filter_by(
-            user_id=current_user.id).all()
+    cursor, per_page = history_page_args()
+    coupons, next_cursor = Coupons.history_page(get_db(), current_user.id, cursor, per_page)
 
-        all_menu_ids = set()
-        for coupon in coupons:
-            all_menu_ids.update([int(menu_id)
-                                for menu_id in coupon.order_items.keys()])
+    return render_template("orders/my_coupons.html",
+                           coupons=coupons,
+                           next_cursor=next_cursor,
+                           per_page=per_page,
+                           user=current_user)
 
-        menu_items = {}
-        if all_menu_ids:
-            menus = db_session.query(Menu).filter(
-                Menu.id.in_(all_menu_ids)).all()
-            menu_items = {str(menu.id): menu.name for menu in menus}
 
-        return render_template("orders/my_coupons.html",
-                               coupons=coupons,
-                               menu_items=menu_items,
-                               user=current_user)
+# Та сама сторінка історії у JSON - для нескінченного прокручування на клієнті
+@app.get("/my_coupons.json")
+@query_budget.limit(3)
+@login_required
+def my_coupons_json():
+    cursor, per_page = history_page_args()
+    coupons, next_cursor = Coupons.history_page(get_db(), current_user.id, cursor, per_page)
+
+    return jsonify({
+        "coupons": [{
+            "id": coupon.id,
+            "order_time": coupon.order_time.isoformat(),
+            "url": url_for("coupon", coupon_id=coupon.id),
+            "items": [{"menu_id": line.menu_id, "name": line.menu_name, "quantity": line.quantity}
+                      for line in coupon.lines],
+        } for coupon in coupons],
+        "next_cursor": next_cursor,
+    })
 
 
 @app.route("/coupon/<int:coupon_id>")
+@query_budget.limit(3)
 @login_required
 def coupon(coupon_id):
-    with Session() as db_session:
-        order = db_session.query(Coupons).filter_by(
-            id=coupon_id, user_id=current_user.id).first()
-        if not order:
-            return "Купон не знайдено!", 404
-
-        all_menu_ids = set()
-        if order.order_items:
-            all_menu_ids.update([int(menu_id)
-                                for menu_id in order.order_items.keys()])
-
-        menu_items = {}
-        if all_menu_ids:
-            menus = db_session.query(Menu).filter(
-                Menu.id.in_(all_menu_ids)).all()
-            menu_items = {str(menu.id): menu.name for menu in menus}
-
-        return render_template("orders/coupon.html",
-                               order=order,
-                               menu_items=menu_items,
-                               user=current_user)
+    db_session = get_db()
+    order = db_session.query(Coupons).filter_by(
+        id=coupon_id, user_id=current_user.id).options(selectinload(Coupons.lines)).first()
+    if not order:
+        return "Купон не знайдено!", 404
+
+    return render_template("orders/coupon.html",
+                           order=order,
+                           user=current_user)
+
+
+# QR-код залежить лише від id купона, тому його можна рендерити на будь-якому воркері
+# і кешувати в браузері назавжди. Власника перевіряємо до ETag і LRU: id купона
+# легко вгадати, а кеш спільний для всіх юзерів
+@app.get("/coupon/<int:coupon_id>/qr.<fmt>")
+@query_budget.limit(2)
+@login_required
+def coupon_qr(coupon_id, fmt):
+    if fmt not in qr_codes.MIMETYPES:
+        return "Непідтримуваний формат!", 404
+
+    owned = get_db().query(Coupons.id).filter_by(
+        id=coupon_id, user_id=current_user.id).first()
+    if not owned:
+        return "Купон не знайдено!", 404
+
+    etag = qr_codes.etag(coupon_id, fmt)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(qr_codes.get_qr(coupon_id, fmt), mimetype=qr_codes.MIMETYPES[fmt])
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, max-age=31536000, immutable"
+    return response
 
 
 # ===== АДМІНІСТРУВАННЯ =====
@@ -475,12 +567,56 @@ def admin():
     if not current_user.is_admin:
         return "Замість того щоб пропувати зайти в адмін панель, стань чашкою чаю☕", 418
 
-    with Session() as db_session:
-        users = db_session.query(Users).all()
+    db_session = get_db()
+    search = request.args.get("q", "").strip()
+    users, next_after = Users.admin_page(
+        db_session, after_id=request.args.get("after", type=int), search=search)
+
+    return render_template("admin/admin_dashboard.html",
+                           users=users,
+                           next_after=next_after,
+                           search=search,
+                           stats=admin_stats.get_stats(db_session))
+
+@app.get("/admin/pool")
+@login_required
+def admin_pool():
+    if not current_user.is_admin:
+        return "Access denied!", 403
+
+    return jsonify(pool_stats.snapshot(engine.pool))
+
+@app.get("/admin/analytics")
+@login_required
+def admin_analytics():
+    if not current_user.is_admin:
+        return "Access denied!", 403
+
+    # Звіт рахується потоково по order_lines, тож період обмежуємо роком
+    days = min(max(request.args.get("days", 30, type=int), 1), 366)
+    report = sales_analytics.build_report(since=datetime.now() - timedelta(days=days))
+    return jsonify(days=days, **report.as_dict())
+
+# Prometheus збирає метрики з кожного воркера окремо (кожен має свій реєстр).
+# Доступ - за METRICS_TOKEN або адміну, бо тут латентності, стан пулу і помилки
+@app.get("/metrics")
+def metrics_endpoint():
+    if not (metrics.authorized(request)
+            or current_user.is_authenticated and current_user.is_admin):
+        return "Access denied!", 403
 
-    return render_template("admin/admin_dashboard.html", users=users)
+    pool = pool_stats.snapshot(engine.pool)
+    gauges = {f"db_pool_{key}": value for key, value in pool.items()}
+    gauges["qr_queue_depth"] = qr_codes.queue_depth()
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
 
 # ===== ФУНКЦІЇ ДЛЯ КЕРУВАННЯ ОБ'ЄКТАМИ =====
+# Курсори сторінок адмінських списків з query string - щоб посилання "далі"
+# в одному списку не скидало сторінку іншого
+def admin_cursors(*names):
+    return {name: request.args.get(name) or None for name in names}
+
+
 # *Для уникнення дублювання коду
 def toggle_object_status(object_class, object_id, is_active, success_message, redirect_endpoint):
     if not current_user.is_admin:
@@ -489,15 +625,19 @@ def toggle_object_status(object_class, object_id, is_active, success_message, re
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
-    with Session() as db_session:
-        object = db_session.query(object_class).filter_by(id=object_id).first()
-        if not object:
-            return f"{object_class.__name__} not found!", 404
+    db_session = get_db()
+    object = db_session.query(object_class).filter_by(id=object_id).first()
+    if not object:
+        return f"{object_class.__name__} not found!", 404
 
-        object.active = is_active
-        db_session.commit()
-        flash(success_message, "success")
-        return redirect(url_for(redirect_endpoint))
+    object.active = is_active
+    db_session.commit()
+    catalog_cache.refresh([object.id if object_class == Menu else object.menu_id])
+    admin_stats.invalidate()
+    if object_class == SpecialOffer:
+        offer_scheduler.schedule(object)
+    flash(success_message, "success")
+    return redirect(url_for(redirect_endpoint))
 
 
 def delete_deactivated_objects(object_class, redirect_endpoint):
@@ -512,46 +652,53 @@ def delete_deactivated_objects(object_class, redirect_endpoint):
         flash("Ви повинні підтвердити видалення, поставивши галочку!", "danger")
         return redirect(url_for(redirect_endpoint))
 
-    with Session() as db_session:
-        deactivated_objects = db_session.query(
-            object_class).filter_by(active=False).all()
-
-        for object in deactivated_objects:
-            if object_class == Menu:
-                file_path = os.path.join(FILES_PATH, object.file_name)
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            db_session.delete(object)
-
-        db_session.commit()
-        flash(f"Видалення деактивованих об'єктів завершено успішно!", "success")
-        return redirect(url_for(redirect_endpoint))
+    db_session = get_db()
+    deactivated_objects = db_session.query(
+        object_class).filter_by(active=False).all()
+    menu_ids = [object.id if object_class == Menu else object.menu_id
+                for object in deactivated_objects]
+    file_names = [object.file_name for object in deactivated_objects
+                  if object_class == Menu]
+
+    for object in deactivated_objects:
+        db_session.delete(object)
+
+    db_session.commit()
+    catalog_cache.refresh(menu_ids)
+    admin_stats.invalidate()
+    # Одне фото може використовуватися кількома позиціями, тому видаляємо
+    # лише ті файли, на які більше ніхто не посилається
+    blob_store.release(file_names, db_session)
+    flash(f"Видалення деактивованих об'єктів завершено успішно!", "success")
+    return redirect(url_for(redirect_endpoint))
 
 # ===== ПОЗИЦІЇ =====
 @app.get("/add_position")
 @login_required
 def add_position():
     if not current_user.is_admin:
-        app_logger.warning(f"Non-admin user {current_user.id} attempted to access add_offer")
+        app_logger.warning("Non-admin user %s attempted to access add_offer", current_user.id)
         return "Access denied!", 403
 
-    with Session() as db_session:
-        all_positions = db_session.query(Menu).all()
-        active_positions = db_session.query(Menu).filter_by(active=True).all()
-        deactivated_positions = db_session.query(
-            Menu).filter_by(active=False).all()
+    # Обидва списки посторінково (keyset по назві), лише потрібні колонки
+    db_session = get_db()
+    cursors = admin_cursors("active_after", "inactive_after")
+    active_positions, next_active = Menu.admin_page(db_session, True, cursors["active_after"])
+    deactivated_positions, next_inactive = Menu.admin_page(db_session, False, cursors["inactive_after"])
 
-        return render_template("admin/add_position.html", csrf_token=session["csrf_token"],
-                               all_positions=all_positions,
-                               active_positions=active_positions,
-                               deactivated_positions=deactivated_positions)
+    return render_template("admin/add_position.html", csrf_token=session["csrf_token"],
+                           active_positions=active_positions,
+                           deactivated_positions=deactivated_positions,
+                           cursors=cursors,
+                           next_active=next_active,
+                           next_inactive=next_inactive)
 
 
 @app.post("/add_position/add")
 @login_required
 def add_position_post():
     if not current_user.is_admin:
-        app_logger.warning(f"Non-admin user {current_user.id} attempted to add position")
+        app_logger.warning("Non-admin user %s attempted to add position", current_user.id)
         return "Access denied!", 403
 
     if request.form.get("csrf_token") != session["csrf_token"]:
@@ -564,27 +711,38 @@ def add_position_post():
     price = request.form["price"]
     weight = request.form["weight"]
 
-    with Session() as db_session:
-        if db_session.query(Menu).filter_by(name=name).first():
-            flash("Позиція з такою назвою вже існує!", "danger")
-            return redirect(url_for("add_position"))
-
-        if not file or not file.filename:
-            return "Файл не вибрано або завантаження не вдалося"
-
-        unique_filename = f"{uuid.uuid4()}_{file.filename}"
-        output_path = os.path.join("static/menu", unique_filename)
+    db_session = get_db()
+    if db_session.query(Menu).filter_by(name=name).first():
+        flash("Позиція з такою назвою вже існує!", "danger")
+        return redirect(url_for("add_position"))
 
-        with open(output_path, "wb") as f:
-            f.write(file.read())
+    if not file or not file.filename:
+        return "Файл не вибрано або завантаження не вдалося"
+
+    file_name, temp_path = blob_store.spool_upload(file)
+    try:
+        # Рядок Menu комітиться під тим самим блокуванням, що й перевірка exists(),
+        # щоб release не видалив блоб між ними
+        with blob_store.locked(file_name, db_session):
+            if not blob_store.backend.exists(file_name):
+                menu_images.build_derivatives(temp_path, file_name)
+                blob_store.commit_upload(file_name, temp_path)
+
+            new_position = Menu(name=name, ingredients=ingredients,
+                                description=description, price=price,
+                                weight=weight, file_name=file_name)
+            db_session.add(new_position)
+            db_session.commit()
+    except UnidentifiedImageError:
+        flash("Завантажений файл не є зображенням!", "danger")
+        return redirect(url_for("add_position"))
+    finally:
+        os.remove(temp_path)
 
-        new_position = Menu(name=name, ingredients=ingredients,
-                            description=description, price=price,
-                            weight=weight, file_name=unique_filename)
-        db_session.add(new_position)
-        db_session.commit()
+    catalog_cache.refresh([new_position.id])
+    admin_stats.invalidate()
 
-        flash("Позицію додано успішно!", "success")
+    flash("Позицію додано успішно!", "success")
 
     return redirect(url_for("add_position"))
 
@@ -625,55 +783,63 @@ def delete_positions():
 @login_required
 def add_offer():
     if not current_user.is_admin:
-        app_logger.warning(f"Non-admin user {current_user.id} attempted to access add_offer")
+        app_logger.warning("Non-admin user %s attempted to access add_offer", current_user.id)
         return "Access denied!", 403
 
-    with Session() as db_session:
-        all_positions = db_session.query(Menu).filter_by(active=True).all()
-        active_offers = db_session.query(SpecialOffer).options(
-            joinedload(SpecialOffer.menu)).filter_by(active=True).all()
-        deactivated_offers = db_session.query(SpecialOffer).options(
-            joinedload(SpecialOffer.menu)).filter_by(active=False).all()
-
-        return render_template(
-            "admin/add_offer.html",
-            csrf_token=session["csrf_token"],
-            all_positions=all_positions,
-            active_offers=active_offers,
-            deactivated_offers=deactivated_offers
-        )
+    db_session = get_db()
+    cursors = admin_cursors("menu_after", "active_after", "inactive_after")
+    all_positions, next_menu = Menu.admin_page(db_session, True, cursors["menu_after"])
+    active_offers, next_active = SpecialOffer.admin_page(
+        db_session, True, request.args.get("active_after", type=int))
+    deactivated_offers, next_inactive = SpecialOffer.admin_page(
+        db_session, False, request.args.get("inactive_after", type=int))
+
+    return render_template(
+        "admin/add_offer.html",
+        csrf_token=session["csrf_token"],
+        all_positions=all_positions,
+        active_offers=active_offers,
+        deactivated_offers=deactivated_offers,
+        cursors=cursors,
+        next_menu=next_menu,
+        next_active=next_active,
+        next_inactive=next_inactive
+    )
 
 
 @app.post("/add_offer/add")
 @login_required
 def add_offer_post():
     if not current_user.is_admin:
-        app_logger.warning(f"Non-admin user {current_user.id} attempted to add offer")
+        app_logger.warning("Non-admin user %s attempted to add offer", current_user.id)
         return "Access denied!", 403
 
     if request.form.get("csrf_token") != session["csrf_token"]:
         return "Request blocked!", 403
 
-    with Session() as db_session:
-        menu_id = request.form["menu_id"]
-        discount = float(request.form["discount"])
-        expiration_date = datetime.fromisoformat(
-            request.form["expiration_date"])
-        active = "active" in request.form
-
-        new_offer = SpecialOffer(
-            menu_id=menu_id,
-            discount=discount,
-            expiration_date=expiration_date,
-            active=active
-        )
-        db_session.add(new_offer)
-        db_session.commit()
-        
-        app_logger.info(f"Admin {current_user.id} added new offer: {menu_id}")
-        flash("Пропозицію додано успішно!", "success")
+    db_session = get_db()
+    menu_id = request.form["menu_id"]
+    discount = float(request.form["discount"])
+    expiration_date = datetime.fromisoformat(
+        request.form["expiration_date"])
+    active = "active" in request.form
+
+    new_offer = SpecialOffer(
+        menu_id=menu_id,
+        discount=discount,
+        expiration_date=expiration_date,
+        active=active
+    )
+    db_session.add(new_offer)
+    db_session.commit()
+    catalog_cache.refresh([new_offer.menu_id])
+    admin_stats.invalidate()
+    offer_scheduler.schedule(new_offer)
 
-        return redirect(url_for("add_offer"))
+    app_logger.info("Admin %s added new offer: %s", current_user.id, menu_id)
+    flash("Пропозицію додано успішно!", "success")
+
+    return redirect(url_for("add_offer"))
 
 
 @app.post("/add_offer/deactivate")
@@ -710,6 +876,4 @@ def delete_offers():
 
 # ===== ЗАПУСК ЗАСТОСУНКУ =====
 if __name__ == "__main__":
-    with Session() as db_session:
-        SpecialOffer.deactivate_expired(db_session)
     app.run(debug=True)
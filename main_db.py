@@ -1,16 +1,21 @@
-from sqlalchemy import create_engine, String, Float, Integer, ForeignKey, func
-from sqlalchemy import Boolean, Text, DateTime
+from sqlalchemy import create_engine, JSON, String, Float, Integer, ForeignKey, func, update, delete
+from sqlalchemy import Boolean, DateTime, Index, text, make_url, select, literal, exists, or_, tuple_
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import Mapped, mapped_column, relationship, sessionmaker
-from sqlalchemy.orm import validates, joinedload, DeclarativeBase
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import validates, selectinload, load_only, aliased, DeclarativeBase
+from sqlalchemy.dialects.postgresql import JSONB, insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime
+from flask import g
 from flask_login import UserMixin
 from dotenv import load_dotenv
-import bcrypt 
 import os
 import logging
+import threading
+import time
 
 from logger_setup import setup_logger
+import passwords
 
 
 db_logger = setup_logger("main_db", "app_db.log",
@@ -22,8 +27,116 @@ logging.getLogger("sqlalchemy.dialects").setLevel(logging.WARNING)
 load_dotenv()
 
 
-engine = create_engine(os.getenv('DATABASE_URL'))
-Session = sessionmaker(bind=engine)
+class PoolStats:
+    '''Counters for how long requests wait to get a connection from the pool.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def snapshot(self, pool):
+        with self._lock:
+            return {
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+                "checked_in": pool.checkedin(),
+                "utilization": pool.checkedout() / (pool.size() + max(pool._max_overflow, 0) or 1),
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record(time.perf_counter() - start)
+        return connection
+
+
+def engine_options(url):
+    '''Pool settings from the environment (DB_POOL_*, DB_STATEMENT_TIMEOUT_MS).'''
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1") == "1",
+    }
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+    if statement_timeout and make_url(url).get_backend_name() == "postgresql":
+        options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout}"}
+    return options
+
+
+engine = create_engine(os.getenv('DATABASE_URL'), **engine_options(os.getenv('DATABASE_URL')))
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+
+def get_db():
+    '''Returns the session bound to the current Flask app context.'''
+    if "db_session" not in g:
+        g.db_session = Session()
+    return g.db_session
+
+
+def close_db(exception=None):
+    db_session = g.pop("db_session", None)
+    if db_session is not None:
+        if exception is not None:
+            db_session.rollback()
+        db_session.close()
+
+
+def active_only():
+    '''WHERE clause for partial indexes over rows with active = true.
+
+    Written the way each dialect renders filter_by(active=True), so that the
+    planner can match the query against the index predicate.
+    '''
+    return {"postgresql_where": text("active = true"), "sqlite_where": text("active = 1")}
+
+
+def dialect_insert(db_session):
+    '''insert() of the session's dialect, for ON CONFLICT clauses.'''
+    if db_session.get_bind().dialect.name == "postgresql":
+        return postgresql_insert
+    return sqlite_insert
+
+
+def keyset_page(query, column, after=None, per_page=50):
+    '''One page of query ordered by a unique column, starting after the given value.
+
+    Returns (rows, next_after); fetching per_page + 1 rows tells whether
+    there is a next page without a COUNT or an OFFSET.
+    '''
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(per_page + 1).all()
+    if len(rows) > per_page:
+        return rows[:per_page], getattr(rows[per_page - 1], column.key)
+    return rows, None
 
 
 class Base(DeclarativeBase):
@@ -46,17 +159,29 @@ class Users(Base, UserMixin):
     basket = relationship("Basket", back_populates="user")
     coupons = relationship("Coupons", back_populates="user")
 
+    # Хешування йде в окремому пулі процесів (див. passwords.py) і може
+    # кинути passwords.HashingBusy, якщо пул перевантажений
     def set_password(self, password: str):
-        self.password = bcrypt.hashpw(
-            password.encode('utf-8'),
-            bcrypt.gensalt()
-        ).decode('utf-8')
+        self.password = passwords.hash_password(password)
 
     def check_password(self, password: str):
-        return bcrypt.checkpw(
-            password.encode('utf-8'),
-            self.password.encode('utf-8')
-        )
+        return passwords.verify(password, self.password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password)
+
+    @classmethod
+    def admin_page(cls, db_session, after_id=None, search=None, per_page=50):
+        '''One page of users ordered by id, optionally filtered by a prefix.
+
+        Returns (users, next_after_id); only the columns the table shows are loaded.
+        '''
+        query = db_session.query(cls).options(load_only(cls.id, cls.username, cls.email, cls.is_admin))
+        if search:
+            pattern = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            query = query.filter(or_(cls.username.ilike(pattern, escape="\\"),
+                                     cls.email.ilike(pattern, escape="\\")))
+        return keyset_page(query, cls.id, after_id or None, per_page)
 
 
 class Menu(Base):
@@ -74,18 +199,109 @@ class Menu(Base):
     special_offers = relationship("SpecialOffer", back_populates="menu")
     basket = relationship("Basket", back_populates="menu")
 
+    # Каталог щоразу вибирає лише активні позиції
+    __table_args__ = (Index("ix_menu_active", "id", **active_only()),)
+
+    @classmethod
+    def admin_page(cls, db_session, active, after_name=None, per_page=50):
+        '''One page of active or deactivated positions ordered by name (unique).'''
+        query = db_session.query(cls.id, cls.name, cls.price).filter(cls.active == active)
+        return keyset_page(query, cls.name, after_name or None, per_page)
+
 
 class Coupons(Base):
     __tablename__ = "coupons"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    order_items: Mapped[dict] = mapped_column(JSONB)
+    # JSONB у Postgres; звичайний JSON дозволяє підняти схему на SQLite (benchmark.py)
+    order_items: Mapped[dict] = mapped_column(JSON().with_variant(JSONB(), "postgresql"))
     order_time: Mapped[datetime] = mapped_column(DateTime)
     active: Mapped[bool] = mapped_column(Boolean, default=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
     qr_code_path: Mapped[str] = mapped_column(String, nullable=True)
+    idempotency_key: Mapped[str] = mapped_column(String(64), nullable=True)
 
     user = relationship("Users", back_populates="coupons")
+    lines = relationship("OrderLine", back_populates="coupon", order_by="OrderLine.id")
+
+    __table_args__ = (
+        # Повторна відправка форми оформлення з тим самим ключем не створює друге замовлення
+        Index("ux_coupons_user_idempotency", "user_id", "idempotency_key", unique=True),
+        # Keyset-пагінація історії: WHERE user_id = ? AND (order_time, id) < (?, ?)
+        Index("ix_coupons_user_time_id", "user_id", order_time.desc(), id.desc()),
+    )
+
+    @staticmethod
+    def encode_cursor(coupon):
+        return f"{coupon.order_time.isoformat()}_{coupon.id}"
+
+    @staticmethod
+    def decode_cursor(cursor):
+        '''Returns (order_time, id) or None for a missing or malformed cursor.'''
+        try:
+            order_time, coupon_id = cursor.rsplit("_", 1)
+            return datetime.fromisoformat(order_time), int(coupon_id)
+        except (AttributeError, ValueError):
+            return None
+
+    @classmethod
+    def history_page(cls, db_session, user_id, cursor=None, per_page=10):
+        '''One page of the user's orders, newest first, with lines loaded.
+
+        Returns (coupons, next_cursor); next_cursor is None on the last page.
+        The cost does not depend on how far the user has scrolled.
+        '''
+        query = db_session.query(cls).filter(cls.user_id == user_id)
+        position = cls.decode_cursor(cursor)
+        if position is not None:
+            query = query.filter(tuple_(cls.order_time, cls.id) < tuple_(*position))
+
+        # +1 рядок, щоб дізнатися, чи є наступна сторінка, без COUNT(*)
+        coupons = query.order_by(cls.order_time.desc(), cls.id.desc()) \
+            .options(selectinload(cls.lines)).limit(per_page + 1).all()
+        if len(coupons) > per_page:
+            return coupons[:per_page], cls.encode_cursor(coupons[per_page - 1])
+        return coupons, None
+
+    @classmethod
+    def insert_once(cls, db_session, user_id, order_items, order_time, idempotency_key=None):
+        '''INSERT ... ON CONFLICT DO NOTHING RETURNING id, without committing.
+
+        Returns the new coupon id, or None if this user already placed an
+        order with the same idempotency key.
+        '''
+        statement = dialect_insert(db_session)(cls).values(
+            user_id=user_id, order_items=order_items, order_time=order_time,
+            active=True, idempotency_key=idempotency_key,
+        ).on_conflict_do_nothing(index_elements=["user_id", "idempotency_key"]).returning(cls.id)
+        return db_session.execute(statement).scalar()
+
+
+class OrderLine(Base):
+    '''One position of an order with the price the customer actually paid.'''
+    __tablename__ = "order_lines"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    coupon_id: Mapped[int] = mapped_column(ForeignKey('coupons.id', ondelete="CASCADE"), nullable=False)
+    # user_id та order_time дубльовані з купона, щоб історія й аналітика
+    # читалися одним індексом без join з coupons
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=False)
+    order_time: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    # Адмін може видалити позицію меню, а історія замовлень має лишитися,
+    # тому menu_id обнуляється, а назва зберігається копією
+    menu_id: Mapped[int] = mapped_column(ForeignKey('menu.id', ondelete="SET NULL"), nullable=True)
+    menu_name: Mapped[str] = mapped_column(String, nullable=False)
+    quantity: Mapped[int] = mapped_column(Integer, nullable=False)
+    unit_price: Mapped[float] = mapped_column(Float, nullable=False)
+    discount: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+
+    coupon = relationship("Coupons", back_populates="lines")
+
+    __table_args__ = (
+        Index("ix_order_lines_user_time", "user_id", order_time.desc()),
+        Index("ix_order_lines_menu", "menu_id"),
+        Index("ix_order_lines_coupon", "coupon_id"),
+    )
 
 
 class Basket(Base):
@@ -100,6 +316,73 @@ class Basket(Base):
     menu: Mapped["Menu"] = relationship("Menu")
     user: Mapped["Users"] = relationship("Users", back_populates="basket")
 
+    # Одна позиція меню = один рядок кошика; на цьому тримається upsert нижче
+    __table_args__ = (Index("ux_basket_user_menu", "user_id", "menu_id", unique=True),)
+
+    @staticmethod
+    def _lock_user(db_session, user_id):
+        # У Postgres (READ COMMITTED) два паралельні INSERT для різних позицій
+        # бачать однакову суму і разом можуть перевищити ліміт, тому
+        # серіалізуємо зміни кошика одного юзера. SQLite і так пише по одному
+        if db_session.get_bind().dialect.name == "postgresql":
+            db_session.execute(select(func.pg_advisory_xact_lock(func.hashtext("basket"), user_id)))
+
+    @classmethod
+    def add_capped(cls, db_session, user_id, menu_id, quantity, max_units, max_lines):
+        '''Adds quantity to the user's line in one INSERT ... ON CONFLICT DO UPDATE.
+
+        The unit and line limits and quantity > 0 are checked inside the
+        statement. Returns the new quantity of the line, or None if they
+        rejected the add.
+        '''
+        units = select(func.coalesce(func.sum(cls.quantity), 0)) \
+            .where(cls.user_id == user_id).scalar_subquery()
+        lines = select(func.count()).select_from(cls) \
+            .where(cls.user_id == user_id).scalar_subquery()
+        has_line = exists().where(cls.user_id == user_id, cls.menu_id == menu_id)
+
+        source = select(literal(user_id), literal(menu_id), literal(quantity)).where(
+            literal(quantity) > 0, units + quantity <= max_units, or_(lines < max_lines, has_line))
+
+        statement = dialect_insert(db_session)(cls).from_select(["user_id", "menu_id", "quantity"], source)
+        statement = statement.on_conflict_do_update(
+            index_elements=["user_id", "menu_id"],
+            set_={"quantity": cls.quantity + statement.excluded.quantity},
+        ).returning(cls.quantity)
+
+        cls._lock_user(db_session, user_id)
+        new_quantity = db_session.execute(statement).scalar()
+        db_session.commit()
+        return new_quantity
+
+    @classmethod
+    def take_all(cls, db_session, user_id):
+        '''DELETE ... RETURNING the user's lines in basket order, without committing.'''
+        rows = db_session.execute(
+            delete(cls).where(cls.user_id == user_id).returning(cls.id, cls.menu_id, cls.quantity)
+        ).all()
+        return sorted(rows, key=lambda row: row.id)
+
+    @classmethod
+    def set_quantity_capped(cls, db_session, user_id, menu_id, quantity, max_units):
+        '''Sets a line's quantity in one UPDATE unless the basket would exceed max_units.
+
+        Returns the new quantity, or None if there is no such line or the cap was hit.
+        '''
+        other = aliased(cls)
+        units = select(func.sum(other.quantity)).where(other.user_id == user_id).scalar_subquery()
+
+        cls._lock_user(db_session, user_id)
+        new_quantity = db_session.execute(
+            update(cls)
+            .where(cls.user_id == user_id, cls.menu_id == menu_id,
+                   units - cls.quantity + quantity <= max_units)
+            .values(quantity=quantity)
+            .returning(cls.quantity)
+        ).scalar()
+        db_session.commit()
+        return new_quantity
+
 
 class SpecialOffer(Base):
     __tablename__ = "special_offers"
@@ -112,6 +395,13 @@ class SpecialOffer(Base):
 
     menu: Mapped["Menu"] = relationship("Menu")
 
+    __table_args__ = (
+        # deactivate_expired() і планувальник шукають активні пропозиції за терміном
+        Index("ix_special_offers_active_expiration", "expiration_date", **active_only()),
+        # Оновлення каталогу по menu_id та видалення позицій меню (FK)
+        Index("ix_special_offers_menu_id", "menu_id"),
+    )
+
     @validates('discount')
     def validate_discount(self, key, discount):
         if not 0 <= float(discount) <= 100:
@@ -124,15 +414,25 @@ class SpecialOffer(Base):
             raise ValueError("Offer can not be added as expired")
         return expiration_date
 
+    @classmethod
+    def admin_page(cls, db_session, active, after_id=None, per_page=50):
+        '''One page of active or deactivated offers with their position names.'''
+        query = db_session.query(cls.id, cls.discount, Menu.name.label("menu_name")) \
+            .join(Menu, cls.menu_id == Menu.id).filter(cls.active == active)
+        return keyset_page(query, cls.id, after_id or None, per_page)
+
     @classmethod
     def deactivate_expired(cls, db_session):
-        expired = db_session.query(cls).filter(
-            cls.active == True,
-            cls.expiration_date < datetime.now()
-        ).all()
-        for offer in expired:
-            offer.active = False
+        '''Deactivates expired offers in one UPDATE, returns affected menu ids.'''
+        result = db_session.execute(
+            update(cls)
+            .where(cls.active == True, cls.expiration_date < datetime.now())
+            .values(active=False)
+            .returning(cls.menu_id)
+        )
+        menu_ids = {row.menu_id for row in result}
         db_session.commit()
+        return menu_ids
 
 
 base = Base()
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps, features
+
+import blob_store
+from fragment_cache import LRUCache
+
+
+DERIVED_DIR = "derived"
+
+# Ширини під картки (320), сторінку позиції (640) та retina-екрани (1024)
+WIDTHS = (320, 640, 1024)
+QUALITY = {"avif": 50, "webp": 75, "jpeg": 80}
+MIMETYPES = {"avif": "image/avif", "webp": "image/webp", "jpeg": "image/jpeg"}
+EXTENSIONS = {"avif": "avif", "webp": "webp", "jpeg": "jpg"}
+# Від найкращого стиснення до найсумісніших форматів; JPEG завжди останній як fallback
+FORMATS = tuple(fmt for fmt in ("avif", "webp", "jpeg")
+                if fmt == "jpeg" or features.check(fmt))
+
+
+def manifest_key(file_name):
+    return f"{DERIVED_DIR}/{file_name}.json"
+
+
+def _encode(image, fmt):
+    buffer = BytesIO()
+    if fmt == "jpeg":
+        # JPEG не має альфа-каналу, тому прозорий фон робимо білим
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        background.save(buffer, format="JPEG", quality=QUALITY[fmt], optimize=True, progressive=True)
+    else:
+        image.save(buffer, format=fmt.upper(), quality=QUALITY[fmt])
+    return buffer.getvalue()
+
+
+def build_derivatives(source, file_name):
+    '''Decodes an uploaded image once and stores resized, re-encoded copies.
+
+    source is a path or a binary file object. Every derivative is stored
+    under a name derived from its content hash, and the list of them goes
+    to a JSON manifest in the blob store.
+    Raises PIL.UnidentifiedImageError if the upload is not an image.
+    '''
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("RGBA")
+
+    widths = sorted({min(width, image.width) for width in WIDTHS})
+    variants = {fmt: [] for fmt in FORMATS}
+
+    for width in widths:
+        height = round(image.height * width / image.width)
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for fmt in FORMATS:
+            data = _encode(resized, fmt)
+            digest = hashlib.sha256(data).hexdigest()[:16]
+            derived_name = f"{digest}-{width}w.{EXTENSIONS[fmt]}"
+            derived_key = f"{DERIVED_DIR}/{derived_name}"
+            if not blob_store.backend.exists(derived_key):
+                blob_store.backend.put_bytes(derived_key, data)
+            blob_store.backend.put_bytes(ref_key(derived_key, file_name), b"")
+            variants[fmt].append([width, derived_name])
+
+    manifest = {"source": file_name, "width": image.width,
+                "height": image.height, "variants": variants}
+    blob_store.backend.put_bytes(manifest_key(file_name), json.dumps(manifest).encode("utf-8"))
+
+    _manifests.pop(file_name)
+    return manifest
+
+
+def derived_keys(file_name):
+    manifest = _load_manifest(file_name)
+    if not manifest:
+        return set()
+    return {f"{DERIVED_DIR}/{name}"
+            for variants in manifest["variants"].values() for _, name in variants}
+
+
+# Однакові картинки дають однакові похідні, тож на одну похідну можуть посилатися
+# кілька оригіналів. Кожне посилання - окремий порожній блоб
+# derived/refs/<похідна>/<оригінал>: його запис і видалення не конфліктують
+# між воркерами, а перевірка "чи потрібна ще похідна" - це один list за префіксом
+def ref_key(derived_key, file_name):
+    return f"{DERIVED_DIR}/refs/{derived_key.split('/', 1)[1]}/{file_name}"
+
+
+def ref_keys(file_name):
+    return {ref_key(key, file_name) for key in derived_keys(file_name)}
+
+
+def write_refs(file_name):
+    '''Adds missing reference markers for derivatives built before they existed.'''
+    for key in ref_keys(file_name):
+        if not blob_store.backend.exists(key):
+            blob_store.backend.put_bytes(key, b"")
+
+
+def delete_derivatives(file_name):
+    for key in derived_keys(file_name):
+        blob_store.backend.delete(ref_key(key, file_name))
+        if next(blob_store.backend.list_keys(prefix=ref_key(key, "")), None) is None:
+            blob_store.backend.delete(key)
+    blob_store.backend.delete(manifest_key(file_name))
+    _manifests.pop(file_name)
+
+
+# Маніфести кешуються в пам'яті, щоб рендер сторінки не ходив у сховище.
+# Відсутній маніфест не кешується: його може створити інший воркер чи запуск
+# menu_images.py, і сторінка має підхопити його без рестарту
+MANIFEST_CACHE_SIZE = int(os.getenv("MANIFEST_CACHE_SIZE", "1024"))
+_manifests = LRUCache(MANIFEST_CACHE_SIZE)
+
+
+def _load_manifest(file_name):
+    manifest = _manifests.get(file_name)
+    if manifest is None:
+        data = blob_store.backend.get_bytes(manifest_key(file_name))
+        if data:
+            manifest = json.loads(data)
+            _manifests.put(file_name, manifest)
+    return manifest
+
+
+class MenuImage:
+    '''What a template needs to emit <picture> for one menu photo.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.manifest = _load_manifest(file_name)
+
+    @staticmethod
+    def _srcset(variants):
+        return ", ".join(f"{blob_store.backend.url(f'{DERIVED_DIR}/{name}')} {width}w"
+                         for width, name in variants)
+
+    @property
+    def sources(self):
+        '''(mimetype, srcset) pairs for the modern formats, best first.'''
+        if not self.manifest:
+            return []
+        return [(MIMETYPES[fmt], self._srcset(variants))
+                for fmt, variants in self.manifest["variants"].items() if fmt != "jpeg"]
+
+    @property
+    def srcset(self):
+        if not self.manifest:
+            return ""
+        return self._srcset(self.manifest["variants"]["jpeg"])
+
+    @property
+    def src(self):
+        if not self.manifest:
+            # Для старих завантажень без похідних віддаємо оригінал
+            return blob_store.backend.url(self.file_name)
+        width, name = self.manifest["variants"]["jpeg"][0]
+        return blob_store.backend.url(f"{DERIVED_DIR}/{name}")
+
+
+def menu_image(file_name):
+    return MenuImage(file_name)
+
+
+# ===== ГЕНЕРАЦІЯ ДЛЯ ВЖЕ ЗАВАНТАЖЕНИХ ФОТО =====
+if __name__ == "__main__":
+    from main_db import Menu, Session
+
+    with Session() as db_session:
+        file_names = sorted({row.file_name for row in db_session.query(Menu.file_name)})
+
+    for file_name in file_names:
+        data = blob_store.backend.get_bytes(file_name)
+        if data is None:
+            print(f"{file_name}: missing in the blob store, skipped")
+            continue
+        manifest = build_derivatives(BytesIO(data), file_name)
+        count = sum(len(variants) for variants in manifest["variants"].values())
+        print(f"{file_name}: {count} derivative(s)")
@@ -0,0 +1,281 @@
+import os
+import threading
+import time
+import weakref
+
+from flask import g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+
+# Межі бакетів гістограм у секундах (як у prometheus_client за замовчуванням)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PREFIX = "coffee"
+# Server-Timing показує браузеру, скільки часу пішло на БД/шаблон/bcrypt/QR
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+# /metrics віддається із заголовком Authorization: Bearer <token>; без токена - лише адміну
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+HELP = {
+    "request_duration_seconds": ("histogram", "Request latency by endpoint"),
+    "requests_total": ("counter", "Responses by endpoint and status"),
+    "db_queries_total": ("counter", "SQL statements executed, by endpoint"),
+    "db_query_seconds_total": ("counter", "Time spent in SQL statements, by endpoint"),
+    "db_query_duration_seconds": ("histogram", "Latency of single SQL statements"),
+    "phase_duration_seconds": ("histogram", "Time of template rendering, bcrypt and QR encoding"),
+}
+
+
+class _Shard:
+    '''Metrics written by one thread; only that thread ever modifies it.'''
+    __slots__ = ("histograms", "counters")
+
+    def __init__(self):
+        # (name, labels) -> [лічильники бакетів..., +Inf, sum]
+        self.histograms = {}
+        self.counters = {}
+
+    def merge(self, other):
+        # Копія dict на випадок, якщо потік саме додає новий ключ
+        for key, values in list(other.histograms.items()):
+            merged = self.histograms.setdefault(key, [0] * len(values))
+            for index, value in enumerate(values):
+                merged[index] += value
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+class _ThreadToken:
+    '''Lives in thread-local storage, so it is freed when its thread exits.'''
+    __slots__ = ("__weakref__",)
+
+
+class Registry:
+    '''Per-thread metric shards merged on collect, so recording takes no lock.
+
+    Servers that start a thread per request (werkzeug, waitress) would leave
+    a shard per request behind, so a finished thread's shard is folded into
+    a single retired shard.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = set()
+        self._retired = _Shard()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            self._local.token = token = _ThreadToken()
+            weakref.finalize(token, self._retire, shard)
+            with self._lock:
+                self._shards.add(shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            # Після reset() шард старого процесу вже не рахується
+            if shard in self._shards:
+                self._shards.remove(shard)
+                self._retired.merge(shard)
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                values[index] += 1
+                break
+        else:
+            values[len(BUCKETS)] += 1
+        values[-1] += value
+
+    def inc(self, name, labels, value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def collect(self):
+        '''Returns merged (histograms, counters) across all threads.'''
+        total = _Shard()
+        # Під локом, щоб шард, який саме переходить у retired, не врахувати двічі
+        with self._lock:
+            total.merge(self._retired)
+            for shard in self._shards:
+                total.merge(shard)
+        return total.histograms, total.counters
+
+    def reset(self):
+        # Після fork дочірній процес не має успадковувати лічильники майстра
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = set()
+        self._retired = _Shard()
+
+
+registry = Registry()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=registry.reset)
+
+
+# ===== ФАЗИ ЗАПИТУ =====
+def _timings():
+    timings = g.get("_metrics_timings")
+    if timings is None:
+        timings = g._metrics_timings = {}
+    return timings
+
+
+def _add_timing(phase, seconds):
+    timing = _timings().setdefault(phase, [0.0, 0])
+    timing[0] += seconds
+    timing[1] += 1
+
+
+def observe_phase(phase, seconds):
+    '''Records time of a hot-path phase (template, bcrypt, qr).'''
+    registry.observe("phase_duration_seconds", (("phase", phase),), seconds)
+    if has_request_context():
+        _add_timing(phase, seconds)
+
+
+class timed:
+    '''Context manager: with metrics.timed("bcrypt"): ...'''
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe_phase(self.phase, time.perf_counter() - self.start)
+
+
+# ===== ПІДКЛЮЧЕННЯ ДО FLASK І SQLALCHEMY =====
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("metrics_query_start")
+    if not starts:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    registry.observe("db_query_duration_seconds", (), seconds)
+    if has_request_context():
+        _add_timing("db", seconds)
+
+
+def _handle_error(context):
+    # Запит упав і after_cursor_execute не буде - інакше його старт лишився б
+    # у conn.info, який живе разом із з'єднанням у пулі
+    if context.connection is None:
+        return
+    starts = context.connection.info.get("metrics_query_start")
+    if starts:
+        starts.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    g.setdefault("_metrics_template_starts", []).append(time.perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    starts = g.get("_metrics_template_starts")
+    if starts:
+        observe_phase("template", time.perf_counter() - starts.pop())
+
+
+def _start_request():
+    g._metrics_started = time.perf_counter()
+
+
+def _finish_request(response):
+    started = g.get("_metrics_started")
+    if started is None:
+        return response
+    total = time.perf_counter() - started
+    endpoint = request.endpoint or "unmatched"
+    labels = (("endpoint", endpoint), ("method", request.method))
+    registry.observe("request_duration_seconds", labels, total)
+    registry.inc("requests_total", (("endpoint", endpoint), ("status", str(response.status_code))))
+
+    timings = g.get("_metrics_timings") or {}
+    db_seconds, db_count = timings.get("db", (0.0, 0))
+    if db_count:
+        registry.inc("db_queries_total", (("endpoint", endpoint),), db_count)
+        registry.inc("db_query_seconds_total", (("endpoint", endpoint),), db_seconds)
+
+    if SERVER_TIMING:
+        parts = [f'{phase};dur={seconds * 1000:.1f};desc="{count}x"'
+                 for phase, (seconds, count) in timings.items()]
+        parts.append(f"app;dur={total * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(parts)
+    return response
+
+
+def init_app(app, engine):
+    '''Installs request, template and SQL timing hooks.'''
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+# ===== ЕКСПОРТ =====
+def authorized(req):
+    '''True if the request carries METRICS_TOKEN; without a configured token nobody does.'''
+    if not METRICS_TOKEN:
+        return False
+    return req.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+def render(gauges=None):
+    '''Prometheus text format for this process (each worker is scraped separately).'''
+    histograms, counters = registry.collect()
+    lines = []
+    for short_name, (kind, help_text) in HELP.items():
+        name = f"{PREFIX}_{short_name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == short_name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != short_name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), values):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {values[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    for short_name, value in (gauges or {}).items():
+        name = f"{PREFIX}_{short_name}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,196 @@
+from datetime import datetime
+import argparse
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import exists, inspect, insert, select, text
+
+from main_db import Coupons, Menu, OrderLine, SpecialOffer, engine
+
+
+# Версія схеми зберігається в окремій таблиці, щоб апгрейдити вже існуючі БД.
+# Нові БД створюються через base.create_db() вже з усіма змінами, а upgrade
+# для них лише проставляє версію (кожна міграція пропускає те, що вже є)
+schema_metadata = MetaData()
+schema_version = Table(
+    "schema_version", schema_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String(100), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def _has_index(connection, table, name):
+    return any(index["name"] == name for index in inspect(connection).get_indexes(table))
+
+
+# ===== 1: один рядок кошика на позицію =====
+def _basket_unique_line_up(connection):
+    if _has_index(connection, "basket", "ux_basket_user_menu"):
+        return
+    # Старий код додавав новий рядок на кожне "додати в кошик", тож спершу
+    # зливаємо дублікати в рядок з найменшим id
+    connection.execute(text('''
+        UPDATE basket SET quantity = (
+            SELECT SUM(b.quantity) FROM basket b
+            WHERE b.user_id = basket.user_id AND b.menu_id = basket.menu_id)
+        WHERE id IN (SELECT MIN(id) FROM basket GROUP BY user_id, menu_id HAVING COUNT(*) > 1)
+    '''))
+    connection.execute(text('''
+        DELETE FROM basket WHERE id NOT IN (SELECT MIN(id) FROM basket GROUP BY user_id, menu_id)
+    '''))
+    connection.execute(text("CREATE UNIQUE INDEX ux_basket_user_menu ON basket (user_id, menu_id)"))
+
+
+def _basket_unique_line_down(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ux_basket_user_menu"))
+
+
+# ===== 2: ключ ідемпотентності для оформлення замовлення =====
+def _coupons_idempotency_key_up(connection):
+    columns = {column["name"] for column in inspect(connection).get_columns("coupons")}
+    if "idempotency_key" not in columns:
+        connection.execute(text("ALTER TABLE coupons ADD COLUMN idempotency_key VARCHAR(64)"))
+    if not _has_index(connection, "coupons", "ux_coupons_user_idempotency"):
+        connection.execute(text(
+            "CREATE UNIQUE INDEX ux_coupons_user_idempotency ON coupons (user_id, idempotency_key)"))
+
+
+def _coupons_idempotency_key_down(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ux_coupons_user_idempotency"))
+    connection.execute(text("ALTER TABLE coupons DROP COLUMN idempotency_key"))
+
+
+# ===== 3: рядки замовлень замість JSON у coupons.order_items =====
+BACKFILL_BATCH = 1000
+
+
+def _order_lines_up(connection):
+    OrderLine.__table__.create(connection, checkfirst=True)
+
+    menu = {row.id: row for row in connection.execute(select(Menu.id, Menu.name, Menu.price))}
+    last_id = 0
+    while True:
+        # Купони, для яких рядків ще немає; батчами, щоб не тримати все в пам'яті
+        coupons = connection.execute(
+            select(Coupons.id, Coupons.user_id, Coupons.order_time, Coupons.order_items)
+            .where(Coupons.id > last_id, ~exists().where(OrderLine.coupon_id == Coupons.id))
+            .order_by(Coupons.id).limit(BACKFILL_BATCH)
+        ).all()
+        if not coupons:
+            break
+
+        rows = []
+        for coupon in coupons:
+            for menu_id, quantity in (coupon.order_items or {}).items():
+                item = menu.get(int(menu_id))
+                # Ціну на момент покупки в JSON не зберігали - беремо поточну без знижки
+                rows.append({
+                    "coupon_id": coupon.id, "user_id": coupon.user_id,
+                    "order_time": coupon.order_time,
+                    "menu_id": item.id if item else None,
+                    "menu_name": item.name if item else "Невідома позиція",
+                    "quantity": quantity, "unit_price": item.price if item else 0,
+                    "discount": 0,
+                })
+        if rows:
+            connection.execute(insert(OrderLine.__table__), rows)
+        last_id = coupons[-1].id
+
+
+def _order_lines_down(connection):
+    OrderLine.__table__.drop(connection, checkfirst=True)
+
+
+# ===== 4: індекс для keyset-пагінації історії замовлень =====
+def _coupons_history_index_up(connection):
+    if not _has_index(connection, "coupons", "ix_coupons_user_time_id"):
+        connection.execute(text(
+            "CREATE INDEX ix_coupons_user_time_id ON coupons (user_id, order_time DESC, id DESC)"))
+
+
+def _coupons_history_index_down(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ix_coupons_user_time_id"))
+
+
+# ===== 5: індекси під гарячі запити =====
+# Кошик (user_id, menu_id) та історія (user_id, order_time, id) вже покриті
+# індексами з міграцій 1 і 4, тож тут лише меню та пропозиції
+def _hot_indexes():
+    return [index for model in (Menu, SpecialOffer) for index in model.__table__.indexes]
+
+
+def _hot_indexes_up(connection):
+    for index in _hot_indexes():
+        index.create(connection, checkfirst=True)
+
+
+def _hot_indexes_down(connection):
+    for index in _hot_indexes():
+        index.drop(connection, checkfirst=True)
+
+
+# (версія, назва, upgrade, downgrade) - лише дописувати в кінець
+MIGRATIONS = [
+    (1, "basket_unique_line", _basket_unique_line_up, _basket_unique_line_down),
+    (2, "coupons_idempotency_key", _coupons_idempotency_key_up, _coupons_idempotency_key_down),
+    (3, "order_lines", _order_lines_up, _order_lines_down),
+    (4, "coupons_history_index", _coupons_history_index_up, _coupons_history_index_down),
+    (5, "hot_lookup_indexes", _hot_indexes_up, _hot_indexes_down),
+]
+
+
+def current_version(connection):
+    schema_metadata.create_all(connection)
+    return connection.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar()
+
+
+def upgrade(target=None):
+    '''Applies pending migrations up to target (all by default), one transaction each.'''
+    applied = []
+    for version, name, up, _ in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.begin() as connection:
+            if version <= current_version(connection):
+                continue
+            up(connection)
+            connection.execute(schema_version.insert().values(
+                version=version, name=name, applied_at=datetime.now()))
+        applied.append(f"{version}_{name}")
+    return applied
+
+
+def downgrade(target):
+    '''Reverts migrations newer than target, newest first.'''
+    reverted = []
+    for version, name, _, down in reversed(MIGRATIONS):
+        if version <= target:
+            break
+        with engine.begin() as connection:
+            if version > current_version(connection):
+                continue
+            down(connection)
+            connection.execute(schema_version.delete().where(schema_version.c.version == version))
+        reverted.append(f"{version}_{name}")
+    return reverted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    upgrade_parser = subparsers.add_parser("upgrade", help="apply pending migrations")
+    upgrade_parser.add_argument("target", type=int, nargs="?")
+    downgrade_parser = subparsers.add_parser("downgrade", help="revert migrations above a version")
+    downgrade_parser.add_argument("target", type=int)
+    subparsers.add_parser("status", help="print the current schema version")
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        for migration in upgrade(args.target):
+            print(f"Applied {migration}")
+    elif args.command == "downgrade":
+        for migration in downgrade(args.target):
+            print(f"Reverted {migration}")
+
+    with engine.begin() as connection:
+        print(f"Schema version: {current_version(connection)} of {MIGRATIONS[-1][0]}")
@@ -0,0 +1,147 @@
+from datetime import datetime
+import argparse
+import heapq
+import logging
+import os
+import threading
+
+from main_db import SpecialOffer, Session
+from logger_setup import setup_logger
+import catalog_cache
+
+
+scheduler_logger = setup_logger(
+    "offer_scheduler", "app.log", level_file=logging.INFO, level_console=logging.WARNING)
+
+# Як часто перечитувати список активних пропозицій з БД, щоб підхопити ті,
+# що додали інші воркери (секунди)
+RESYNC_INTERVAL = float(os.getenv("OFFER_RESYNC_INTERVAL", "60"))
+ENABLED = os.getenv("OFFER_SCHEDULER", "1") != "0"
+
+
+class OfferExpiryScheduler:
+    '''Wakes up exactly when the next active offer lapses and expires it.
+
+    Upcoming expirations live in a min-heap of (expiration_date, offer_id, menu_id).
+    After every expiry run the touched menu ids are pushed to the catalog cache,
+    which in turn updates the price table.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._last_sync = None
+
+    def ensure_started(self):
+        # Після fork потік батьківського процесу не існує, тому стартуємо заново
+        if self._pid == os.getpid():
+            return
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._heap = []
+            self._thread = threading.Thread(
+                target=self._run, name="offer-expiry", daemon=True)
+            self._thread.start()
+
+    def schedule(self, offer):
+        if not offer.active:
+            return
+        with self._condition:
+            heapq.heappush(self._heap, (offer.expiration_date, offer.id, offer.menu_id))
+            self._condition.notify()
+
+    def _sync(self):
+        with Session() as db_session:
+            offers = db_session.query(
+                SpecialOffer.expiration_date, SpecialOffer.id, SpecialOffer.menu_id
+            ).filter_by(active=True).all()
+
+        heap = [tuple(offer) for offer in offers]
+        heapq.heapify(heap)
+        with self._condition:
+            self._heap = heap
+            self._last_sync = datetime.now()
+
+    def _pop_due(self, now):
+        menu_ids = set()
+        while self._heap and self._heap[0][0] < now:
+            _, _, menu_id = heapq.heappop(self._heap)
+            menu_ids.add(menu_id)
+        return menu_ids
+
+    def _run(self):
+        while True:
+            try:
+                self._expire(set())
+                self._sync()
+                self._loop()
+            except Exception:
+                scheduler_logger.error("Offer expiry scheduler failed, restarting", exc_info=True)
+                with self._condition:
+                    self._condition.wait(RESYNC_INTERVAL)
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                now = datetime.now()
+                due = self._pop_due(now)
+                if not due:
+                    timeout = RESYNC_INTERVAL - (now - self._last_sync).total_seconds()
+                    if self._heap:
+                        # +1мс, щоб до моменту UPDATE expiration_date вже був < now()
+                        until_next = (self._heap[0][0] - now).total_seconds() + 0.001
+                        timeout = min(timeout, until_next)
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+                        continue
+
+            if due:
+                self._expire(due)
+            else:
+                self._sync()
+
+    def _expire(self, menu_ids):
+        with Session() as db_session:
+            expired = SpecialOffer.deactivate_expired(db_session)
+        # Інший воркер міг уже виконати UPDATE, тому кеші оновлюємо і для
+        # позицій з нашої купи, навіть якщо в нас UPDATE нічого не змінив
+        menu_ids = menu_ids | expired
+        if menu_ids:
+            catalog_cache.refresh(menu_ids)
+        if expired:
+            scheduler_logger.info("Deactivated expired offers for menu ids %s", sorted(expired))
+
+
+scheduler = OfferExpiryScheduler()
+
+
+def ensure_started():
+    if ENABLED:
+        scheduler.ensure_started()
+
+
+def schedule(offer):
+    if ENABLED:
+        scheduler.schedule(offer)
+
+
+# ===== CLI ДЛЯ CRON =====
+# python offer_scheduler.py          - один прохід (для cron, з OFFER_SCHEDULER=0 у воркерах)
+# python offer_scheduler.py --serve  - окремий процес, що сам прокидається до кожного терміну
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deactivate expired special offers")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep running and expire offers as they lapse")
+    args = parser.parse_args()
+
+    if args.serve:
+        scheduler.ensure_started()
+        scheduler._thread.join()
+    else:
+        with Session() as db_session:
+            expired = SpecialOffer.deactivate_expired(db_session)
+        print(f"Deactivated offers for {len(expired)} menu item(s)")
@@ -0,0 +1,119 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import multiprocessing
+import os
+import threading
+
+import bcrypt
+
+import metrics
+
+
+# Вартість bcrypt (2^rounds ітерацій). Після зміни старі хеші перераховуються при вході
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+# Скільки хешувань може чекати в черзі; решта запитів одразу отримує 503,
+# щоб шквал логінів не забрав усі воркери в меню
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "16"))
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", "10"))
+# process - окремі процеси (forkserver/spawn імпортують головний модуль, тож
+# скрипт запуску має бути під if __name__ == "__main__", як main.py);
+# thread - потоки: bcrypt відпускає GIL, тож теж не блокує інші запити
+PASSWORD_POOL = os.getenv("PASSWORD_POOL", "process")
+
+
+class HashingBusy(RuntimeError):
+    '''Raised when the pool already has PASSWORD_QUEUE_LIMIT jobs or one waited too long.'''
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(password, hashed):
+    return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+
+
+class HashingPool:
+    '''Process (or thread) pool for bcrypt with a hard limit on queued jobs.'''
+
+    def __init__(self, kind, workers, queue_limit):
+        self.kind = kind
+        self.workers = workers
+        self._queue_limit = queue_limit
+        self._slots = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Пул створюється ліниво і заново після fork (кожен воркер gunicorn має свій)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.kind == "thread":
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="password")
+            else:
+                # forkserver/spawn: дочірні процеси не успадковують потоки веб-воркера
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+            self._slots = threading.BoundedSemaphore(self._queue_limit)
+            self._pid = os.getpid()
+
+    def run(self, function, *args):
+        self._ensure_started()
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            slots.release()
+            raise
+        # Слот звільняється, лише коли задача справді завершилась або скасована,
+        # інакше задачі, яких запит перестав чекати, лишались би в черзі поза лімітом
+        future.add_done_callback(lambda _: slots.release())
+
+        # Час разом з очікуванням у черзі пулу - саме його бачить запит
+        with metrics.timed("bcrypt"):
+            try:
+                return future.result(timeout=PASSWORD_TIMEOUT)
+            except FutureTimeoutError:
+                # Якщо задача ще в черзі - вона не виконуватиметься даремно
+                future.cancel()
+                raise HashingBusy()
+
+
+pool = HashingPool(PASSWORD_POOL, PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
+
+_dummy_hash = None
+
+
+def hash_password(password):
+    return pool.run(_hash, password, BCRYPT_ROUNDS)
+
+
+def verify(password, hashed):
+    '''Checks a password; hashed=None (unknown user) costs the same and fails.'''
+    global _dummy_hash
+    if hashed is None:
+        # Невідомий юзернейм перевіряємо проти фіктивного хешу тієї ж вартості,
+        # щоб за часом відповіді не можна було дізнатися, чи існує акаунт
+        if _dummy_hash is None:
+            _dummy_hash = hash_password(os.urandom(16).hex())
+        pool.run(_check, password, _dummy_hash)
+        return False
+    return pool.run(_check, password, hashed)
+
+
+def rounds_of(hashed):
+    # Формат bcrypt: $2b$<rounds>$<salt+hash>
+    return int(hashed.split("$")[2])
+
+
+def needs_rehash(hashed):
+    return rounds_of(hashed) != BCRYPT_ROUNDS
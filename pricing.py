@@ -0,0 +1,102 @@
+from datetime import datetime
+import threading
+
+import catalog_cache
+
+
+def to_money(value):
+    '''Rounds a price to kopecks and drops the fraction for whole amounts.'''
+    value = round(value, 2)
+    return int(value) if float(value).is_integer() else value
+
+
+class EffectivePrice:
+    '''Final unit price of a menu item with the best offer already applied.'''
+    __slots__ = ("menu_id", "base_price", "price", "discount", "offer")
+
+    def __init__(self, item, offer):
+        self.menu_id = item.id
+        self.base_price = item.price
+        self.offer = offer
+        self.discount = offer.discount if offer else 0
+        self.price = to_money(item.price - item.price * self.discount / 100)
+
+
+def _best_offer(item, now):
+    best = None
+    for offer in item.special_offers:
+        if offer.active and offer.expiration_date > now:
+            if best is None or offer.discount > best.discount:
+                best = offer
+    return best
+
+
+class PriceTable:
+    '''Effective prices for every catalog item, keyed by menu id.'''
+
+    def __init__(self, version, entries):
+        self.version = version
+        self.entries = entries
+
+    def __getitem__(self, menu_id):
+        return self.entries[menu_id]
+
+    def get(self, menu_id):
+        return self.entries.get(menu_id)
+
+    def unit_price(self, menu_id):
+        return self.entries[menu_id].price
+
+    def total(self, lines):
+        '''Sums price * quantity over objects with menu_id and quantity.'''
+        return to_money(sum(self.unit_price(line.menu_id) * line.quantity for line in lines))
+
+    @property
+    def best_offers(self):
+        '''Entries of active menu items that currently have a discount.'''
+        return sorted(
+            (entry for entry in self.entries.values() if entry.offer and entry.offer.menu.active),
+            key=lambda entry: entry.offer.id
+        )
+
+
+def _compute(catalog, menu_ids, now):
+    return {menu_id: EffectivePrice(catalog.by_id[menu_id], _best_offer(catalog.by_id[menu_id], now))
+            for menu_id in menu_ids if menu_id in catalog.by_id}
+
+
+def _rebuild(catalog, table, now):
+    if (table is not None and catalog.parent_version == table.version
+            and catalog.changed_ids is not None):
+        # Каталог лише пропатчили - перераховуємо тільки змінені позиції
+        entries = {menu_id: entry for menu_id, entry in table.entries.items()
+                   if menu_id not in catalog.changed_ids}
+        entries.update(_compute(catalog, catalog.changed_ids, now))
+    else:
+        entries = _compute(catalog, catalog.by_id.keys(), now)
+    return PriceTable(catalog.version, entries)
+
+
+_lock = threading.Lock()
+_table = None
+
+
+def get_price_table():
+    '''Returns the price table for the current catalog snapshot.
+
+    Expired offers are switched off by offer_scheduler, which patches the
+    catalog, so a lookup never has to look at the clock.
+    '''
+    global _table
+    catalog = catalog_cache.get_catalog()
+    table = _table
+    if table is not None and table.version == catalog.version:
+        return table
+
+    with _lock:
+        catalog = catalog_cache.get_catalog()
+        table = _table
+        if table is None or table.version != catalog.version:
+            table = _rebuild(catalog, table, datetime.now())
+            _table = table
+        return table
@@ -0,0 +1,216 @@
+from collections import OrderedDict
+from io import BytesIO
+import argparse
+import glob
+import logging
+import os
+import queue
+import threading
+import time
+
+import qrcode
+import qrcode.image.svg
+from sqlalchemy import update
+
+from main_db import Coupons, Session
+from logger_setup import setup_logger
+import metrics
+
+
+qr_logger = setup_logger(
+    "qr_codes", "app.log", level_file=logging.INFO, level_console=logging.WARNING)
+
+QR_DIR = "static/qrcodes"
+QR_WORKERS = int(os.getenv("QR_WORKERS", "2"))
+QR_QUEUE_SIZE = int(os.getenv("QR_QUEUE_SIZE", "200"))
+QR_MAX_ATTEMPTS = int(os.getenv("QR_MAX_ATTEMPTS", "3"))
+QR_CACHE_BYTES = int(os.getenv("QR_CACHE_BYTES", str(8 * 1024 * 1024)))
+
+# Вміст QR-коду ніколи не змінюється, тому версія потрібна лише на випадок,
+# якщо ми колись змінимо спосіб рендерингу (розмір, рамку тощо)
+QR_VERSION = "1"
+MIMETYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render_qr(coupon_id, fmt="png"):
+    '''Encodes ORDER:<coupon_id> as a PNG or SVG and returns the bytes.'''
+    data = f"ORDER:{coupon_id}"
+    buffer = BytesIO()
+    with metrics.timed("qr"):
+        if fmt == "svg":
+            qrcode.make(data, image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        else:
+            qrcode.make(data).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def etag(coupon_id, fmt):
+    return f"qr-{QR_VERSION}-{coupon_id}-{fmt}"
+
+
+class LRUByteCache:
+    '''Thread-safe LRU of encoded images, bounded by the total number of bytes.'''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+cache = LRUByteCache(QR_CACHE_BYTES)
+
+
+def get_qr(coupon_id, fmt="png"):
+    '''Returns encoded QR bytes from the LRU, rendering them on a miss.'''
+    key = (coupon_id, fmt)
+    data = cache.get(key)
+    if data is None:
+        data = render_qr(coupon_id, fmt)
+        cache.put(key, data)
+    return data
+
+
+class QRWorkerPool:
+    '''Bounded pool of threads that pre-render coupon QR codes into the LRU.
+
+    Rendering on demand in /coupon/<id>/qr.png works without the pool; the
+    pool just makes sure the first view after checkout is a cache hit.
+    '''
+
+    def __init__(self, workers, queue_size, max_attempts):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {"submitted": 0, "rendered": 0, "retried": 0,
+                      "failed": 0, "rejected": 0, "max_queue_depth": 0}
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for number in range(self.workers):
+                threading.Thread(target=self._run, name=f"qr-worker-{number}",
+                                 daemon=True).start()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, coupon_id):
+        '''Queues a coupon for pre-rendering. Returns False if the queue is full.'''
+        self.ensure_started()
+        with self._lock:
+            if coupon_id in self._pending:
+                return True
+            try:
+                self._queue.put_nowait((coupon_id, 1))
+            except queue.Full:
+                self.stats["rejected"] += 1
+                qr_logger.warning("QR queue is full, coupon %s will be rendered on demand", coupon_id)
+                return False
+            self._pending.add(coupon_id)
+            self.stats["submitted"] += 1
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self._queue.qsize())
+            return True
+
+    def _run(self):
+        while True:
+            coupon_id, attempt = self._queue.get()
+            try:
+                self._render(coupon_id)
+            except Exception:
+                self._retry(coupon_id, attempt)
+            finally:
+                self._queue.task_done()
+
+    def _render(self, coupon_id):
+        get_qr(coupon_id, "png")
+        with self._lock:
+            self._pending.discard(coupon_id)
+            self.stats["rendered"] += 1
+
+    def _retry(self, coupon_id, attempt):
+        if attempt < self.max_attempts:
+            qr_logger.warning("QR render for coupon %s failed (attempt %s), retrying",
+                              coupon_id, attempt, exc_info=True)
+            # Простий backoff: 0.5с, 1с, 2с... Воркер у цей час не бере нових задач
+            time.sleep(0.5 * 2 ** (attempt - 1))
+            try:
+                self._queue.put_nowait((coupon_id, attempt + 1))
+                with self._lock:
+                    self.stats["retried"] += 1
+                return
+            except queue.Full:
+                pass
+
+        qr_logger.error("QR render for coupon %s failed after %s attempt(s)",
+                        coupon_id, attempt, exc_info=True)
+        with self._lock:
+            self._pending.discard(coupon_id)
+            self.stats["failed"] += 1
+
+
+pool = QRWorkerPool(QR_WORKERS, QR_QUEUE_SIZE, QR_MAX_ATTEMPTS)
+
+
+def submit(coupon_id):
+    return pool.submit(coupon_id)
+
+
+def queue_depth():
+    return pool.queue_depth()
+
+
+def drop_stored_files():
+    '''One-off migration: removes legacy PNG files and clears qr_code_path.'''
+    removed = 0
+    for path in glob.glob(os.path.join(QR_DIR, "coupon_*.png")):
+        os.remove(path)
+        removed += 1
+
+    with Session() as db_session:
+        cleared = db_session.execute(
+            update(Coupons).where(Coupons.qr_code_path.is_not(None)).values(qr_code_path=None)
+        ).rowcount
+        db_session.commit()
+
+    return removed, cleared
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Coupon QR code maintenance")
+    parser.add_argument("--drop-stored-files", action="store_true",
+                        help=f"delete legacy {QR_DIR}/coupon_*.png files and clear Coupons.qr_code_path")
+    args = parser.parse_args()
+
+    if args.drop_stored_files:
+        removed, cleared = drop_stored_files()
+        print(f"Removed {removed} file(s), cleared qr_code_path on {cleared} coupon(s)")
+    else:
+        parser.print_help()
@@ -0,0 +1,117 @@
+from collections import Counter
+from contextlib import contextmanager
+import logging
+import os
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from logger_setup import setup_logger
+
+
+budget_logger = setup_logger(
+    "query_budget", "app.log", level_file=logging.INFO, level_console=logging.WARNING)
+
+# off - нічого не рахуємо, warn - пишемо в лог, raise - кидаємо QueryBudgetExceeded.
+# Якщо не задано, то raise під app.testing і off в іншому разі
+QUERY_BUDGET = os.getenv("QUERY_BUDGET")
+# Скільки однакових запитів (різних лише параметрами) за запит вважається N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "3"))
+
+
+class QueryBudgetExceeded(AssertionError):
+    '''A request ran more SQL than its route allows, or repeated a statement N times.'''
+
+
+class QueryLog:
+    __slots__ = ("statements", "exempt")
+
+    def __init__(self):
+        self.statements = Counter()
+        self.exempt = 0
+
+    @property
+    def count(self):
+        return sum(self.statements.values())
+
+    def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+        return [(statement, count) for statement, count in self.statements.items()
+                if count >= threshold]
+
+
+def limit(max_queries):
+    '''Declares the query budget of a route; goes right under @app.route.'''
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+    return decorator
+
+
+def _mode():
+    if QUERY_BUDGET:
+        return QUERY_BUDGET
+    return "raise" if current_app.testing else "off"
+
+
+def _log():
+    return g.get("_query_log")
+
+
+@contextmanager
+def exempt():
+    '''Statements inside don't count: cache refills amortised over many requests.'''
+    query_log = _log() if has_request_context() else None
+    if query_log is None:
+        yield
+        return
+    query_log.exempt += 1
+    try:
+        yield
+    finally:
+        query_log.exempt -= 1
+
+
+def _start_request():
+    if _mode() != "off":
+        g._query_log = QueryLog()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+    query_log = _log()
+    if query_log is not None and not query_log.exempt:
+        # Текст запиту вже параметризований, тож однаковий текст = той самий запит
+        query_log.statements[statement] += 1
+
+
+def violations(query_log, budget):
+    problems = []
+    if budget is not None and query_log.count > budget:
+        problems.append(f"{query_log.count} queries, budget is {budget}")
+    for statement, count in query_log.repeated():
+        problems.append(f"N+1: {count}x {' '.join(statement.split())[:200]}")
+    return problems
+
+
+def _check(response):
+    query_log = _log()
+    if query_log is None:
+        return response
+
+    response.headers["X-Query-Count"] = str(query_log.count)
+    view = current_app.view_functions.get(request.endpoint)
+    problems = violations(query_log, getattr(view, "query_budget", None))
+    if problems:
+        message = f"{request.method} {request.path}: " + "; ".join(problems)
+        if _mode() == "raise":
+            raise QueryBudgetExceeded(message)
+        budget_logger.warning("Query budget exceeded: %s", message)
+    return response
+
+
+def init_app(app, engine):
+    app.before_request(_start_request)
+    app.after_request(_check)
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+
@@ -0,0 +1,67 @@
+from datetime import datetime
+import json
+import sys
+
+from sqlalchemy import select, tuple_
+
+from main_db import Basket, Coupons, Menu, OrderLine, SpecialOffer, engine
+
+
+# Запити, що виконуються на кожному запиті користувача, і індекси, які вони
+# мають використовувати. Вирази повторюють ті, що в main.py / main_db.py
+def hot_queries():
+    now = datetime.now()
+    return [
+        ("basket by user", "ux_basket_user_menu",
+         select(Basket.menu_id, Basket.quantity).where(Basket.user_id == 1)),
+        ("order history page", "ix_coupons_user_time_id",
+         select(Coupons.id).where(Coupons.user_id == 1, tuple_(Coupons.order_time, Coupons.id) < tuple_(now, 1))
+         .order_by(Coupons.order_time.desc(), Coupons.id.desc()).limit(11)),
+        ("order lines of a page", "ix_order_lines_coupon",
+         select(OrderLine.menu_name, OrderLine.quantity).where(OrderLine.coupon_id.in_([1, 2, 3]))),
+        ("expired offers", "ix_special_offers_active_expiration",
+         select(SpecialOffer.menu_id).where(SpecialOffer.active == True, SpecialOffer.expiration_date < now)),
+        ("offers of changed items", "ix_special_offers_menu_id",
+         select(SpecialOffer.id).where(SpecialOffer.active == True, SpecialOffer.menu_id.in_([1, 2]))),
+        ("active menu", "ix_menu_active",
+         select(Menu.id).where(Menu.active == True)),
+    ]
+
+
+def _plan(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect,
+                                 compile_kwargs={"render_postcompile": True})
+    params = compiled.construct_params()
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+
+    if connection.dialect.name == "postgresql":
+        # На маленьких таблицях seq scan дешевший, тож забороняємо його,
+        # щоб перевірити саме те, що індекс придатний для запиту
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", params).scalar()
+        return json.dumps(plan)
+
+    rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+    return "\n".join(row[-1] for row in rows)
+
+
+def check():
+    '''Returns (name, expected_index, plan, ok) for every hot query.'''
+    results = []
+    with engine.connect() as connection:
+        for name, index, statement in hot_queries():
+            plan = _plan(connection, statement)
+            results.append((name, index, plan, index in plan))
+        connection.rollback()
+    return results
+
+
+if __name__ == "__main__":
+    failed = 0
+    for name, index, plan, ok in check():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: expects {index}")
+        if not ok:
+            failed += 1
+            print(f"     plan: {plan}")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,79 @@
+from abc import ABC, abstractmethod
+import os
+import threading
+import time
+
+
+# Вхід: не більше LOGIN_PER_IP спроб з однієї IP і LOGIN_PER_USERNAME на один
+# юзернейм за хвилину (з накопиченням до цієї ж кількості)
+LOGIN_PER_IP = int(os.getenv("LOGIN_RATE_PER_IP", "20"))
+LOGIN_PER_USERNAME = int(os.getenv("LOGIN_RATE_PER_USERNAME", "5"))
+REGISTER_PER_IP = int(os.getenv("REGISTER_RATE_PER_IP", "5"))
+
+
+class BucketStore(ABC):
+    '''Interface of a token-bucket store.
+
+    The in-memory store limits per worker process; a shared implementation
+    (e.g. Redis with a Lua script doing the same arithmetic) can be assigned
+    to rate_limit.store to make limits global.
+    '''
+
+    @abstractmethod
+    def take(self, key, capacity, per_second, cost=1):
+        '''Takes cost tokens from the bucket. Returns (allowed, retry_after_seconds).'''
+
+
+class MemoryBucketStore(BucketStore):
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, per_second, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * per_second)
+
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                allowed, retry_after = True, 0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (cost - tokens) / per_second
+
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return allowed, retry_after
+
+    def _prune(self, now):
+        # Відро, що простояло довше за повне поповнення, нічим не відрізняється від нового
+        stale = [key for key, (_, updated) in self._buckets.items() if now - updated > 3600]
+        for key in stale:
+            del self._buckets[key]
+        if len(self._buckets) > self.max_keys:
+            oldest = sorted(self._buckets.items(), key=lambda item: item[1][1])
+            for key, _ in oldest[:len(self._buckets) - self.max_keys]:
+                del self._buckets[key]
+
+
+store = MemoryBucketStore()
+
+
+def per_minute(key, limit):
+    return store.take(key, limit, limit / 60)
+
+
+def check_login(ip, username):
+    '''Returns seconds to wait, or 0 if this login attempt may proceed.'''
+    waits = [retry_after for allowed, retry_after in (
+        per_minute(f"login-ip:{ip}", LOGIN_PER_IP),
+        per_minute(f"login-user:{username.lower()}", LOGIN_PER_USERNAME),
+    ) if not allowed]
+    return max(waits, default=0)
+
+
+def check_register(ip):
+    allowed, retry_after = per_minute(f"register-ip:{ip}", REGISTER_PER_IP)
+    return 0 if allowed else retry_after
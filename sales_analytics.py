@@ -0,0 +1,297 @@
+from array import array
+from datetime import datetime, timedelta
+import argparse
+import csv
+import os
+
+from sqlalchemy import select
+
+from main_db import OrderLine, engine
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Рядки order_lines читаються серверним курсором пачками по ANALYTICS_BATCH,
+# тож пам'ять залежить лише від розміру пачки та кількості позицій, а не замовлень
+ANALYTICS_BATCH = int(os.getenv("ANALYTICS_BATCH", "10000"))
+WEEK_HOURS = 7 * 24
+
+
+class Batch:
+    '''One chunk of order lines as typed columns.'''
+    __slots__ = ("item", "offer", "quantity", "revenue", "full_price", "discounted", "hour")
+
+    def __init__(self):
+        self.item = array("l")
+        self.offer = array("l")
+        self.quantity = array("l")
+        self.revenue = array("d")
+        self.full_price = array("d")
+        self.discounted = array("b")
+        # година тижня: weekday * 24 + hour
+        self.hour = array("l")
+
+    def __len__(self):
+        return len(self.item)
+
+
+class SalesReport:
+    '''Sales totals per item, per offer (item + discount) and per hour of week.'''
+
+    def __init__(self):
+        self.items = []
+        self.offers = []
+        self._item_codes = {}
+        self._offer_codes = {}
+
+        # Колонки акумуляторів: індекс - код позиції / пропозиції / години тижня
+        self.item_units = []
+        self.item_revenue = []
+        self.item_full_price = []
+        self.item_lines = []
+        self.item_discounted_units = []
+        self.item_discounted_lines = []
+        self.offer_units = []
+        self.offer_revenue = []
+        self.offer_lines = []
+        self.hour_units = [0] * WEEK_HOURS
+        self.hour_revenue = [0.0] * WEEK_HOURS
+        self.lines = 0
+
+    # ===== РОЗКЛАДАННЯ РЯДКІВ У КОЛОНКИ =====
+    def _item_code(self, menu_id, menu_name):
+        key = (menu_id, menu_name)
+        code = self._item_codes.get(key)
+        if code is None:
+            code = self._item_codes[key] = len(self.items)
+            self.items.append(key)
+            for column in (self.item_units, self.item_lines,
+                           self.item_discounted_units, self.item_discounted_lines):
+                column.append(0)
+            self.item_revenue.append(0.0)
+            self.item_full_price.append(0.0)
+        return code
+
+    def _offer_code(self, item_code, discount):
+        key = (item_code, discount)
+        code = self._offer_codes.get(key)
+        if code is None:
+            code = self._offer_codes[key] = len(self.offers)
+            self.offers.append(key)
+            self.offer_units.append(0)
+            self.offer_lines.append(0)
+            self.offer_revenue.append(0.0)
+        return code
+
+    def to_batch(self, rows):
+        '''Splits rows into columns; codes and price factors are looked up once per distinct value.'''
+        batch = Batch()
+        if not rows:
+            return batch
+        menu_ids, menu_names, order_times, quantities, unit_prices, discounts = zip(*rows)
+        discounts = [discount or 0 for discount in discounts]
+
+        keys = list(zip(menu_ids, menu_names, discounts))
+        codes = {}
+        for menu_id, menu_name, discount in dict.fromkeys(keys):
+            item = self._item_code(menu_id, menu_name)
+            codes[menu_id, menu_name, discount] = (item, self._offer_code(item, discount))
+        pairs = [codes[key] for key in keys]
+
+        # unit_price вже зі знижкою; повну ціну відновлюємо з відсотка
+        factors = {discount: 1 / (1 - discount / 100) if discount < 100 else 1
+                   for discount in set(discounts)}
+        revenue = [unit_price * quantity for unit_price, quantity in zip(unit_prices, quantities)]
+
+        batch.item = array("l", [item for item, _ in pairs])
+        batch.offer = array("l", [offer for _, offer in pairs])
+        batch.quantity = array("l", quantities)
+        batch.revenue = array("d", revenue)
+        batch.full_price = array("d", [value * factors[discount]
+                                       for value, discount in zip(revenue, discounts)])
+        batch.discounted = array("b", [1 if discount else 0 for discount in discounts])
+        batch.hour = array("l", [order_time.weekday() * 24 + order_time.hour
+                                 for order_time in order_times])
+        return batch
+
+    # ===== АГРЕГАЦІЯ =====
+    def add(self, batch):
+        if not len(batch):
+            return
+        self.lines += len(batch)
+        if numpy is not None:
+            self._add_vectorized(batch)
+        else:
+            self._add_loop(batch)
+
+    def _add_vectorized(self, batch):
+        # array("l") має розмір long платформи, тож dtype беремо з itemsize
+        codes = numpy.dtype(f"i{batch.item.itemsize}")
+        item = numpy.frombuffer(batch.item, dtype=codes)
+        offer = numpy.frombuffer(batch.offer, dtype=codes)
+        hour = numpy.frombuffer(batch.hour, dtype=codes)
+        quantity = numpy.frombuffer(batch.quantity, dtype=codes).astype(numpy.float64)
+        revenue = numpy.frombuffer(batch.revenue, dtype=numpy.float64)
+        full_price = numpy.frombuffer(batch.full_price, dtype=numpy.float64)
+        discounted = numpy.frombuffer(batch.discounted, dtype=numpy.int8).astype(numpy.float64)
+
+        def group_sum(codes, size, weights=None):
+            return numpy.bincount(codes, weights=weights, minlength=size)
+
+        items, offers = len(self.items), len(self.offers)
+        sums = (
+            (self.item_units, group_sum(item, items, quantity)),
+            (self.item_revenue, group_sum(item, items, revenue)),
+            (self.item_full_price, group_sum(item, items, full_price)),
+            (self.item_lines, group_sum(item, items)),
+            (self.item_discounted_units, group_sum(item, items, quantity * discounted)),
+            (self.item_discounted_lines, group_sum(item, items, discounted)),
+            (self.offer_units, group_sum(offer, offers, quantity)),
+            (self.offer_revenue, group_sum(offer, offers, revenue)),
+            (self.offer_lines, group_sum(offer, offers)),
+            (self.hour_units, group_sum(hour, WEEK_HOURS, quantity)),
+            (self.hour_revenue, group_sum(hour, WEEK_HOURS, revenue)),
+        )
+        for column, values in sums:
+            for code in numpy.flatnonzero(values):
+                value = values[code]
+                column[code] += int(value) if isinstance(column[code], int) else float(value)
+
+    def _add_loop(self, batch):
+        for index in range(len(batch)):
+            item, offer, hour = batch.item[index], batch.offer[index], batch.hour[index]
+            quantity, revenue = batch.quantity[index], batch.revenue[index]
+            self.item_units[item] += quantity
+            self.item_revenue[item] += revenue
+            self.item_full_price[item] += batch.full_price[index]
+            self.item_lines[item] += 1
+            if batch.discounted[index]:
+                self.item_discounted_units[item] += quantity
+                self.item_discounted_lines[item] += 1
+            self.offer_units[offer] += quantity
+            self.offer_revenue[offer] += revenue
+            self.offer_lines[offer] += 1
+            self.hour_units[hour] += quantity
+            self.hour_revenue[hour] += revenue
+
+    # ===== РЕЗУЛЬТАТИ =====
+    def item_rows(self):
+        '''Per item: units, revenue, discount cost and uplift.
+
+        uplift compares average units per order line bought with a discount
+        against those bought at full price (0.25 = +25%); None if either
+        side has no sales.
+        '''
+        rows = []
+        for code, (menu_id, menu_name) in enumerate(self.items):
+            full_units = self.item_units[code] - self.item_discounted_units[code]
+            full_lines = self.item_lines[code] - self.item_discounted_lines[code]
+            uplift = None
+            if full_lines and full_units and self.item_discounted_lines[code]:
+                discounted_avg = self.item_discounted_units[code] / self.item_discounted_lines[code]
+                uplift = round(discounted_avg / (full_units / full_lines) - 1, 4)
+            rows.append({
+                "menu_id": menu_id, "menu_name": menu_name,
+                "units": self.item_units[code],
+                "revenue": round(self.item_revenue[code], 2),
+                "discounted_units": self.item_discounted_units[code],
+                "discount_cost": round(self.item_full_price[code] - self.item_revenue[code], 2),
+                "uplift": uplift,
+            })
+        return sorted(rows, key=lambda row: row["revenue"], reverse=True)
+
+    def offer_rows(self):
+        rows = []
+        for code, (item, discount) in enumerate(self.offers):
+            menu_id, menu_name = self.items[item]
+            rows.append({
+                "menu_id": menu_id, "menu_name": menu_name, "discount": discount,
+                "lines": self.offer_lines[code], "units": self.offer_units[code],
+                "revenue": round(self.offer_revenue[code], 2),
+            })
+        return sorted(rows, key=lambda row: (row["menu_name"], row["discount"]))
+
+    def hour_rows(self):
+        return [{
+            "weekday": hour // 24, "hour": hour % 24,
+            "units": self.hour_units[hour], "revenue": round(self.hour_revenue[hour], 2),
+        } for hour in range(WEEK_HOURS)]
+
+    def heatmap(self):
+        '''Units sold as 7 rows (Monday first) of 24 hourly cells.'''
+        return [self.hour_units[day * 24:(day + 1) * 24] for day in range(7)]
+
+    def as_dict(self):
+        return {
+            "lines": self.lines,
+            "items": self.item_rows(),
+            "offers": self.offer_rows(),
+            "heatmap": self.heatmap(),
+        }
+
+
+def build_report(since=None, until=None, batch_size=ANALYTICS_BATCH):
+    '''Streams order_lines in [since, until) and aggregates them batch by batch.'''
+    statement = select(OrderLine.menu_id, OrderLine.menu_name, OrderLine.order_time,
+                       OrderLine.quantity, OrderLine.unit_price, OrderLine.discount)
+    if since is not None:
+        statement = statement.where(OrderLine.order_time >= since)
+    if until is not None:
+        statement = statement.where(OrderLine.order_time < until)
+
+    report = SalesReport()
+    # stream_results - серверний курсор у Postgres, рядки не вантажаться всі одразу
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size) \
+            .execute(statement)
+        for rows in result.partitions(batch_size):
+            report.add(report.to_batch(rows))
+    return report
+
+
+# ===== ЕКСПОРТ =====
+def _write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["empty"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def export(report, directory, file_format="csv"):
+    '''Writes items, offers and hours tables; returns the written paths.'''
+    if file_format == "parquet":
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("pyarrow is not installed, exporting CSV instead")
+            file_format = "csv"
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, rows in (("items", report.item_rows()), ("offers", report.offer_rows()),
+                       ("hours", report.hour_rows())):
+        path = os.path.join(directory, f"{name}.{file_format}")
+        if file_format == "parquet":
+            pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+        else:
+            _write_csv(path, rows)
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export sales analytics")
+    parser.add_argument("--days", type=int, help="only the last N days (all time by default)")
+    parser.add_argument("--out", default="analytics", help="output directory")
+    parser.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    args = parser.parse_args()
+
+    since = datetime.now() - timedelta(days=args.days) if args.days else None
+    report = build_report(since)
+    for path in export(report, args.out, args.format):
+        print(f"Written {path}")
+    print(f"{report.lines} order lines aggregated")
@@ -0,0 +1,158 @@
+import multiprocessing
+import os
+import threading
+
+from dotenv import load_dotenv
+
+
+# Продакшн-запуск: python3 serve.py (або gunicorn -c serve.py main:app).
+# Застосунок вантажиться один раз у майстрі (preload), прогрівається і
+# лише потім форкається на воркери - кожен з потоками gthread
+load_dotenv()
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = int(os.getenv("WEB_TIMEOUT", "30"))
+# Скільки воркер чекає на незавершені запити після SIGTERM
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+# Перезапуск воркера після N запитів (0 - ніколи), з розкидом, щоб не всі разом
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "100"))
+preload_app = True
+wsgi_app = "main:app"
+
+# Маршрути, які воркер дочікується перед виходом, навіть при швидкій зупинці
+DRAIN_ENDPOINTS = {"checkout"}
+
+
+class InFlight:
+    '''Counts running requests to DRAIN_ENDPOINTS so shutdown can wait for them.'''
+
+    def __init__(self):
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def start(self):
+        with self._condition:
+            self._count += 1
+
+    def finish(self):
+        with self._condition:
+            self._count -= 1
+            self._condition.notify_all()
+
+    def wait(self, seconds):
+        '''Returns True once nothing is in flight, False after the timeout.'''
+        with self._condition:
+            return self._condition.wait_for(lambda: self._count == 0, seconds)
+
+    def reset(self):
+        self._count = 0
+        self._condition = threading.Condition()
+
+
+in_flight = InFlight()
+
+
+def track_in_flight(app):
+    from flask import g, request
+
+    @app.before_request
+    def start_tracking():
+        if request.endpoint in DRAIN_ENDPOINTS:
+            g._in_flight = True
+            in_flight.start()
+
+    @app.teardown_request
+    def finish_tracking(error):
+        if g.pop("_in_flight", False):
+            in_flight.finish()
+
+
+def warmup(app):
+    '''Loads everything workers would otherwise build on their first requests.'''
+    import catalog_cache
+    import menu_images
+    import pricing
+    from main_db import engine
+
+    # Усі шаблони компілюються один раз у майстрі й успадковуються воркерами
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    catalog = catalog_cache.get_catalog()
+    pricing.get_price_table()
+    for item in catalog.items:
+        menu_images.menu_image(item.file_name)
+
+    # З'єднання майстра не мають потрапити у воркери
+    engine.dispose()
+
+
+# ===== ХУКИ GUNICORN =====
+def when_ready(server):
+    app = server.app.wsgi()
+    track_in_flight(app)
+    warmup(app)
+    server.log.info("App preloaded and warmed up, forking %s worker(s)", server.cfg.workers)
+
+
+def post_fork(server, worker):
+    from main_db import engine
+
+    # Пул з'єднань, скопійований з майстра, воркер не використовує і не закриває
+    engine.dispose(close=False)
+    in_flight.reset()
+
+
+def worker_int(worker):
+    # SIGINT/SIGQUIT - швидка зупинка, але почате оформлення замовлення
+    # дочікуємо (запити gthread виконуються в інших потоках)
+    if not in_flight.wait(graceful_timeout):
+        worker.log.warning("Stopping with checkouts still in flight")
+
+
+def worker_exit(server, worker):
+    from main_db import engine
+
+    in_flight.wait(graceful_timeout)
+    engine.dispose()
+
+
+def _serve_without_gunicorn():
+    # Windows: gunicorn там не працює, тож waitress (якщо встановлено) або
+    # вбудований багатопотоковий сервер werkzeug без перезавантажувача
+    from main import app
+
+    track_in_flight(app)
+    warmup(app)
+    host, _, port = bind.rpartition(":")
+    try:
+        import waitress
+    except ImportError:
+        print("gunicorn/waitress are not installed, using the werkzeug server")
+        app.run(host=host, port=int(port), threaded=True, debug=False, use_reloader=False)
+        return
+    waitress.serve(app, host=host, port=int(port), threads=threads)
+
+
+if __name__ == "__main__":
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        _serve_without_gunicorn()
+    else:
+        class ServeApplication(BaseApplication):
+            def load_config(self):
+                for key, value in globals().items():
+                    if key in self.cfg.settings and value is not None:
+                        self.cfg.set(key, value)
+
+            def load(self):
+                from main import app
+                return app
+
+        ServeApplication().run()
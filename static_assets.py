@@ -0,0 +1,212 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+
+STATIC_FOLDER = "static"
+BUILD_DIR = ".static_build"
+MANIFEST_PATH = os.path.join(BUILD_DIR, "manifest.json")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Файли без хешу в імені (наприклад, старі посилання) кешуються коротко
+REVALIDATE = "public, max-age=300"
+
+# Фото меню вже лежать під content-hash іменами в blob_store і змінюються
+# в рантаймі, тому в маніфест їх не додаємо
+SKIP_DIRS = ("menu/",)
+COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".map", ".txt")
+CONTENT_HASHED = re.compile(r"(^|/)[0-9a-f]{16,64}[.-]")
+
+mimetypes.add_type("font/woff2", ".woff2")
+
+# Latin + Latin-1, знаки пунктуації, ₴ (U+20B4) та вся кирилиця з доповненням
+FONT_UNICODES = (
+    list(range(0x0000, 0x0100)) + list(range(0x2000, 0x2070)) +
+    [0x20AC, 0x20B4, 0x2116, 0x2122, 0x2212] +
+    list(range(0x0400, 0x0530))
+)
+
+
+def fingerprint(path, data):
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    stem, extension = os.path.splitext(path)
+    return f"{stem}.{digest}{extension}"
+
+
+def _walk(root):
+    for directory, _, files in os.walk(root):
+        for file_name in files:
+            path = os.path.join(directory, file_name)
+            yield os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def _source_path(logical):
+    built = os.path.join(BUILD_DIR, logical)
+    return built if os.path.isfile(built) else os.path.join(STATIC_FOLDER, logical)
+
+
+def _hash_all():
+    manifest = {}
+    logical_paths = set(_walk(STATIC_FOLDER))
+    if os.path.isdir(BUILD_DIR):
+        logical_paths.update(path for path in _walk(BUILD_DIR)
+                             if not path.endswith((".gz", ".br")) and path != "manifest.json")
+
+    for logical in sorted(logical_paths):
+        if logical.startswith(SKIP_DIRS):
+            continue
+        with open(_source_path(logical), "rb") as f:
+            manifest[logical] = fingerprint(logical, f.read())
+    return manifest
+
+
+# ===== КРОК ЗБІРКИ =====
+def _build_fonts():
+    try:
+        from fontTools import subset
+    except ImportError:
+        print("fontTools is not installed, fonts are served as TTF")
+        return
+
+    options = subset.Options()
+    options.flavor = "woff2"
+    options.layout_features = ["*"]
+    for logical in _walk(STATIC_FOLDER):
+        if not logical.endswith(".ttf"):
+            continue
+        font = subset.load_font(os.path.join(STATIC_FOLDER, logical), options)
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(unicodes=FONT_UNICODES)
+        subsetter.subset(font)
+
+        target = os.path.join(BUILD_DIR, os.path.splitext(logical)[0] + ".woff2")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        subset.save_font(font, target, options)
+        print(f"{logical} -> {os.path.relpath(target, BUILD_DIR)}")
+
+
+_CSS_URL = re.compile(r"url\((['\"]?)/static/([^'\")]+)\1\)(\s*format\((['\"])truetype\4\))?")
+
+
+def _build_css(manifest):
+    def rewrite(match):
+        logical = match.group(2)
+        woff2 = os.path.splitext(logical)[0] + ".woff2"
+        if logical.endswith(".ttf") and woff2 in manifest:
+            return f"url('/static/{manifest[woff2]}') format('woff2')"
+        if logical in manifest:
+            return match.group(0).replace(f"/static/{logical}", f"/static/{manifest[logical]}")
+        return match.group(0)
+
+    for logical in _walk(STATIC_FOLDER):
+        if not logical.endswith(".css") or logical.startswith("css-bootstrap/"):
+            continue
+        with open(os.path.join(STATIC_FOLDER, logical), encoding="utf-8") as f:
+            css = f.read()
+        rewritten = _CSS_URL.sub(rewrite, css)
+        if rewritten != css:
+            target = os.path.join(BUILD_DIR, logical)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "w", encoding="utf-8") as f:
+                f.write(rewritten)
+
+
+def _build_compressed(manifest):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print("brotli is not installed, only gzip variants are built")
+
+    for logical in manifest:
+        if not logical.endswith(COMPRESSIBLE):
+            continue
+        with open(_source_path(logical), "rb") as f:
+            data = f.read()
+        target = os.path.join(BUILD_DIR, logical)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target + ".gz", "wb") as f:
+            f.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli:
+            with open(target + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+
+
+def build():
+    '''Subsets fonts, rewrites CSS urls, precompresses and writes the manifest.'''
+    shutil.rmtree(BUILD_DIR, ignore_errors=True)
+    os.makedirs(BUILD_DIR)
+    _build_fonts()
+    # CSS посилається на шрифти, тому спершу хешуємо все інше, потім
+    # переписуємо CSS і рахуємо маніфест ще раз уже з новими CSS
+    _build_css(_hash_all())
+    manifest = _hash_all()
+    _build_compressed(manifest)
+
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+# ===== РАНТАЙМ =====
+def load_manifest():
+    '''Reads the build manifest, or hashes static/ in memory if there is none.'''
+    try:
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _hash_all()
+
+
+def init_app(app):
+    '''Makes url_for('static', ...) emit fingerprinted URLs and serves them.'''
+    manifest = load_manifest()
+    reverse = {fingerprinted: logical for logical, fingerprinted in manifest.items()}
+
+    @app.url_defaults
+    def fingerprint_static(endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = manifest.get(values["filename"], values["filename"])
+
+    def serve_static(filename):
+        logical = reverse.get(filename)
+        immutable = logical is not None or CONTENT_HASHED.search(filename) is not None
+        logical = logical or filename
+
+        response = None
+        accepted = request.accept_encodings
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            compressed = safe_join(BUILD_DIR, logical + suffix)
+            if accepted[encoding] and compressed and os.path.isfile(compressed):
+                response = send_from_directory(
+                    os.path.abspath(BUILD_DIR), logical + suffix,
+                    mimetype=mimetypes.guess_type(logical)[0] or "application/octet-stream")
+                response.headers["Content-Encoding"] = encoding
+                break
+
+        if response is None:
+            built = safe_join(BUILD_DIR, logical)
+            directory = BUILD_DIR if built and os.path.isfile(built) else app.static_folder
+            response = send_from_directory(os.path.abspath(directory), logical)
+
+        response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = IMMUTABLE if immutable else REVALIDATE
+        return response
+
+    app.view_functions["static"] = serve_static
+    return manifest
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["build"]:
+        print("Usage: python static_assets.py build")
+        sys.exit(1)
+    print(f"Fingerprinted {len(build())} static file(s) into {MANIFEST_PATH}")
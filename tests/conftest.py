@@ -0,0 +1,68 @@
+import os
+import random
+import re
+import tempfile
+
+import pytest
+
+import benchmark
+
+
+# Застосунок читає налаштування під час імпорту, тож БД і середовище
+# задаються до першого імпорту main / main_db: окремий SQLite-файл на прогін
+# тестів і ті ж налаштування, що й у benchmark.py (дешевий bcrypt, без лімітів
+# входу, QUERY_BUDGET=raise)
+benchmark.configure(f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='coffee-tests-'), 'test.sqlite')}")
+
+
+@pytest.fixture(scope="session")
+def menu_names():
+    return benchmark.seed(users=5, menu_items=6, offers=2, coupons_per_user=3, rng=random.Random(7))
+
+
+@pytest.fixture(scope="session")
+def app(menu_names):
+    from main import app
+
+    app.testing = True
+    return app
+
+
+@pytest.fixture
+def position(menu_names):
+    '''A fresh active menu item; it and its offers are deleted after the test.'''
+    import catalog_cache
+    from main_db import Menu, Session, SpecialOffer
+
+    with Session() as db_session:
+        item = Menu(name="Test latte", weight="250 мл", ingredients="кава, молоко",
+                    description="", price=80, active=True, file_name="test.png")
+        db_session.add(item)
+        db_session.commit()
+    yield item
+    with Session() as db_session:
+        db_session.query(SpecialOffer).filter_by(menu_id=item.id).delete()
+        db_session.query(Menu).filter_by(id=item.id).delete()
+        db_session.commit()
+    catalog_cache.refresh([item.id])
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def csrf_token(client):
+    with client.session_transaction() as session:
+        return session["csrf_token"]
+
+
+def login(client, username):
+    client.get("/login")
+    response = client.post("/login", data={
+        "csrf_token": csrf_token(client), "username": username, "password": benchmark.PASSWORD})
+    assert response.status_code == 302
+
+
+def idempotency_key(page):
+    return re.search(r'name="idempotency_key" value="([^"]+)"', page.get_data(as_text=True)).group(1)
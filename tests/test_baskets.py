@@ -0,0 +1,104 @@
+import pytest
+
+import baskets
+from conftest import csrf_token, login
+from main_db import Basket, Session, Users
+
+
+USERNAME = "user00004"
+
+
+def user_id():
+    with Session() as db_session:
+        return db_session.query(Users.id).filter_by(username=USERNAME).scalar()
+
+
+def stored_basket():
+    with Session() as db_session:
+        return dict(db_session.query(Basket.menu_id, Basket.quantity).filter_by(user_id=user_id()).all())
+
+
+def menu_id(app, name):
+    import catalog_cache
+
+    with app.app_context():
+        return catalog_cache.get_catalog().get_active(name).id
+
+
+@pytest.fixture
+def empty_basket(app):
+    with Session() as db_session:
+        db_session.query(Basket).filter_by(user_id=user_id()).delete()
+        db_session.commit()
+
+
+@pytest.fixture
+def shopper(empty_basket, client):
+    login(client, USERNAME)
+    return client
+
+
+def add(client, name, quantity):
+    return client.post(f"/position/{name}", data={
+        "csrf_token": csrf_token(client), "name": name, "quantity": quantity})
+
+
+@pytest.mark.parametrize("quantity", ["0", "-2", "abc"])
+def test_route_rejects_non_positive_quantity(app, shopper, menu_names, quantity):
+    assert add(shopper, menu_names[0], 2).status_code == 302
+
+    assert add(shopper, menu_names[0], quantity).status_code == 400
+    assert stored_basket() == {menu_id(app, menu_names[0]): 2}
+
+
+@pytest.mark.parametrize("quantity", [0, -1])
+def test_upsert_ignores_non_positive_quantity(app, empty_basket, menu_names, quantity):
+    item = menu_id(app, menu_names[0])
+    with Session() as db_session:
+        assert Basket.add_capped(db_session, user_id(), item, 2, 10, 10) == 2
+        assert Basket.add_capped(db_session, user_id(), item, quantity, 10, 10) is None
+        assert Basket.add_capped(db_session, user_id(), menu_id(app, menu_names[1]), quantity, 10, 10) is None
+    assert stored_basket() == {item: 2}
+
+
+def test_session_basket_rejects_non_positive_quantity():
+    basket = baskets.SessionBasket({}, {"user_id": 0, "items": {"1": 2}})
+    with pytest.raises(baskets.BasketLimitError):
+        basket.add(None, 1, 0)
+
+
+def flashes(client):
+    with client.session_transaction() as session:
+        return session.get("_flashes", [])
+
+
+def test_update_over_the_cap_is_reported(app, shopper, menu_names):
+    add(shopper, menu_names[0], 4)
+    add(shopper, menu_names[1], 4)
+    item = menu_id(app, menu_names[0])
+
+    response = shopper.post("/update_quantity", data={
+        "csrf_token": csrf_token(shopper), "menu_id": item, "quantity": 7})
+
+    assert response.status_code == 302
+    assert stored_basket()[item] == 4
+    assert flashes(shopper)[-1][0] == "danger"
+
+
+def test_login_merges_session_and_stored_baskets(app, empty_basket, client, menu_names):
+    first, second, third = (menu_id(app, name) for name in menu_names[:3])
+    with Session() as db_session:
+        db_session.add_all([Basket(user_id=user_id(), menu_id=first, quantity=1),
+                            Basket(user_id=user_id(), menu_id=second, quantity=3)])
+        db_session.commit()
+    # Кошик, зібраний у цьому браузері до того, як юзер знову увійшов
+    with client.session_transaction() as session:
+        session["basket"] = {"user_id": user_id(), "items": {str(first): 2, str(third): 9}}
+
+    login(client, USERNAME)
+
+    # Більша кількість перемагає, а результат обрізається до MAX_UNITS у порядку кошика
+    expected = {first: 2, second: 3, third: baskets.MAX_UNITS - 5}
+    assert stored_basket() == expected
+    with client.session_transaction() as session:
+        assert {int(key): quantity for key, quantity in session["basket"]["items"].items()} == expected
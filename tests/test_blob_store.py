@@ -0,0 +1,182 @@
+from datetime import datetime, timezone
+from io import BytesIO
+import hashlib
+import os
+import threading
+
+from PIL import Image
+import pytest
+
+import blob_store
+from conftest import csrf_token, login
+
+
+class StandInClientError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class StandInS3Client:
+    '''In-memory stand-in for the subset of the boto3 S3 client ObjectStoreBackend uses.'''
+
+    class exceptions:
+        ClientError = StandInClientError
+
+        class NoSuchKey(StandInClientError):
+            def __init__(self):
+                super().__init__("NoSuchKey")
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = 0
+        self.head_error = None
+
+    def put_object(self, Bucket, Key, Body, CacheControl):
+        self.puts += 1
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.objects[(Bucket, Key)] = (data, datetime.now(timezone.utc))
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        return {"Body": BytesIO(self.objects[(Bucket, Key)][0])}
+
+    def head_object(self, Bucket, Key):
+        if self.head_error:
+            raise StandInClientError(self.head_error)
+        if (Bucket, Key) not in self.objects:
+            raise StandInClientError("404")
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    def get_paginator(self, name):
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {"Contents": [{"Key": key, "LastModified": modified}
+                                    for (bucket, key), (_, modified) in sorted(client.objects.items())
+                                    if bucket == Bucket and key.startswith(Prefix)]}
+        return Paginator()
+
+
+class Upload:
+    def __init__(self, data, filename):
+        self.stream = BytesIO(data)
+        self.filename = filename
+
+
+@pytest.fixture
+def s3():
+    return StandInS3Client()
+
+
+@pytest.fixture(params=["local", "s3"])
+def backend(request, tmp_path, s3, monkeypatch):
+    if request.param == "local":
+        store = blob_store.LocalBlobBackend(str(tmp_path / "menu"), static_folder=str(tmp_path))
+    else:
+        store = blob_store.ObjectStoreBackend(s3, "menu", "http://minio.local/menu/")
+    monkeypatch.setattr(blob_store, "backend", store)
+    return store
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        blob_store.BlobBackend()
+
+
+def test_round_trip(backend):
+    backend.put_bytes("derived/a.webp", b"webp")
+    backend.put_bytes("b.png", b"png")
+
+    assert backend.get_bytes("b.png") == b"png"
+    assert backend.get_bytes("missing.png") is None
+    assert backend.exists("derived/a.webp")
+    assert [key for key, _ in backend.list_keys("derived/")] == ["derived/a.webp"]
+
+    backend.delete("b.png")
+    backend.delete("b.png")
+    assert not backend.exists("b.png")
+
+
+def test_identical_uploads_share_one_blob(backend):
+    first_key, first_path = blob_store.spool_upload(Upload(b"latte" * 1000, "Latte.PNG"))
+    second_key, second_path = blob_store.spool_upload(Upload(b"latte" * 1000, "copy.png"))
+
+    assert first_key == second_key
+    assert first_key.endswith(".png")
+    assert blob_store.commit_upload(first_key, first_path)
+    assert not blob_store.commit_upload(second_key, second_path)
+    assert backend.get_bytes(first_key) == b"latte" * 1000
+    os.remove(first_path)
+    os.remove(second_path)
+
+
+def test_object_store_url(s3):
+    store = blob_store.ObjectStoreBackend(s3, "menu", "http://minio.local/menu/")
+    assert store.url("derived/a.webp") == "http://minio.local/menu/derived/a.webp"
+
+
+@pytest.mark.parametrize("code", ["AccessDenied", "SlowDown"])
+def test_object_store_exists_raises_on_other_errors(s3, code, monkeypatch):
+    store = blob_store.ObjectStoreBackend(s3, "menu", "http://minio.local/menu")
+    monkeypatch.setattr(blob_store, "backend", store)
+    s3.head_error = code
+
+    with pytest.raises(StandInClientError):
+        store.exists("a.png")
+    with pytest.raises(StandInClientError):
+        blob_store.commit_upload("a.png", __file__)
+    assert s3.puts == 0
+
+
+def test_release_waits_for_an_upload_of_the_same_image(app, tmp_path, monkeypatch):
+    import catalog_cache
+    import menu_images
+    from main_db import Menu, Session
+
+    store = blob_store.LocalBlobBackend(str(tmp_path / "menu"), static_folder=str(tmp_path))
+    monkeypatch.setattr(blob_store, "backend", store)
+    buffer = BytesIO()
+    Image.new("RGBA", (64, 64), "brown").save(buffer, format="PNG")
+    image = buffer.getvalue()
+    # Блоб лишився від щойно видаленої позиції, рядків Menu на нього немає
+    key = blob_store.key_for(hashlib.sha256(image).hexdigest(), "latte.png")
+    store.put_bytes(key, image)
+
+    admin = app.test_client()
+    login(admin, "admin")
+    responses = []
+    upload = threading.Thread(target=lambda: responses.append(admin.post("/add_position/add", data={
+        "csrf_token": csrf_token(admin), "name": "Race latte", "ingredients": "кава",
+        "description": "", "price": "50", "weight": "250 мл", "img": (BytesIO(image), "latte.png"),
+    }, content_type="multipart/form-data")))
+
+    delete_derivatives = menu_images.delete_derivatives
+
+    def delete_while_uploading(file_name):
+        # release вже вирішив, що блоб нікому не потрібен; без блокування
+        # завантаження за цей час побачило б exists() і пропустило put
+        upload.start()
+        upload.join(timeout=0.5)
+        delete_derivatives(file_name)
+
+    monkeypatch.setattr(menu_images, "delete_derivatives", delete_while_uploading)
+    with Session() as db_session:
+        blob_store.release([key], db_session)
+    upload.join()
+
+    with Session() as db_session:
+        position = db_session.query(Menu).filter_by(name="Race latte").one()
+        db_session.delete(position)
+        db_session.commit()
+    with app.app_context():
+        catalog_cache.refresh([position.id])
+
+    assert responses[0].status_code == 302
+    assert position.file_name == key
+    assert store.get_bytes(key) == image
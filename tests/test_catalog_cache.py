@@ -0,0 +1,61 @@
+from sqlalchemy import update
+
+import catalog_cache
+from main_db import Menu, Session
+
+
+def set_price(menu_id, price):
+    with Session() as db_session:
+        db_session.execute(update(Menu).where(Menu.id == menu_id).values(price=price))
+        db_session.commit()
+
+
+def test_snapshot_is_reused_until_refreshed(position):
+    catalog_cache.invalidate()
+    catalog = catalog_cache.get_catalog()
+    assert catalog_cache.get_catalog() is catalog
+
+    set_price(position.id, 95)
+    # Зміна в БД без refresh не видна до CATALOG_TTL
+    assert catalog_cache.get_catalog().by_id[position.id].price == 80
+
+    catalog_cache.refresh([position.id])
+    assert catalog_cache.get_catalog().by_id[position.id].price == 95
+
+
+def test_refresh_patches_only_the_given_items(position, menu_names):
+    catalog_cache.invalidate()
+    before = catalog_cache.get_catalog()
+    other = before.get_active(menu_names[0])
+
+    set_price(position.id, 120)
+    catalog_cache.refresh([position.id])
+    after = catalog_cache.get_catalog()
+
+    assert after.version > before.version
+    assert after.parent_version == before.version
+    assert after.changed_ids == {position.id}
+    assert after.by_id[position.id].price == 120
+    # Незмінені позиції - ті самі об'єкти, без повторного читання з БД
+    assert after.get_active(menu_names[0]) is other
+    assert [item.id for item in after.items] == sorted(item.id for item in after.items)
+
+
+def test_refresh_drops_deactivated_and_deleted_items(position):
+    catalog_cache.invalidate()
+    catalog_cache.get_catalog()
+
+    with Session() as db_session:
+        db_session.execute(update(Menu).where(Menu.id == position.id).values(active=False))
+        db_session.commit()
+    catalog_cache.refresh([position.id])
+    catalog = catalog_cache.get_catalog()
+    assert catalog.get_active(position.name) is None
+    assert position.id in catalog.by_id
+    assert all(item.id != position.id for item in catalog.active_positions)
+
+    with Session() as db_session:
+        db_session.query(Menu).filter_by(id=position.id).delete()
+        db_session.commit()
+    catalog_cache.refresh([position.id])
+    assert position.id not in catalog_cache.get_catalog().by_id
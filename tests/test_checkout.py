@@ -0,0 +1,117 @@
+import pytest
+
+from conftest import csrf_token, idempotency_key, login
+from main_db import Basket, Coupons, OrderLine, Session, Users
+
+
+USERNAME = "user00003"
+
+
+def user_id():
+    with Session() as db_session:
+        return db_session.query(Users.id).filter_by(username=USERNAME).scalar()
+
+
+def stored_basket():
+    with Session() as db_session:
+        return dict(db_session.query(Basket.menu_id, Basket.quantity).filter_by(user_id=user_id()).all())
+
+
+def coupon_count():
+    with Session() as db_session:
+        return db_session.query(Coupons).filter_by(user_id=user_id()).count()
+
+
+def menu_id(app, name):
+    import catalog_cache
+
+    with app.app_context():
+        return catalog_cache.get_catalog().get_active(name).id
+
+
+@pytest.fixture
+def shopper(app, client):
+    with Session() as db_session:
+        db_session.query(Basket).filter_by(user_id=user_id()).delete()
+        db_session.commit()
+    login(client, USERNAME)
+    return client
+
+
+def add(client, name, quantity=1):
+    response = client.post(f"/position/{name}", data={
+        "csrf_token": csrf_token(client), "name": name, "quantity": quantity})
+    assert response.status_code == 302
+
+
+def checkout(client, key):
+    return client.post("/checkout", data={"csrf_token": csrf_token(client), "idempotency_key": key})
+
+
+def session_items(client):
+    with client.session_transaction() as session:
+        return dict(session["basket"]["items"])
+
+
+def test_same_key_places_one_order(shopper, menu_names):
+    add(shopper, menu_names[0])
+    key = idempotency_key(shopper.get("/checkout"))
+    before = coupon_count()
+
+    assert checkout(shopper, key).status_code == 302
+    assert checkout(shopper, key).status_code == 302
+
+    assert coupon_count() == before + 1
+    assert stored_basket() == {}
+
+
+def test_order_is_built_from_the_stored_basket(app, shopper, menu_names):
+    add(shopper, menu_names[0])
+    key = idempotency_key(shopper.get("/checkout"))
+
+    # Інший пристрій того ж юзера змінює кошик; сесія першого про це не знає
+    other = app.test_client()
+    login(other, USERNAME)
+    first, second = menu_id(app, menu_names[0]), menu_id(app, menu_names[1])
+    other.post("/update_quantity", data={"csrf_token": csrf_token(other), "menu_id": first, "quantity": 3})
+    add(other, menu_names[1], 2)
+    assert session_items(shopper) == {str(first): 1}
+
+    assert checkout(shopper, key).status_code == 302
+
+    with Session() as db_session:
+        coupon = db_session.query(Coupons).filter_by(user_id=user_id(), idempotency_key=key).one()
+        lines = {line.menu_id: line.quantity
+                 for line in db_session.query(OrderLine).filter_by(coupon_id=coupon.id)}
+    assert lines == {first: 3, second: 2}
+    assert stored_basket() == {}
+    assert session_items(shopper) == {}
+
+
+def test_resubmitted_key_keeps_items_added_later(app, shopper, menu_names):
+    add(shopper, menu_names[0])
+    key = idempotency_key(shopper.get("/checkout"))
+    checkout(shopper, key)
+
+    add(shopper, menu_names[1])
+    assert checkout(shopper, key).status_code == 302
+
+    expected = {menu_id(app, menu_names[1]): 1}
+    assert stored_basket() == expected
+    assert {int(key): quantity for key, quantity in session_items(shopper).items()} == expected
+
+
+def test_empty_stored_basket_is_not_ordered(app, shopper, menu_names):
+    add(shopper, menu_names[0])
+    key = idempotency_key(shopper.get("/checkout"))
+    with Session() as db_session:
+        db_session.query(Basket).filter_by(user_id=user_id()).delete()
+        db_session.commit()
+    before = coupon_count()
+
+    response = checkout(shopper, key)
+
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/basket")
+    assert coupon_count() == before
+    assert session_items(shopper) == {}
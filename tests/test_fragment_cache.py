@@ -0,0 +1,71 @@
+from sqlalchemy import update
+
+import catalog_cache
+from conftest import login
+import fragment_cache
+from main_db import Menu, Session
+
+
+def test_fragment_renders_once_per_version():
+    fragment_cache.clear()
+    calls = []
+
+    def card(name):
+        calls.append(name)
+        return f"<b>{name}</b>"
+
+    assert fragment_cache.fragment("card", 1, 7, card, "Latte") == "<b>Latte</b>"
+    assert fragment_cache.fragment("card", 1, 7, card, "Mocha") == "<b>Latte</b>"
+    # Нова версія каталогу - нова розмітка
+    assert fragment_cache.fragment("card", 2, 7, card, "Mocha") == "<b>Mocha</b>"
+    assert calls == ["Latte", "Mocha"]
+
+
+def test_lru_evicts_the_least_recently_used():
+    cache = fragment_cache.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c"), len(cache)) == (1, 3, 2)
+
+
+def test_anonymous_page_revalidates_against_the_catalog(client, position):
+    fragment_cache.clear()
+    catalog_cache.refresh([position.id])
+    first = client.get("/menu")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    assert client.get("/menu", headers={"If-None-Match": etag}).status_code == 304
+
+    # Каталог перебудовано без змін: сторінку рендеримо знову, але ETag і
+    # Last-Modified лишаються від попередньої версії
+    page = fragment_cache.pages.get(("menu", "/menu", fragment_cache.LOCALE))
+    catalog_cache.invalidate()
+    assert client.get("/menu", headers={"If-None-Match": etag}).status_code == 304
+    rendered = fragment_cache.pages.get(("menu", "/menu", fragment_cache.LOCALE))
+    assert rendered is not page
+    assert rendered.last_modified is page.last_modified
+
+    with Session() as db_session:
+        db_session.execute(update(Menu).where(Menu.id == position.id).values(price=91))
+        db_session.commit()
+    catalog_cache.refresh([position.id])
+    changed = client.get("/menu", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert "91" in changed.get_data(as_text=True)
+
+
+def test_logged_in_pages_are_not_shared(client, menu_names):
+    fragment_cache.clear()
+    login(client, "user00002")
+
+    response = client.get("/menu")
+
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert len(fragment_cache.pages) == 0
@@ -0,0 +1,68 @@
+from io import BytesIO
+
+from PIL import Image, PngImagePlugin
+import pytest
+
+import blob_store
+from fragment_cache import LRUCache
+import menu_images
+
+
+def png(color, size=(400, 300), **info):
+    buffer = BytesIO()
+    Image.new("RGBA", size, color).save(buffer, format="PNG", **info)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    store = blob_store.LocalBlobBackend(str(tmp_path / "menu"), static_folder=str(tmp_path))
+    monkeypatch.setattr(blob_store, "backend", store)
+    monkeypatch.setattr(menu_images, "_manifests", LRUCache(2))
+    return store
+
+
+def keys(backend):
+    return {key for key, _ in backend.list_keys()}
+
+
+def test_shared_derivatives_survive_until_last_reference(backend):
+    # Різні байти оригіналу (інший текстовий чанк), але однакові пікселі -
+    # отже однакові похідні
+    menu_images.build_derivatives(BytesIO(png("brown")), "a.png")
+    info = PngImagePlugin.PngInfo()
+    info.add_text("Comment", "copy")
+    menu_images.build_derivatives(BytesIO(png("brown", pnginfo=info)), "b.png")
+
+    shared = menu_images.derived_keys("a.png")
+    assert shared and shared == menu_images.derived_keys("b.png")
+
+    menu_images.delete_derivatives("a.png")
+    assert shared <= keys(backend)
+    assert menu_images.manifest_key("a.png") not in keys(backend)
+
+    menu_images.delete_derivatives("b.png")
+    assert keys(backend) == set()
+
+
+def test_unshared_derivatives_are_deleted(backend):
+    menu_images.build_derivatives(BytesIO(png("brown")), "a.png")
+    menu_images.build_derivatives(BytesIO(png("white")), "b.png")
+    kept = menu_images.derived_keys("b.png") | menu_images.ref_keys("b.png")
+
+    menu_images.delete_derivatives("a.png")
+
+    assert keys(backend) == kept | {menu_images.manifest_key("b.png")}
+
+
+def test_manifest_cache_is_bounded_and_skips_misses(backend):
+    assert menu_images.MenuImage("a.png").manifest is None
+    # Маніфест записав інший воркер - цей процес бачить його без скидання кешу
+    backend.put_bytes(menu_images.manifest_key("a.png"), b'{"source": "a.png", "variants": {}}')
+    assert menu_images.MenuImage("a.png").manifest["source"] == "a.png"
+
+    for file_name in ("b.png", "c.png"):
+        menu_images.build_derivatives(BytesIO(png("white")), file_name)
+        menu_images.MenuImage(file_name)
+    assert len(menu_images._manifests) == 2
+    assert menu_images._manifests.get("a.png") is None
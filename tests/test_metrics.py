@@ -0,0 +1,61 @@
+import threading
+
+from flask import Flask, request
+import pytest
+from sqlalchemy import create_engine, text
+
+import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_finished_threads_fold_into_retired_shard(registry):
+    for _ in range(50):
+        threads = [threading.Thread(target=registry.inc, args=("requests_total", ()))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(registry._shards) == 0
+    _, counters = registry.collect()
+    assert counters[("requests_total", ())] == 1000
+
+
+def test_collect_merges_live_and_retired_shards(registry):
+    registry.observe("request_duration_seconds", (), 0.02)
+    thread = threading.Thread(target=registry.observe, args=("request_duration_seconds", (), 20.0))
+    thread.start()
+    thread.join()
+
+    histograms, _ = registry.collect()
+    values = histograms[("request_duration_seconds", ())]
+    assert values[metrics.BUCKETS.index(0.025)] == 1
+    assert values[len(metrics.BUCKETS)] == 1
+    assert values[-1] == pytest.approx(20.02)
+
+
+def test_metrics_are_private_without_a_token(monkeypatch):
+    app = Flask(__name__)
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", None)
+    with app.test_request_context(headers={"Authorization": "Bearer "}):
+        assert not metrics.authorized(request)
+
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "secret")
+    with app.test_request_context(headers={"Authorization": "Bearer secret"}):
+        assert metrics.authorized(request)
+
+
+def test_failed_statement_does_not_leave_its_start_time():
+    engine = create_engine("sqlite://")
+    metrics.init_app(Flask(__name__), engine)
+
+    with engine.connect() as connection:
+        with pytest.raises(Exception):
+            connection.execute(text("SELECT * FROM missing_table"))
+        connection.execute(text("SELECT 1"))
+        assert connection.info.get("metrics_query_start") == []
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+
+import catalog_cache
+from main_db import Session, SpecialOffer
+import offer_scheduler
+import pricing
+
+
+def offer(offer_id, menu_id, expires_in, active=True):
+    return SimpleNamespace(id=offer_id, menu_id=menu_id, active=active,
+                           expiration_date=datetime.now() + expires_in)
+
+
+def test_heap_pops_only_due_offers_in_order():
+    scheduler = offer_scheduler.OfferExpiryScheduler()
+    for item in (offer(1, 10, timedelta(hours=2)), offer(2, 20, -timedelta(minutes=5)),
+                 offer(3, 30, timedelta(minutes=1)), offer(4, 20, -timedelta(hours=1)),
+                 offer(5, 50, -timedelta(hours=1), active=False)):
+        scheduler.schedule(item)
+
+    assert scheduler._pop_due(datetime.now()) == {20}
+    assert scheduler._heap[0][1] == 3
+    assert scheduler._pop_due(datetime.now() + timedelta(minutes=2)) == {30}
+    assert len(scheduler._heap) == 1
+
+
+def test_expiry_deactivates_and_patches_the_catalog(position):
+    with Session() as db_session:
+        offer_id = db_session.execute(insert(SpecialOffer).returning(SpecialOffer.id).values(
+            menu_id=position.id, discount=40, active=True,
+            expiration_date=datetime.now() - timedelta(seconds=1))).scalar()
+        db_session.commit()
+    catalog_cache.refresh([position.id])
+    assert [item.id for item in catalog_cache.get_catalog().by_id[position.id].special_offers] == [offer_id]
+
+    offer_scheduler.OfferExpiryScheduler()._expire({position.id})
+
+    with Session() as db_session:
+        assert db_session.get(SpecialOffer, offer_id).active is False
+    assert catalog_cache.get_catalog().by_id[position.id].special_offers == []
+    assert pricing.get_price_table()[position.id].discount == 0
+
+
+def test_sync_loads_active_offers(position):
+    expires = datetime.now() + timedelta(days=3)
+    with Session() as db_session:
+        offer_id = db_session.execute(insert(SpecialOffer).returning(SpecialOffer.id).values(
+            menu_id=position.id, discount=15, active=True, expiration_date=expires)).scalar()
+        db_session.commit()
+    scheduler = offer_scheduler.OfferExpiryScheduler()
+
+    scheduler._sync()
+
+    assert (expires, offer_id, position.id) in scheduler._heap
+    assert scheduler._heap[0] == min(scheduler._heap)
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+import passwords
+
+
+def _wait(event):
+    event.wait(5)
+    return True
+
+
+@pytest.fixture(autouse=True)
+def short_timeout(monkeypatch):
+    monkeypatch.setattr(passwords, "PASSWORD_TIMEOUT", 0.05)
+
+
+def test_timeout_raises_busy():
+    pool = passwords.HashingPool("thread", workers=1, queue_limit=2)
+    release = threading.Event()
+
+    with pytest.raises(passwords.HashingBusy):
+        pool.run(_wait, release)
+    # Друга задача стоїть у черзі за першою і скасовується по таймауту
+    with pytest.raises(passwords.HashingBusy):
+        pool.run(_wait, release)
+
+    release.set()
+    assert pool.run(_wait, release)
+
+
+def test_running_jobs_keep_their_slots_after_timeout():
+    pool = passwords.HashingPool("thread", workers=2, queue_limit=2)
+    release = threading.Event()
+    for _ in range(2):
+        with pytest.raises(passwords.HashingBusy):
+            pool.run(_wait, release)
+
+    # Запити вже отримали 503, але задачі ще виконуються і тримають слоти
+    assert not pool._slots.acquire(blocking=False)
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while not pool._slots.acquire(blocking=False):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    assert pool._slots.acquire(blocking=False)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+import baskets
+import catalog_cache
+from main_db import Session, SpecialOffer
+import pricing
+
+
+def add_offers(menu_id, *offers):
+    # Через insert(), бо валідатор моделі не пускає вже прострочені пропозиції
+    with Session() as db_session:
+        db_session.execute(insert(SpecialOffer), [{
+            "menu_id": menu_id, "discount": discount, "expiration_date": datetime.now() + expires_in,
+            "active": True,
+        } for discount, expires_in in offers])
+        db_session.commit()
+
+
+def test_best_live_offer_sets_the_price(position):
+    add_offers(position.id, (10, timedelta(days=1)), (30, timedelta(days=2)), (50, -timedelta(hours=1)))
+    catalog_cache.refresh([position.id])
+
+    entry = pricing.get_price_table()[position.id]
+
+    assert entry.discount == 30
+    assert entry.base_price == 80
+    assert entry.price == 56
+
+
+def test_patched_catalog_rebuilds_only_changed_prices(position, menu_names):
+    catalog_cache.invalidate()
+    table = pricing.get_price_table()
+    assert pricing.get_price_table() is table
+    other = catalog_cache.get_catalog().get_active(menu_names[0]).id
+
+    add_offers(position.id, (25, timedelta(days=1)))
+    catalog_cache.refresh([position.id])
+    patched = pricing.get_price_table()
+
+    assert patched.version == catalog_cache.get_catalog().version
+    assert patched[other] is table[other]
+    assert table[position.id].discount == 0
+    assert patched[position.id].discount == 25
+    assert patched[position.id].price == 60
+    assert position.id in {entry.menu_id for entry in patched.best_offers}
+
+
+def test_total_uses_effective_prices(position):
+    add_offers(position.id, (12.5, timedelta(days=1)))
+    catalog_cache.refresh([position.id])
+    table = pricing.get_price_table()
+    menu = catalog_cache.get_catalog().by_id[position.id]
+
+    assert table.total([baskets.BasketLine(position.id, 3, menu)]) == 210
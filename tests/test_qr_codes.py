@@ -0,0 +1,23 @@
+from conftest import csrf_token, idempotency_key, login
+
+
+def place_order(client, name):
+    client.post(f"/position/{name}", data={"csrf_token": csrf_token(client), "name": name, "quantity": 1})
+    page = client.get("/checkout")
+    client.post("/checkout", data={"csrf_token": csrf_token(client), "idempotency_key": idempotency_key(page)})
+    return client.get("/my_coupons.json").get_json()["coupons"][0]["url"] + "/qr.svg"
+
+
+def test_qr_of_another_users_coupon_is_not_served(app, menu_names):
+    owner, other = app.test_client(), app.test_client()
+    login(owner, "user00004")
+    login(other, "user00002")
+    qr_url = place_order(owner, menu_names[0])
+
+    # Власник прогріває LRU і отримує ETag; чужому юзеру не допомагає ні те, ні інше
+    response = owner.get(qr_url)
+    assert response.status_code == 200
+    assert other.get(qr_url).status_code == 404
+    assert other.get(qr_url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 404
+
+    assert owner.get(qr_url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
@@ -0,0 +1,170 @@
+from flask import jsonify
+from flask_login import current_user
+import pytest
+from sqlalchemy import func, literal, select
+
+from conftest import csrf_token, idempotency_key, login
+from main_db import Basket, Coupons, Session, Users, get_db
+import query_budget
+import user_cache
+
+
+def budget_of(app, endpoint):
+    return app.view_functions[endpoint].query_budget
+
+
+def assert_within_budget(app, response, endpoint):
+    # У режимі raise перевищення вже кинуло б QueryBudgetExceeded
+    assert int(response.headers["X-Query-Count"]) <= budget_of(app, endpoint)
+
+
+@pytest.fixture
+def shopper(client, menu_names):
+    login(client, "user00001")
+    for name in menu_names[:2]:
+        response = client.post(f"/position/{name}", data={
+            "csrf_token": csrf_token(client), "name": name, "quantity": 1})
+        assert response.status_code == 302
+    return client
+
+
+@pytest.mark.parametrize("url, endpoint", [
+    ("/", "home"),
+    ("/menu", "menu"),
+])
+def test_anonymous_pages(app, client, url, endpoint):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert_within_budget(app, response, endpoint)
+
+
+def test_shopping_routes(app, shopper, menu_names):
+    for url, endpoint in [
+        ("/", "home"),
+        ("/menu", "menu"),
+        (f"/position/{menu_names[0]}", "position"),
+        ("/basket", "basket"),
+        ("/checkout", "checkout_page"),
+    ]:
+        response = shopper.get(url)
+        assert response.status_code == 200, url
+        assert_within_budget(app, response, endpoint)
+
+    page = shopper.get("/checkout")
+    response = shopper.post("/checkout", data={
+        "csrf_token": csrf_token(shopper), "idempotency_key": idempotency_key(page)})
+    assert response.status_code == 302
+    assert_within_budget(app, response, "checkout")
+
+
+def test_coupon_routes(app, shopper):
+    page = shopper.get("/checkout")
+    shopper.post("/checkout", data={
+        "csrf_token": csrf_token(shopper), "idempotency_key": idempotency_key(page)})
+
+    for url, endpoint in [("/my_coupons", "my_coupons"), ("/my_coupons.json", "my_coupons_json")]:
+        response = shopper.get(url)
+        assert response.status_code == 200, url
+        assert_within_budget(app, response, endpoint)
+
+    coupon_url = shopper.get("/my_coupons.json").get_json()["coupons"][0]["url"]
+    for url, endpoint in [(coupon_url, "coupon"), (f"{coupon_url}/qr.svg", "coupon_qr")]:
+        response = shopper.get(url)
+        assert response.status_code == 200, url
+        assert_within_budget(app, response, endpoint)
+
+
+def test_routes_count_the_user_reload(app, shopper, menu_names, monkeypatch):
+    # Кешований у сесії юзер застарів: кожен запит ще й перечитує рядок users
+    monkeypatch.setattr(user_cache, "USER_CACHE_TTL", 0)
+    page = shopper.get("/checkout")
+    assert_within_budget(app, page, "checkout_page")
+    response = shopper.post(f"/position/{menu_names[2]}", data={
+        "csrf_token": csrf_token(shopper), "name": menu_names[2], "quantity": 1})
+    assert response.status_code == 302
+    assert_within_budget(app, response, "position_post")
+    response = shopper.post("/checkout", data={
+        "csrf_token": csrf_token(shopper), "idempotency_key": idempotency_key(page)})
+    assert_within_budget(app, response, "checkout")
+
+    coupon_url = shopper.get("/my_coupons.json").get_json()["coupons"][0]["url"]
+    for url, endpoint in [
+        ("/basket", "basket"),
+        ("/my_coupons", "my_coupons"),
+        (coupon_url, "coupon"),
+        # svg воркер не прогріває, тож це промах LRU
+        (f"{coupon_url}/qr.svg", "coupon_qr"),
+    ]:
+        response = shopper.get(url)
+        assert response.status_code == 200, url
+        assert_within_budget(app, response, endpoint)
+
+
+def test_basket_add_fits_budget_with_the_postgres_lock(app, shopper, menu_names, monkeypatch):
+    # На SQLite Basket._lock_user нічого не виконує; підміняємо його запитом,
+    # щоб порахувати pg_advisory_xact_lock, як у продакшені
+    monkeypatch.setattr(Basket, "_lock_user", staticmethod(
+        lambda db_session, user_id: db_session.execute(select(literal(1)))))
+    monkeypatch.setattr(user_cache, "USER_CACHE_TTL", 0)
+    name = menu_names[3]
+    # Інша вкладка вже додала цю позицію, тож після upsert кошик перечитується
+    other_tab = app.test_client()
+    login(other_tab, "user00001")
+    other_tab.post(f"/position/{name}", data={"csrf_token": csrf_token(other_tab), "name": name, "quantity": 1})
+
+    response = shopper.post(f"/position/{name}", data={
+        "csrf_token": csrf_token(shopper), "name": name, "quantity": 1})
+
+    assert response.status_code == 302
+    assert int(response.headers["X-Query-Count"]) == budget_of(app, "position_post")
+
+
+def test_login_within_budget(app, client):
+    client.get("/login")
+    response = client.post("/login", data={
+        "csrf_token": csrf_token(client), "username": "user00002", "password": "bench-password"})
+    assert response.status_code == 302
+    assert_within_budget(app, response, "login_post")
+
+
+def _user_with_orders(minimum):
+    with Session() as db_session:
+        username = db_session.query(Users.username).join(Coupons, Coupons.user_id == Users.id) \
+            .group_by(Users.id, Users.username).having(func.count(Coupons.id) >= minimum).limit(1).scalar()
+    assert username, "seed produced no user with enough orders"
+    return username
+
+
+def test_n_plus_one_in_a_route_raises(app, client, monkeypatch):
+    # Та сама сторінка історії, але рядки кожного купона довантажуються окремим запитом
+    def my_coupons_json():
+        coupons = get_db().query(Coupons).filter_by(user_id=current_user.id).all()
+        return jsonify([len(coupon.lines) for coupon in coupons])
+
+    budget = budget_of(app, "my_coupons_json")
+    login(client, _user_with_orders(query_budget.N_PLUS_ONE_THRESHOLD))
+    monkeypatch.setitem(app.view_functions, "my_coupons_json",
+                        query_budget.limit(budget)(my_coupons_json))
+
+    with pytest.raises(query_budget.QueryBudgetExceeded, match="N\\+1"):
+        client.get("/my_coupons.json")
+
+
+def test_exempt_statements_are_not_counted(app):
+    with app.test_request_context("/"):
+        query_budget._start_request()
+        with query_budget.exempt():
+            get_db().query(Coupons.id).first()
+        get_db().query(Coupons.id).first()
+        assert query_budget._log().count == 1
+
+
+def test_violations_report_budget_and_repeats():
+    query_log = query_budget.QueryLog()
+    query_log.statements["SELECT a"] = 1
+    query_log.statements["SELECT b WHERE id = ?"] = 3
+
+    problems = query_budget.violations(query_log, budget=2)
+
+    assert problems[0] == "4 queries, budget is 2"
+    assert problems[1].startswith("N+1: 3x SELECT b")
@@ -0,0 +1,30 @@
+from main_db import engine
+import migrations
+import query_plans
+
+
+def failures():
+    return {name for name, index, plan, ok in query_plans.check() if not ok}
+
+
+def test_hot_queries_use_their_indexes(menu_names):
+    # Схема тестової БД - як у benchmark.py: create_all + migrations.upgrade()
+    results = query_plans.check()
+
+    assert len(results) == len(query_plans.hot_queries())
+    failed = [f"{name}: expects {index}, plan: {plan}" for name, index, plan, ok in results if not ok]
+    assert not failed, "\n".join(failed)
+
+
+def test_check_notices_indexes_the_migrations_add(menu_names):
+    # Без міграцій 4 і 5 індексів історії, меню та пропозицій немає
+    migrations.downgrade(3)
+    # sqlite3 кешує підготовлені EXPLAIN у з'єднаннях пулу разом зі старим планом
+    engine.dispose()
+    try:
+        assert failures() == {"order history page", "expired offers",
+                              "offers of changed items", "active menu"}
+    finally:
+        migrations.upgrade()
+        engine.dispose()
+    assert failures() == set()
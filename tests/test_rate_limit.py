@@ -0,0 +1,16 @@
+import pytest
+
+import rate_limit
+
+
+def test_bucket_store_is_abstract():
+    with pytest.raises(TypeError):
+        rate_limit.BucketStore()
+
+
+def test_memory_bucket_store_limits_per_key():
+    store = rate_limit.MemoryBucketStore()
+    assert [store.take("a", 2, 1 / 60)[0] for _ in range(3)] == [True, True, False]
+    allowed, retry_after = store.take("a", 2, 1 / 60)
+    assert not allowed and 0 < retry_after <= 60
+    assert store.take("b", 2, 1 / 60)[0]
@@ -0,0 +1,65 @@
+from datetime import datetime, timedelta
+import random
+
+import pytest
+
+import sales_analytics
+
+
+def order_rows(count=500, seed=3):
+    rng = random.Random(seed)
+    start = datetime(2026, 3, 2, 8)
+    rows = []
+    for _ in range(count):
+        menu_id = rng.randint(1, 6)
+        discount = rng.choice((None, 0, 10, 25, 100))
+        rows.append((menu_id, f"Item {menu_id}", start + timedelta(minutes=rng.randint(0, 7 * 24 * 60)),
+                     rng.randint(1, 4), round(rng.uniform(40, 180), 2), discount))
+    return rows
+
+
+def test_batch_columns_follow_the_rows():
+    rows = order_rows(50)
+    report = sales_analytics.SalesReport()
+    batch = report.to_batch(rows)
+
+    assert len(batch) == len(rows)
+    for index, (menu_id, menu_name, order_time, quantity, unit_price, discount) in enumerate(rows):
+        discount = discount or 0
+        assert report.items[batch.item[index]] == (menu_id, menu_name)
+        assert report.offers[batch.offer[index]] == (batch.item[index], discount)
+        assert batch.revenue[index] == pytest.approx(unit_price * quantity)
+        full_price = unit_price / (1 - discount / 100) if discount < 100 else unit_price
+        assert batch.full_price[index] == pytest.approx(full_price * quantity)
+        assert batch.discounted[index] == (1 if discount else 0)
+        assert batch.hour[index] == order_time.weekday() * 24 + order_time.hour
+
+
+def test_vectorized_and_loop_aggregation_agree():
+    pytest.importorskip("numpy")
+    rows = order_rows()
+    vectorized, loop = sales_analytics.SalesReport(), sales_analytics.SalesReport()
+    # Два батчі, щоб перевірити і накопичення між ними
+    for report, add in ((vectorized, vectorized._add_vectorized), (loop, loop._add_loop)):
+        for part in (rows[:200], rows[200:]):
+            add(report.to_batch(part))
+
+    for column in ("item_units", "item_lines", "item_discounted_units", "item_discounted_lines",
+                   "offer_units", "offer_lines", "hour_units"):
+        assert getattr(vectorized, column) == getattr(loop, column), column
+    for column in ("item_revenue", "item_full_price", "offer_revenue", "hour_revenue"):
+        assert getattr(vectorized, column) == pytest.approx(getattr(loop, column)), column
+
+
+def test_report_over_order_lines(menu_names):
+    from main_db import OrderLine, Session
+
+    with Session() as db_session:
+        lines = db_session.query(OrderLine).count()
+        units = sum(quantity for (quantity,) in db_session.query(OrderLine.quantity))
+
+    report = sales_analytics.build_report(batch_size=7)
+
+    assert report.lines == lines
+    assert sum(row["units"] for row in report.item_rows()) == units
+    assert sum(map(sum, report.heatmap())) == units
@@ -0,0 +1,106 @@
+from datetime import datetime
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from main_db import Users
+
+
+# Скільки секунд довіряти даним юзера з cookie сесії, перш ніж перечитати рядок з БД.
+# Це верхня межа того, як довго інший воркер може бачити старі права після їх зміни
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+SESSION_KEY = "cached_user"
+
+
+class CachedUser:
+    '''Lightweight stand-in for Users that Flask-Login keeps as current_user.
+
+    Carries only what templates and permission checks need. Routes that
+    need the password hash or relationships load the Users row explicitly.
+    '''
+
+    __slots__ = ("id", "username", "email", "is_admin", "created_at")
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, email, is_admin, created_at=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.is_admin = is_admin
+        self.created_at = created_at
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, bool(user.is_admin),
+                   getattr(user, "created_at", None))
+
+    def get_id(self):
+        return str(self.id)
+
+    def to_payload(self):
+        return {"id": self.id, "username": self.username, "email": self.email,
+                "is_admin": self.is_admin,
+                "created_at": self.created_at.isoformat() if self.created_at else None,
+                "cached_at": time.time()}
+
+    @classmethod
+    def from_payload(cls, payload):
+        created_at = payload["created_at"]
+        return cls(payload["id"], payload["username"], payload["email"], payload["is_admin"],
+                   datetime.fromisoformat(created_at) if created_at else None)
+
+
+# user_id -> час останньої зміни рядка в цьому процесі; payload, записаний раніше, вже неактуальний
+_invalidated = {}
+_invalidated_lock = threading.Lock()
+
+
+def invalidate(user_id):
+    with _invalidated_lock:
+        _invalidated[int(user_id)] = time.time()
+
+
+@event.listens_for(Users, "after_update")
+def _users_updated(mapper, connection, target):
+    invalidate(target.id)
+
+
+def remember(session, user):
+    '''Stores the user in the signed session cookie and returns a CachedUser.'''
+    cached = user if isinstance(user, CachedUser) else CachedUser.from_user(user)
+    session[SESSION_KEY] = cached.to_payload()
+    return cached
+
+
+def forget(session):
+    session.pop(SESSION_KEY, None)
+
+
+def from_session(session, user_id):
+    '''Returns the CachedUser from the session if it is still fresh, else None.'''
+    payload = session.get(SESSION_KEY)
+    if not payload or str(payload.get("id")) != str(user_id):
+        return None
+
+    stale_before = max(time.time() - USER_CACHE_TTL, _invalidated.get(payload["id"], 0))
+    if payload.get("cached_at", 0) <= stale_before:
+        return None
+    return CachedUser.from_payload(payload)
+
+
+def load(session, user_id, db_session):
+    '''Flask-Login user loader: session payload first, the database on a miss.'''
+    cached = from_session(session, user_id)
+    if cached is not None:
+        return cached
+
+    user = db_session.get(Users, int(user_id))
+    if user is None:
+        forget(session)
+        return None
+    return remember(session, user)